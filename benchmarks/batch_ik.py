@@ -0,0 +1,142 @@
+"""Benchmarks BatchIKSolver against solving each IKChain on its own.
+
+Builds pairs of identical legs, set up like those of Humanoid, and moves them and their foot targets to random places
+every frame. One leg of each pair is solved with IKChain.updateIK(), the other with BatchIKSolver. The time per chain of
+both is reported for each number of chains, together with how many chains ended up with the same bone rotations and
+how far the feet are from their targets on average. Like Humanoid's legs, these are two bone chains, which both solvers
+solve in closed form, in 32 and 64 bit floats respectively.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.batch_ik --chains 10 50 200 400
+"""
+
+import argparse
+import json
+import math
+import random
+from time import perf_counter
+
+from panda3d.core import load_prc_file_data
+
+load_prc_file_data("", """
+    window-type none
+    audio-library-name null
+""")
+
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import LVector3f, Vec3
+
+base = ShowBase()
+
+from src.inverse_kinematics.ArmatureUtils import ArmatureUtils
+from src.inverse_kinematics.BatchIKSolver import BatchIKSolver
+from src.inverse_kinematics.IKChain import IKChain
+
+# The proportions of a Humanoid that's 1.7 m tall
+THIGH_LENGTH = 0.4457
+LOWER_LEG_LENGTH = 0.3022
+HIP = Vec3(0.095, 0, -0.17)
+
+
+def create_leg(body):
+    """A leg with the same bones and constraints as those of Humanoid."""
+    au = ArmatureUtils()
+    root_joint = au.createJoint("root")
+    thigh = au.createJoint("upperLeg", parentJoint=root_joint, translate=HIP)
+    lower_leg = au.createJoint("lowerLeg", parentJoint=thigh, translate=-LVector3f.unitZ() * THIGH_LENGTH)
+    foot = au.createJoint("foot", parentJoint=lower_leg, translate=-LVector3f.unitZ() * LOWER_LEG_LENGTH)
+    au.finalize()
+    au.getActor().reparentTo(body)
+
+    leg = IKChain(au.getActor())
+    bone = leg.addJoint(thigh, au.getControlNode(thigh.getName()))
+    bone = leg.addJoint(lower_leg, au.getControlNode(lower_leg.getName()), parentBone=bone)
+    leg.addJoint(foot, au.getControlNode(foot.getName()), parentBone=bone)
+    leg.setBallConstraint(thigh.getName(), minAng=-math.pi * 0.2, maxAng=math.pi * 0.2)
+    leg.setHingeConstraint(lower_leg.getName(), LVector3f.unitX(), minAng=-math.pi * 0.7, maxAng=0)
+    leg.setBallConstraint(foot.getName(), minAng=0, maxAng=math.pi * 0.6)
+    leg.setTarget(render.attach_new_node("FootTarget"))
+    return leg
+
+
+def quat_distance(leg_a, leg_b):
+    """The largest difference between the bone rotations of two legs. q and -q are the same rotation."""
+    distance = 0
+    for bone_a, bone_b in zip(leg_a.bones, leg_b.bones):
+        quat_a, quat_b = bone_a.controlNode.getQuat(), bone_b.controlNode.getQuat()
+        distance = max(distance, min((quat_a - quat_b).length(), (quat_a + quat_b).length()))
+    return distance
+
+
+def foot_error(leg):
+    return (leg.target.getPos(render) - leg.bones[-1].controlNode.getPos(render)).length()
+
+
+def run(num_chains, frames, rng):
+    bodies = [render.attach_new_node("Body") for _ in range(num_chains)]
+    legs = [create_leg(body) for body in bodies]
+    batched_legs = [create_leg(body) for body in bodies]
+    # Always batched, however few chains there are
+    ik_solver = BatchIKSolver(minBatchSize=0)
+    for leg in batched_legs:
+        ik_solver.addChain(leg)
+
+    single_time = batched_time = 0
+    same = single_error = batched_error = 0
+    for frame in range(frames):
+        for body, leg, batched_leg in zip(bodies, legs, batched_legs):
+            body.set_pos_hpr(rng.uniform(-5, 5), rng.uniform(-5, 5), 1, rng.uniform(-180, 180), 0, 0)
+            target = Vec3(body.get_x() + rng.uniform(-0.3, 0.3), body.get_y() + rng.uniform(-0.3, 0.3),
+                          rng.uniform(0.2, 0.6))
+            leg.target.set_pos(target)
+            batched_leg.target.set_pos(target)
+
+        start = perf_counter()
+        for leg in legs:
+            leg.updateIK()
+        single_time += perf_counter() - start
+
+        start = perf_counter()
+        for leg in batched_legs:
+            leg.updateIK()
+        ik_solver.solve()
+        batched_time += perf_counter() - start
+
+        for leg, batched_leg in zip(legs, batched_legs):
+            same += quat_distance(leg, batched_leg) < 1e-2
+            single_error += foot_error(leg)
+            batched_error += foot_error(batched_leg)
+
+    for body in bodies:
+        body.remove_node()
+    solves = num_chains * frames
+    return {
+        "chains": num_chains,
+        "frames": frames,
+        "single_us_per_chain": single_time / solves * 1e6,
+        "batched_us_per_chain": batched_time / solves * 1e6,
+        "speedup": single_time / batched_time,
+        "same_rotations": same / solves,
+        "single_mean_foot_error": single_error / solves,
+        "batched_mean_foot_error": batched_error / solves,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chains", type=int, nargs="+", default=[10, 50, 200, 400])
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = []
+    for num_chains in args.chains:
+        result = run(num_chains, args.frames, rng)
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""Headless benchmark of the per-frame cost of a crowd of Humanoids.
+
+Spawns humanoids on the debug heightmap without opening a window, walks them around with scripted inputs for a fixed
+number of frames and reports how much time each subsystem took, as JSON. Natural language generation itself is not
+included, because it would need a language model, but the per-frame NLP bookkeeping is.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.crowd --humanoids 100 --frames 300
+"""
+
+import argparse
+import json
+from contextlib import contextmanager
+from math import ceil, sqrt, radians
+from pathlib import Path
+from time import perf_counter
+
+from panda3d.core import load_prc_file_data, Filename
+
+# Assets are looked up relative to the root directory, like when running specusim.py
+root_dir = Filename.from_os_specific(str(Path(__file__).resolve().parent.parent)).get_fullpath()
+load_prc_file_data("", f"""
+    model-path {root_dir}
+    window-type none
+    audio-library-name null
+    textures-power-2 none
+    transform-cache 0
+    bullet-filter-algorithm groups-mask
+""")
+
+from direct.showbase.ShowBase import ShowBase
+from panda3d.bullet import BulletHeightfieldShape, BulletRigidBodyNode, BulletWorld, ZUp
+from panda3d.core import BitMask32, ClockObject, Vec3
+
+base = ShowBase()
+
+from src.humanoid import Humanoid
+from src.inverse_kinematics.BatchIKSolver import BatchIKSolver
+from src.language_processing.nlp_manager import NLPManager
+from src.terrain import TerrainHeightSampler, GroundQueryBatch
+from src.utils import create_or_load_walk_map
+
+SUBSYSTEMS = ("physics", "ground_queries", "ik", "locomotion", "speech", "nlp_update")
+WALK_FORWARD = radians(90)
+LINES = ("Hello!", "Nice weather today, isn't it?", "Have you seen the sword I lost? It was long and pointy.")
+
+
+class SubsystemTimer:
+    """Accumulates wall-clock time per subsystem.
+
+    The times are exclusive: e.g. IK that is done from within the locomotion code only counts as IK.
+    """
+
+
+    def __init__(self):
+        self.totals = dict.fromkeys(SUBSYSTEMS, 0.0)
+        self.enabled = False
+        self._nested_times = []
+
+
+    @contextmanager
+    def measure(self, subsystem):
+        """Adds the running time of the with block to the subsystem's total."""
+        if not self.enabled:
+            yield
+            return
+        self._nested_times.append(0.0)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            self.totals[subsystem] += elapsed - self._nested_times.pop()
+            if self._nested_times:
+                self._nested_times[-1] += elapsed
+
+
+    def wrap(self, obj, method_name, subsystem):
+        """Replaces a method of a single object with one that adds its running time to the subsystem's total."""
+        method = getattr(obj, method_name)
+
+        def timed(*args, **kwargs):
+            with self.measure(subsystem):
+                return method(*args, **kwargs)
+
+        setattr(obj, method_name, timed)
+
+
+def create_world(use_batch):
+    terrain_height = 25.0
+    world = BulletWorld()
+    world.set_gravity(Vec3(0, 0, 0))
+    # The same collision groups as in the game modes
+    world.set_group_collision_flag(1, 0, False)
+    world.set_group_collision_flag(1, 1, False)
+    world.set_group_collision_flag(3, 0, False)
+    world.set_group_collision_flag(3, 1, False)
+    world.set_group_collision_flag(3, 3, True)
+
+    walk_map = create_or_load_walk_map("worldmaps/debug_heightmap.png", "worldmaps/debug_ocean.png")
+    terrain_colshape = BulletHeightfieldShape(walk_map, terrain_height, ZUp)
+    terrain_colshape.set_use_diamond_subdivision(True)
+    terrain_bullet_node = BulletRigidBodyNode("terrainBodyNode")
+    terrain_bullet_node.add_shape(terrain_colshape)
+    terrain_np = render.attach_new_node(terrain_bullet_node)
+    terrain_np.set_collide_mask(BitMask32.bit(0))
+    world.attach(terrain_bullet_node)
+
+    height_sampler = None
+    ground_queries = None
+    if use_batch:
+        height_sampler = TerrainHeightSampler(walk_map, terrain_height, diamond_subdivision=True)
+        ground_queries = GroundQueryBatch(height_sampler)
+    return world, terrain_bullet_node, height_sampler, ground_queries
+
+
+def drive(humanoid, frame, index):
+    """Scripted input: walk forward, turn for a while, and then stop for a bit."""
+    phase = (frame + index * 7) % 240
+    if phase >= 180:
+        humanoid.stand_still()
+        return
+    if 60 <= phase < 90:
+        humanoid.turn_left()
+    elif 120 <= phase < 150:
+        humanoid.turn_right()
+    humanoid.walk_in_dir(WALK_FORWARD)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--humanoids", type=int, default=25)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--warmup-frames", type=int, default=30, help="Frames to run before timing starts")
+    parser.add_argument("--fps", type=float, default=60, help="The fixed frame rate to simulate")
+    parser.add_argument("--say-every", type=int, default=120, help="How often (in frames) each humanoid says something")
+    parser.add_argument("--raycast", action="store_true",
+                        help="Use Bullet raycasts for ground queries instead of TerrainHeightSampler and GroundQueryBatch")
+    parser.add_argument("--walk-speed", type=float, help="The walking speed of the humanoids in m/s, if not their own")
+    parser.add_argument("--unbatched-ik", action="store_true",
+                        help="Let each leg solve itself in IKChain.updateIK() instead of using BatchIKSolver")
+    parser.add_argument("--output", help="Also write the results into this file")
+    args = parser.parse_args()
+
+    # Every frame is exactly 1/fps seconds long, so that runs are comparable with each other
+    globalClock.set_mode(ClockObject.M_non_real_time)
+    globalClock.set_frame_rate(args.fps)
+
+    timer = SubsystemTimer()
+    world, terrain_bullet_node, height_sampler, ground_queries = create_world(not args.raycast)
+
+    ik_solver = None if args.unbatched_ik else BatchIKSolver()
+    start = perf_counter()
+    humanoids = []
+    side = ceil(sqrt(args.humanoids))
+    for i in range(args.humanoids):
+        x = (i % side) * 2 - (side - 1)
+        y = (i // side) * 2 - (side - 1)
+        humanoid = Humanoid(world, terrain_bullet_node, x, y, height_sampler=height_sampler)
+        if args.walk_speed is not None:
+            humanoid.walk_speed = args.walk_speed
+            humanoid.leg_movement_speed = args.walk_speed * 3
+        humanoids.append(humanoid)
+        if ground_queries:
+            ground_queries.add(humanoid)
+        if ik_solver:
+            for leg in humanoid.leg:
+                ik_solver.addChain(leg)
+    spawn_time = perf_counter() - start
+
+    nlp_manager = NLPManager(None, num_threads=0)
+
+    for humanoid in humanoids:
+        timer.wrap(humanoid, "walk_in_dir", "locomotion")
+        timer.wrap(humanoid, "get_ground_z_pos", "ground_queries")
+        timer.wrap(humanoid, "say", "speech")
+        for leg in humanoid.leg:
+            timer.wrap(leg, "updateIK", "ik")
+
+    total_frames = args.warmup_frames + args.frames
+    for frame in range(total_frames):
+        if frame == args.warmup_frames:
+            timer.enabled = True
+            start = perf_counter()
+
+        with timer.measure("physics"):
+            world.do_physics(globalClock.get_dt(), 5, 1.0 / 80.0)
+        if ground_queries:
+            with timer.measure("ground_queries"):
+                ground_queries.resolve()
+        for i, humanoid in enumerate(humanoids):
+            drive(humanoid, frame, i)
+            if args.say_every > 0 and (frame + i) % args.say_every == 0:
+                humanoid.say(LINES[(frame // args.say_every + i) % len(LINES)])
+        if ik_solver:
+            with timer.measure("ik"):
+                ik_solver.solve()
+        with timer.measure("nlp_update"):
+            nlp_manager.update()
+        # Advances the clock, and runs the hide tasks of the speech bubbles among others
+        taskMgr.step()
+    total_time = perf_counter() - start
+
+    result = {
+        "humanoids": args.humanoids,
+        "frames": args.frames,
+        "ground_queries": "raycast" if args.raycast else "batched",
+        "ik": "unbatched" if args.unbatched_ik else "batched",
+        "walk_speed": humanoids[0].walk_speed if humanoids else None,
+        "spawn_s": spawn_time,
+        "fps": args.frames / total_time,
+        "frame_ms": total_time / args.frames * 1000,
+        "subsystem_ms_per_frame": {name: total / args.frames * 1000 for name, total in timer.totals.items()},
+    }
+    result["subsystem_ms_per_frame"]["other"] = result["frame_ms"] - sum(result["subsystem_ms_per_frame"].values())
+
+    output = json.dumps(result, indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Checks GPT2LMHeadModelExperimental against GPT2LMHeadModel, and benchmarks the two.
+
+Both models are loaded from the same weights. A prompt is run through them, and then the same tokens are generated
+greedily, one at a time, with each model's own past key/values. The experimental model is also run once without past
+key/values, on the prompt and the tokens that GPT2LMHeadModel generated. Both ways, the experimental model must pick the
+same tokens, and their logits may differ from those of GPT2LMHeadModel by at most --tolerance times the largest absolute
+logit of GPT2LMHeadModel, or an AssertionError is raised. The largest differences are reported, followed by the tokens
+per second of both models.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.experimental_model --model language_models/<model folder>
+"""
+
+import argparse
+import json
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+from src.language_processing.gpt2 import GPT2LMHeadModelExperimental
+from src.language_processing.gpt2generator import GPT2LMHeadModel
+from src.language_processing.weight_cache import load_pretrained
+
+
+def generate_greedy(model, prompt, length):
+    """Continues the prompt with the most likely tokens.
+
+    Returns:
+        Tuple[List[int], List[torch.Tensor], float]: The tokens, the logits of the last position at each step, and how many
+        seconds the steps after the prompt took
+    """
+    tokens, step_logits = [], []
+    next_tokens = prompt
+    pasts = None
+    start = None
+    with torch.no_grad():
+        for _ in range(length):
+            logits, pasts = model(input_ids=next_tokens, past=pasts)
+            step_logits.append(logits[-1].float())
+            next_tokens = logits[-1:].argmax(-1)
+            tokens.append(next_tokens.item())
+            if start is None:
+                start = perf_counter()
+    return tokens, step_logits, perf_counter() - start
+
+
+def logits_without_cache(model, prompt, tokens):
+    """Runs the prompt and the generated tokens through the model at once, without past key/values.
+
+    Returns:
+        torch.Tensor: (len(tokens), vocabulary size) The logits that each of the tokens was picked from
+    """
+    with torch.no_grad():
+        logits = model(input_ids=torch.cat((prompt, torch.tensor(tokens[:-1], dtype=prompt.dtype))))[0]
+    return logits.reshape(-1, logits.size(-1))[len(prompt) - 1:].float()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--prompt-length", type=int, default=256)
+    parser.add_argument("--tokens", type=int, default=100, help="Tokens to generate")
+    parser.add_argument("--tolerance", type=float, default=1e-4,
+                        help="The largest allowed difference between the logits of the models, relative to the largest "
+                             "absolute logit")
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    models = {
+        "gpt2": load_pretrained(GPT2LMHeadModel, args.model, torch.float32).eval(),
+        "gpt2-experimental": load_pretrained(GPT2LMHeadModelExperimental, args.model, torch.float32).eval(),
+    }
+    vocab_size = models["gpt2"].config.vocab_size
+    prompt = torch.randint(0, vocab_size, (args.prompt_length,))
+
+    outputs = {name: generate_greedy(model, prompt, args.tokens) for name, model in models.items()}
+    (tokens, logits, time), (experimental_tokens, experimental_logits, experimental_time) = outputs.values()
+
+    logit_diff = max((a - b).abs().max().item() for a, b in zip(logits, experimental_logits))
+    uncached_logits = logits_without_cache(models["gpt2-experimental"], prompt, tokens)
+    uncached_logit_diff = (torch.stack(logits) - uncached_logits).abs().max().item()
+    uncached_tokens = uncached_logits.argmax(-1).tolist()
+    max_diff = args.tolerance * max(step_logits.abs().max().item() for step_logits in logits)
+
+    result = {
+        "max_abs_logit_diff": logit_diff,
+        "same_tokens": tokens == experimental_tokens,
+        "uncached_max_abs_logit_diff": uncached_logit_diff,
+        "uncached_same_tokens": tokens == uncached_tokens,
+        "gpt2_tokens_per_s": (args.tokens - 1) / time,
+        "gpt2_experimental_tokens_per_s": (args.tokens - 1) / experimental_time,
+        "speedup": time / experimental_time,
+    }
+    print(json.dumps(result))
+    assert result["same_tokens"], "With past key/values, the experimental model picked other tokens"
+    assert logit_diff <= max_diff, f"With past key/values, the logits differ by up to {logit_diff}"
+    assert result["uncached_same_tokens"], "Without past key/values, the experimental model picked other tokens"
+    assert uncached_logit_diff <= max_diff, \
+        f"Without past key/values, the logits differ by up to {uncached_logit_diff}"
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Measures the armatures of a crowd of Humanoids: Characters, joints, nodes, and the per-frame cost of updating them.
+
+Spawns humanoids like benchmarks.crowd does and walks them around. Every frame, after their legs have been moved by IK,
+all Characters in the scene are updated, which is what Panda3D does for each visible Character while rendering. The
+counts are per humanoid.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.humanoid_armature --humanoids 100 --frames 120
+"""
+
+import argparse
+import json
+from math import ceil, sqrt
+from time import perf_counter
+
+from panda3d.core import CharacterJoint
+
+from benchmarks.crowd import create_world, drive
+from src.humanoid import Humanoid
+
+
+def count_joints(part_group):
+    count = 0
+    for i in range(part_group.get_num_children()):
+        child = part_group.get_child(i)
+        count += isinstance(child, CharacterJoint) + count_joints(child)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--humanoids", type=int, default=100)
+    parser.add_argument("--frames", type=int, default=120)
+    args = parser.parse_args()
+
+    world, terrain_bullet_node, height_sampler, ground_queries = create_world(True)
+    nodes_before = len(render.find_all_matches("**"))
+    start = perf_counter()
+    humanoids = []
+    side = ceil(sqrt(args.humanoids))
+    for i in range(args.humanoids):
+        humanoid = Humanoid(world, terrain_bullet_node, (i % side) * 2 - (side - 1), (i // side) * 2 - (side - 1),
+                            height_sampler=height_sampler)
+        ground_queries.add(humanoid)
+        humanoids.append(humanoid)
+    spawn_time = perf_counter() - start
+    nodes = len(render.find_all_matches("**")) - nodes_before
+
+    characters = render.find_all_matches("**/+Character")
+    joints = sum(count_joints(character.node().get_bundle(0)) for character in characters)
+
+    update_time = 0
+    for frame in range(args.frames):
+        world.do_physics(1 / 60, 5, 1.0 / 80.0)
+        ground_queries.resolve()
+        for i, humanoid in enumerate(humanoids):
+            drive(humanoid, frame, i)
+        start = perf_counter()
+        for character in characters:
+            character.node().force_update()
+        update_time += perf_counter() - start
+        taskMgr.step()
+
+    result = {
+        "humanoids": args.humanoids,
+        "characters_per_humanoid": len(characters) / args.humanoids,
+        "joints_per_humanoid": joints / args.humanoids,
+        "nodes_per_humanoid": nodes / args.humanoids,
+        "spawn_ms_per_humanoid": spawn_time / args.humanoids * 1e3,
+        "character_update_ms_per_frame": update_time / args.frames * 1e3,
+    }
+    print(json.dumps(result))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Measures how long spawning Humanoids takes and how much memory each of them needs.
+
+Spawns humanoids like benchmarks.crowd does, cycling through the given heights. The first humanoid of each height is
+timed separately, since the body parts that humanoids of the same proportions share are created for it. The memory of
+a humanoid is the growth of the process' peak resident set size, together with how many distinct scene graph nodes,
+collision shapes and geoms it adds. Nothing is simulated.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.humanoid_spawn --humanoids 200 --heights 1.7 1.8
+"""
+
+import argparse
+import json
+import resource
+from math import ceil, sqrt
+from time import perf_counter
+
+from panda3d.bullet import BulletRigidBodyNode
+from panda3d.core import GeomNode
+
+from benchmarks.crowd import create_world
+from src.humanoid import Humanoid
+
+
+def peak_rss_kb():
+    # In KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_scene():
+    """The distinct nodes, collision shapes and geoms in the scene, however often they are instanced."""
+    nodes = {node_path.node().this: node_path.node() for node_path in render.find_all_matches("**")}
+    shapes = set()
+    geoms = set()
+    for node in nodes.values():
+        if isinstance(node, BulletRigidBodyNode):
+            shapes.update(shape.this for shape in node.get_shapes())
+        elif isinstance(node, GeomNode):
+            geoms.update(geom.this for geom in node.get_geoms())
+    return len(nodes), len(shapes), len(geoms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--humanoids", type=int, default=200)
+    parser.add_argument("--heights", type=float, nargs="+", default=[1.7])
+    args = parser.parse_args()
+
+    world, terrain_bullet_node, height_sampler, ground_queries = create_world(True)
+    nodes_before, shapes_before, geoms_before = count_scene()
+    rss_before = peak_rss_kb()
+
+    first_spawn_time = spawn_time = 0
+    humanoids = []
+    side = ceil(sqrt(args.humanoids))
+    for i in range(args.humanoids):
+        height = args.heights[i % len(args.heights)]
+        start = perf_counter()
+        humanoid = Humanoid(world, terrain_bullet_node, (i % side) * 2 - (side - 1), (i // side) * 2 - (side - 1),
+                            height=height, height_sampler=height_sampler)
+        elapsed = perf_counter() - start
+        if i < len(args.heights):
+            first_spawn_time += elapsed
+        else:
+            spawn_time += elapsed
+        ground_queries.add(humanoid)
+        humanoids.append(humanoid)
+
+    nodes, shapes, geoms = count_scene()
+    num_firsts = min(len(args.heights), args.humanoids)
+    num_rest = max(args.humanoids - num_firsts, 1)
+    result = {
+        "humanoids": args.humanoids,
+        "heights": args.heights,
+        "first_spawn_ms_per_height": first_spawn_time / num_firsts * 1e3,
+        "spawn_ms_per_humanoid": spawn_time / num_rest * 1e3,
+        "peak_rss_kb_per_humanoid": (peak_rss_kb() - rss_before) / args.humanoids,
+        "nodes_per_humanoid": (nodes - nodes_before) / args.humanoids,
+        "collision_shapes_per_humanoid": (shapes - shapes_before) / args.humanoids,
+        "geoms_per_humanoid": (geoms - geoms_before) / args.humanoids,
+    }
+    print(json.dumps(result))
+    return result
+
+
+if __name__ == "__main__":
+    main()
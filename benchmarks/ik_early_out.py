@@ -0,0 +1,74 @@
+"""Benchmarks how much IKChain.updateIK() costs when the legs' targets barely move.
+
+Legs like those of Humanoid are updated every frame, while their bodies and foot targets move by a given distance per
+frame in random directions. Below updateIK()'s tolerance, solving is skipped. The time per updateIK() call and the share
+of calls that actually solved the chain are reported for each distance, once with the default tolerance and once with a
+tolerance of zero, which solves every time.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.ik_early_out --legs 200 --frames 30
+"""
+
+import argparse
+import json
+import random
+from time import perf_counter
+
+from panda3d.core import Vec3
+
+from benchmarks.batch_ik import create_leg, foot_error
+
+
+def run(legs, bodies, frames, step, tolerance, rng):
+    kwargs = {} if tolerance is None else {"tolerance": tolerance}
+    for body, leg in zip(bodies, legs):
+        body.set_pos_hpr(rng.uniform(-5, 5), rng.uniform(-5, 5), 1, rng.uniform(-180, 180), 0, 0)
+        leg.target.set_pos(body.get_x(), body.get_y(), 0.4)
+        leg.updateIK(**kwargs)
+
+    solves = 0
+    elapsed = error = 0
+    for frame in range(frames):
+        for body, leg in zip(bodies, legs):
+            body.set_pos(body.get_pos() + Vec3(rng.uniform(-1, 1), rng.uniform(-1, 1), 0).normalized() * step)
+        before = [leg.solvedTargetPos for leg in legs]
+        start = perf_counter()
+        for leg in legs:
+            leg.updateIK(**kwargs)
+        elapsed += perf_counter() - start
+        solves += sum(leg.solvedTargetPos is not pos for leg, pos in zip(legs, before))
+        error += sum(foot_error(leg) for leg in legs)
+
+    calls = len(legs) * frames
+    return {
+        "step_m": step,
+        "tolerance": "default" if tolerance is None else tolerance,
+        "us_per_update": elapsed / calls * 1e6,
+        "solved": solves / calls,
+        "mean_foot_error": error / calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--legs", type=int, default=200)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--steps", type=float, nargs="+", default=[0.0, 0.001, 0.003, 0.03],
+                        help="How far the bodies move each frame, in m")
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bodies = [render.attach_new_node("Body") for _ in range(args.legs)]
+    legs = [create_leg(body) for body in bodies]
+    results = []
+    for step in args.steps:
+        for tolerance in (None, 0):
+            result = run(legs, bodies, args.frames, step, tolerance, rng)
+            print(json.dumps(result))
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
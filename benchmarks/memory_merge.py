@@ -0,0 +1,97 @@
+"""Benchmarks putting together the prompts of a conversation, against the way it was done before the lines were cached.
+
+A conversation with one NPC is simulated: on every turn, a prompt is made from the context, the short-term memory, what
+was said and the answer prompt, and then what was said and a made-up answer are added to the short-term memory. The
+prompts are checked to be the same as before, and the time per prompt is reported for the first and last turns.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.memory_merge --model language_models/<model folder>
+"""
+
+import argparse
+import json
+from pathlib import Path
+from time import perf_counter
+
+from src.language_processing.gpt2generator import GPT2Generator
+
+
+def encode_prepend_newline_old(tokenizer, s):
+    return tokenizer.encode('====\n\n' + s)[2:]
+
+
+def memory_merge_old(generator, *args):
+    """GPT2Generator.memory_merge() as it was before the lines were cached."""
+    tokenizer = generator.tokenizer
+    merge_objects = [[]] * len(args)
+    length = 0
+    max_len = 0
+    for i, arg in enumerate(reversed(args), start=1):
+        if isinstance(arg, str):
+            new_tokens = encode_prepend_newline_old(tokenizer, arg)
+            length += len(new_tokens)
+            if length > generator.max_history_tokens:
+                break
+            merge_objects[-i] = new_tokens
+        else:
+            max_len = max(len(arg), max_len)
+    else:
+        for i in range(1, max_len + 1):
+            for j, arg in enumerate(args, start=1):
+                if isinstance(arg, str) or len(arg) < i:
+                    continue
+                new_tokens = encode_prepend_newline_old(tokenizer, arg[-i])
+                length += len(new_tokens)
+                if length > generator.max_history_tokens:
+                    break
+                merge_objects[j] = new_tokens + merge_objects[j]
+            else:
+                continue
+            break
+    first, *rest = sum(merge_objects, [])
+    return tokenizer.encode('====\n' + tokenizer.decode(first))[2:] + rest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--report-turns", type=int, default=20, help="How many of the first and last turns to average")
+    args = parser.parse_args()
+
+    generator = GPT2Generator(model_path=args.model)
+    context = "You are speaking to a person called Tabula Rasa."
+    prompt = "Tabula Rasa answers: \""
+    memory = []
+    old_times, new_times = [], []
+    for turn in range(args.turns):
+        said = f"You say: \"Have you seen the sword I lost on day {turn}?\""
+
+        start = perf_counter()
+        old_tokens = memory_merge_old(generator, context, memory, said, prompt)
+        old_times.append(perf_counter() - start)
+
+        start = perf_counter()
+        new_tokens = generator.memory_merge(context, memory, said, prompt)
+        new_times.append(perf_counter() - start)
+
+        assert new_tokens == old_tokens, f"The prompts differ on turn {turn}"
+        memory.append(said)
+        memory.append(prompt + f"No, but I saw a long and pointy stick {turn} steps from here.\"")
+
+    n = args.report_turns
+    result = {
+        "turns": args.turns,
+        "prompt_tokens": len(new_tokens),
+        "old_first_turns_ms": sum(old_times[:n]) / n * 1e3,
+        "old_last_turns_ms": sum(old_times[-n:]) / n * 1e3,
+        "new_first_turns_ms": sum(new_times[:n]) / n * 1e3,
+        "new_last_turns_ms": sum(new_times[-n:]) / n * 1e3,
+        "same_prompts": True,
+    }
+    print(json.dumps(result))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Benchmarks loading a language model from pytorch_model.bin against loading it from the weight cache.
+
+Each way of loading is timed in a fresh process, so that the peak memory usage (RSS) can be measured too. The time until
+the first logits is also reported, as the weight cache only reads the weights from the disk when they're needed. The
+weight cache is created first if it doesn't exist yet. Only works on Unix-like systems.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.model_loading --model language_models/<model folder>
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+from src.language_processing.gpt2generator import GPT2LMHeadModel
+from src.language_processing.weight_cache import WeightCache, load_pretrained
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16}
+
+
+def get_peak_rss_mb():
+    try:
+        # Unlike ru_maxrss, this doesn't carry over the peak of the parent process
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def load(method, model_path, dtype):
+    """Loads the model in the given way, and runs it once. Meant to be run in a process of its own.
+
+    Returns:
+        dict: The results
+    """
+    start = perf_counter()
+    if method == "pytorch_model.bin":
+        model = GPT2LMHeadModel.from_pretrained(str(model_path))
+        model.to(dtype)
+    else:
+        model = WeightCache(model_path, GPT2LMHeadModel, dtype).load_model()
+    model.eval()
+    load_time = perf_counter() - start
+
+    with torch.no_grad():
+        logits = model(torch.arange(16))[0].float()
+    first_logits_time = perf_counter() - start
+
+    return {
+        "method": method,
+        "load_s": load_time,
+        "first_logits_s": first_logits_time,
+        "peak_rss_mb": get_peak_rss_mb(),
+        "logits_checksum": logits.sum().item(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--dtype", choices=DTYPES, default="float32")
+    parser.add_argument("--method", choices=["pytorch_model.bin", "weight_cache"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    dtype = DTYPES[args.dtype]
+
+    if args.method:
+        print(json.dumps(load(args.method, args.model, dtype)))
+        return
+
+    if not WeightCache(args.model, GPT2LMHeadModel, dtype).is_valid():
+        start = perf_counter()
+        load_pretrained(GPT2LMHeadModel, args.model, dtype)
+        print(json.dumps({"conversion_s": perf_counter() - start}))
+
+    results = []
+    for method in ("pytorch_model.bin", "weight_cache"):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.model_loading", "--model", str(args.model),
+                                 "--dtype", args.dtype, "--method", method],
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
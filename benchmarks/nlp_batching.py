@@ -0,0 +1,112 @@
+"""Benchmarks batched generation against generating for one NPC at a time.
+
+For each batch size, that many prompts of different lengths are continued for a fixed number of tokens, first one by one
+with sample_sequence() and then all at once with sample_sequence_batch(). Stopping is disabled, so that every sequence
+generates the same number of tokens. The aggregate tokens per second of both are reported.
+
+Before that, the prompts of the largest batch are checked to give the same logits with masked_forward() as a left padded
+batch as they give with the model's own forward() one at a time, both for the prompts and for the greedily picked tokens
+after them. If they don't, an AssertionError is raised.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.nlp_batching --model language_models/<model folder>
+"""
+
+import argparse
+import json
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+from src.language_processing.gpt2generator import GPT2Generator, masked_forward, pad_batch, sample_sequence, \
+    sample_sequence_batch
+
+NO_STOPPING = dict(disallowed_starts=(), stop_chars_included=(), stop_chars_not_included=(), stop_tokens=None)
+
+
+def make_prompts(generator, count):
+    context = "You are speaking to a person called Tabula Rasa."
+    memory = ["You say: \"Have you seen the sword I lost?\"", "Tabula Rasa answers: \"No, but I saw a long and pointy stick.\""]
+    return [generator.memory_merge(context, memory * (i + 1), f"You say: \"What is your favourite colour, {i}?\"",
+                                   "Tabula Rasa answers: \"") for i in range(count)]
+
+
+def check_batch_parity(model, contexts, steps, tolerance, device="cpu"):
+    """Asserts that masked_forward() continues a left padded batch like the model continues each context alone.
+
+    Returns:
+        float: The largest difference between the logits
+    """
+    input_ids, attention_mask, position_ids = pad_batch(contexts, device)
+    single_inputs = [torch.tensor([context], dtype=torch.long, device=device) for context in contexts]
+    pasts = None
+    single_pasts = [None] * len(contexts)
+    max_diff = 0
+    with torch.no_grad():
+        for step in range(steps + 1):
+            logits, pasts = masked_forward(model, input_ids, pasts, attention_mask, position_ids)
+            next_tokens = []
+            for i, single_input in enumerate(single_inputs):
+                single_logits, single_pasts[i] = model(single_input, past=single_pasts[i])[:2]
+                single_logits = single_logits[0, -1]
+                max_diff = max(max_diff, (logits[i, -1] - single_logits).abs().max().item())
+                assert logits[i, -1].argmax() == single_logits.argmax(), \
+                    f"The batch picks another token for context {i} at step {step}"
+                next_tokens.append(single_logits.argmax().item())
+            input_ids = torch.tensor(next_tokens, dtype=torch.long, device=device).unsqueeze(-1)
+            single_inputs = list(input_ids.unsqueeze(1))
+            attention_mask = torch.cat((attention_mask, attention_mask.new_ones((len(contexts), 1))), dim=-1)
+            position_ids = position_ids[:, -1:] + 1
+    assert max_diff <= tolerance, f"The logits of the batch differ by up to {max_diff}"
+    return max_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--tokens", type=int, default=40, help="Tokens to generate for each prompt")
+    parser.add_argument("--temperature", type=float, default=0.3)
+    parser.add_argument("--parity-steps", type=int, default=10, help="Tokens to check the logits of after the prompts")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="The largest allowed difference between logits")
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    generator = GPT2Generator(model_path=args.model, generate_num=args.tokens, temperature=args.temperature)
+    settings = dict(model=generator.model, length=args.tokens, temperature=args.temperature, top_k=generator.top_k,
+                    top_p=generator.top_p, repetition_penalty=generator.repetition_penalty, device=generator.device,
+                    tokenizer=generator.tokenizer, **NO_STOPPING)
+
+    max_logit_diff = check_batch_parity(generator.model, make_prompts(generator, max(args.batch_sizes)),
+                                        args.parity_steps, args.tolerance, generator.device)
+    print(json.dumps({"max_abs_logit_diff": max_logit_diff}))
+
+    results = []
+    for batch_size in args.batch_sizes:
+        torch.manual_seed(args.seed)
+        prompts = make_prompts(generator, batch_size)
+        generated_tokens = batch_size * args.tokens
+
+        start = perf_counter()
+        for prompt in prompts:
+            sample_sequence(context=prompt, **settings)
+        sequential_time = perf_counter() - start
+
+        start = perf_counter()
+        sample_sequence_batch(contexts=prompts, **settings)
+        batched_time = perf_counter() - start
+
+        result = {
+            "batch_size": batch_size,
+            "sequential_tokens_per_s": generated_tokens / sequential_time,
+            "batched_tokens_per_s": generated_tokens / batched_time,
+            "speedup": sequential_time / batched_time,
+        }
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
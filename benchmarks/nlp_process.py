@@ -0,0 +1,100 @@
+"""Benchmarks how generating text affects the frame times of the main thread, with the language model in a thread of the
+game's process and in a process of its own.
+
+The main thread simulates frames that take a fixed amount of Python work, while text is generated in a thread like
+NLPManager does, first with GPT2Generator and then with GeneratorProcess. The frame times while generating are compared
+against the frame times without any generation.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.nlp_process --model language_models/<model folder>
+"""
+
+import argparse
+import json
+import threading
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+from src.language_processing.gpt2generator import GPT2Generator
+from src.language_processing.nlp_process import GeneratorProcess
+
+
+class FrameWork:
+    """Pure Python work, like the game's own per-frame code."""
+
+
+    def __init__(self, work_ms):
+        # Calibrated once, so that every frame does the same amount of work
+        start = perf_counter()
+        self.iterations = 100000
+        self.run()
+        self.iterations = int(self.iterations * work_ms / ((perf_counter() - start) * 1e3))
+
+
+    def run(self):
+        total = 0
+        for i in range(self.iterations):
+            total += i * i
+        return total
+
+
+def measure_frames(work, frames):
+    """Runs frames, and gives back their times in milliseconds."""
+    times = []
+    for _ in range(frames):
+        start = perf_counter()
+        work.run()
+        times.append((perf_counter() - start) * 1e3)
+    return times
+
+
+def summarize(name, times):
+    times = sorted(times)
+    return {
+        "mode": name,
+        "median_frame_ms": median(times),
+        "p95_frame_ms": times[int(len(times) * 0.95)],
+        "max_frame_ms": times[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--work-ms", type=float, default=5.0, help="Python work per frame")
+    parser.add_argument("--tokens", type=int, default=60)
+    args = parser.parse_args()
+
+    work = FrameWork(args.work_ms)
+    results = [summarize("no generation", measure_frames(work, args.frames))]
+    print(json.dumps(results[-1]))
+
+    kwargs = dict(model_path=args.model, generate_num=args.tokens)
+    for name, generator_class in (("thread", GPT2Generator), ("process", GeneratorProcess)):
+        generator = generator_class(**kwargs)
+        tokens = generator.memory_merge("You are speaking to a person called Tabula Rasa.",
+                                        ["You say: \"Have you seen the sword I lost?\""] * 20,
+                                        "Tabula Rasa answers: \"")
+        done = threading.Event()
+
+        def generate():
+            while not done.is_set():
+                generator.generate(tokens, temperature=generator.temp, repetition_penalty=generator.repetition_penalty)
+
+        generating_thread = threading.Thread(target=generate)
+        generating_thread.start()
+        times = measure_frames(work, args.frames)
+        done.set()
+        generating_thread.join()
+        if isinstance(generator, GeneratorProcess):
+            generator.close()
+
+        results.append(summarize(name, times))
+        print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmarks the inference server with several clients at once.
+
+The server is started in this process, once with batching and once without. Each time, that many clients ask for a reply
+at the same time, and the time until all of them have their reply is reported. The time that connecting a client takes
+is compared against loading the model, which is what a game saves when the server is already running.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.nlp_server --model language_models/<model folder>
+"""
+
+import argparse
+import json
+import threading
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+from src.language_processing.gpt2generator import GPT2Generator
+from src.language_processing.nlp_server import GeneratorClient, InferenceServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=40, help="Tokens to generate for each reply")
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    start = perf_counter()
+    generator = GPT2Generator(model_path=args.model, generate_num=args.tokens)
+    load_time = perf_counter() - start
+
+    results = []
+    for batch_size in (1, args.clients):
+        server = InferenceServer(("127.0.0.1", 0), generator, batch_size)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"127.0.0.1:{server.server_address[1]}"
+
+        start = perf_counter()
+        clients = [GeneratorClient(url) for _ in range(args.clients)]
+        connect_time = (perf_counter() - start) / args.clients
+
+        prompts = [client.memory_merge("You are speaking to a person called Tabula Rasa.",
+                                       [f"You say: \"What is your favourite colour, {i}?\""], "Tabula Rasa answers: \"")
+                   for i, client in enumerate(clients)]
+        torch.manual_seed(args.seed)
+        threads = [threading.Thread(target=client.generate, args=(prompt,),
+                                    kwargs=dict(temperature=generator.temp, repetition_penalty=generator.repetition_penalty))
+                   for client, prompt in zip(clients, prompts)]
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        all_replies_time = perf_counter() - start
+        server.shutdown()
+        server.server_close()
+
+        result = {
+            "clients": args.clients,
+            "batch_size": batch_size,
+            "all_replies_s": all_replies_time,
+            "client_connect_ms": connect_time * 1e3,
+            "model_load_ms": load_time * 1e3,
+        }
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Compares the int8 quantized language model against the 32-bit one on the CPU.
+
+Each precision is loaded in a fresh process, so that its peak memory usage (RSS) can be measured. The quality is compared
+with the perplexity on a fixed set of prompts like the ones that the game writes, which should only be slightly higher
+when quantized. If it's more than --max-perplexity-increase higher, an AssertionError is raised. The latency is the time per generated token, when continuing the first prompt greedily. The quantized
+model is created first if it isn't cached yet. Only works on Unix-like systems.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.quantization --model language_models/<model folder>
+"""
+
+import argparse
+import json
+import math
+import subprocess
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks.model_loading import get_peak_rss_mb
+from src.language_processing.gpt2generator import MODEL_CLASSES
+from src.language_processing.quantization import QuantizedCache, load_quantized
+from src.language_processing.weight_cache import load_pretrained
+
+PROMPTS = [
+    "You are speaking to a person called Tabula Rasa.\n"
+    "You say: \"Have you seen the sword I lost?\"\n"
+    "Tabula Rasa answers: \"No, but I saw a long and pointy stick near the old well. Maybe that's what you mean?\"",
+    "The village was quiet in the evening. The blacksmith had put out the fire in his forge, and the baker was sweeping "
+    "the flour off the steps of her shop. Only the children were still running between the houses, chasing a cat.",
+    "You say: \"Where can I buy some bread?\"\n"
+    "The guard answers: \"The bakery is on the other side of the market square. Be quick, they close at sunset.\"",
+    "Long ago, before the river changed its course, there was a castle on the hill. Its walls were made of grey stone, "
+    "and its towers could be seen from miles away. Nobody knows who built it, or why it was abandoned.",
+]
+
+
+def perplexity(model, tokenizer):
+    """The perplexity of the model on PROMPTS, over all of their tokens together."""
+    total_loss = 0.0
+    total_tokens = 0
+    with torch.no_grad():
+        for prompt in PROMPTS:
+            tokens = torch.tensor(tokenizer.encode(prompt))
+            logits = model(input_ids=tokens)[0].float()
+            total_loss += F.cross_entropy(logits[:-1], tokens[1:], reduction="sum").item()
+            total_tokens += len(tokens) - 1
+    return math.exp(total_loss / total_tokens)
+
+
+def seconds_per_token(model, tokenizer, length):
+    """The time per token when continuing the first prompt greedily, not counting the prompt itself."""
+    next_tokens = torch.tensor(tokenizer.encode(PROMPTS[0]))
+    pasts = None
+    with torch.no_grad():
+        logits, pasts = model(input_ids=next_tokens, past=pasts)[:2]
+        start = perf_counter()
+        for _ in range(length):
+            next_tokens = logits[-1:].argmax(-1)
+            logits, pasts = model(input_ids=next_tokens, past=pasts)[:2]
+    return (perf_counter() - start) / length
+
+
+def load(precision, model_type, model_path, tokens):
+    """Loads the model in the given precision, and measures it. Meant to be run in a process of its own.
+
+    Returns:
+        dict: The results
+    """
+    model_class, tokenizer_class = MODEL_CLASSES[model_type]
+    tokenizer = tokenizer_class.from_pretrained(str(model_path))
+    start = perf_counter()
+    if precision == "int8":
+        model = load_quantized(model_class, model_path)
+    else:
+        model = load_pretrained(model_class, model_path, torch.float32)
+    model.eval()
+    load_time = perf_counter() - start
+
+    return {
+        "precision": precision,
+        "load_s": load_time,
+        "perplexity": perplexity(model, tokenizer),
+        "ms_per_token": seconds_per_token(model, tokenizer, tokens) * 1e3,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--model-type", choices=MODEL_CLASSES, default="gpt2")
+    parser.add_argument("--tokens", type=int, default=40, help="Tokens to generate for the latency")
+    parser.add_argument("--max-perplexity-increase", type=float, default=0.05,
+                        help="How much higher the perplexity of the int8 model may be, as a fraction of the 32-bit one's")
+    parser.add_argument("--precision", choices=["float32", "int8"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.precision:
+        print(json.dumps(load(args.precision, args.model_type, args.model, args.tokens)))
+        return
+
+    model_class = MODEL_CLASSES[args.model_type][0]
+    if not QuantizedCache(args.model, model_class).is_valid():
+        start = perf_counter()
+        load_quantized(model_class, args.model)
+        print(json.dumps({"quantization_s": perf_counter() - start}))
+
+    results = []
+    for precision in ("float32", "int8"):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.quantization", "--model", str(args.model),
+                                 "--model-type", args.model_type, "--tokens", str(args.tokens), "--precision", precision],
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(json.dumps(result))
+        results.append(result)
+
+    float_result, int8_result = results
+    perplexity_increase = int8_result["perplexity"] / float_result["perplexity"] - 1
+    print(json.dumps({"perplexity_increase": perplexity_increase}))
+    assert perplexity_increase <= args.max_perplexity_increase, \
+        f"The perplexity of the int8 model is {perplexity_increase:.1%} higher than that of the 32-bit one"
+    return results
+
+
+if __name__ == "__main__":
+    main()
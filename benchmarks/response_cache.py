@@ -0,0 +1,75 @@
+"""Benchmarks answering from the response cache, against generating the answer with the language model.
+
+An answer is generated greedily (temperature 0), cached together with the lengths of the lines that it's remembered as,
+and then looked up with a key made like NLPManager.response_key() makes it. The time of both is reported. The cache is
+then filled, written to a file, and loaded from it again, to time that and to check that the answers survive it.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.response_cache --model language_models/<model folder>
+"""
+
+import argparse
+import json
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from src.language_processing.gpt2generator import GPT2Generator
+from src.language_processing.response_cache import ResponseCache
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--entries", type=int, default=10000, help="How many answers to fill the cache with")
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    generator = GPT2Generator(model_path=args.model)
+    context = "You are speaking to a person called Tabula Rasa."
+    prompt = "Tabula Rasa answers: \""
+    memory = ["You say: \"Have you seen the sword I lost?\"", prompt + "No, but I saw a long and pointy stick.\""] * 10
+    text = "You say: \"Hello, who are you?\""
+    sampling = [0.0, generator.repetition_penalty, generator.top_k, generator.top_p, generator.generate_num]
+
+    def key():
+        return ResponseCache.make_key(generator.model_id, context, memory, text, prompt, sampling)
+
+    start = perf_counter()
+    result = generator.generate(generator.memory_merge(context, memory, text, prompt), temperature=0.0,
+                                repetition_penalty=generator.repetition_penalty)
+    generate_time = perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory, "response_cache.jsonl")
+        cache = ResponseCache(args.entries, path)
+        result = result or "(empty)"
+        line_lengths = [generator.line_length(text), generator.line_length(prompt + result + '"')]
+        cache.store(key(), result, line_lengths)
+        start = perf_counter()
+        for _ in range(args.lookups):
+            cached = cache.lookup(key())
+        lookup_time = (perf_counter() - start) / args.lookups
+
+        for i in range(args.entries - 1):
+            cache.store(ResponseCache.make_key(generator.model_id, context, memory, f"{text} {i}", prompt, sampling),
+                        f"Answer {i}", line_lengths)
+        start = perf_counter()
+        reloaded = ResponseCache(args.entries, path)
+        reload_time = perf_counter() - start
+
+        output = {
+            "generate_ms": generate_time * 1e3,
+            "key_and_lookup_us": lookup_time * 1e6,
+            "speedup": generate_time / lookup_time,
+            "reload_entries": len(reloaded),
+            "reload_ms": reload_time * 1e3,
+            "file_kb": path.stat().st_size / 2 ** 10,
+            "same_after_reload": reloaded.lookup(key()) == cached,
+        }
+    print(json.dumps(output))
+    return output
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Benchmarks the per-token cost of picking the next token, without running a language model.
+
+Compares TokenSampler against the old way of top_k_top_p_filtering() followed by a Python loop for the repetition penalty.
+The logits are random, with a few likely tokens and a long tail like language models have. The fraction of steps where
+TokenSampler had to look past its first candidates, because they didn't cover top_p, is reported as well.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.sampling
+"""
+
+import argparse
+import json
+from time import perf_counter
+
+import torch
+import torch.nn.functional as F
+
+from src.language_processing.gpt2generator import TokenSampler
+
+
+def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
+    """ The filtering that was used before TokenSampler.
+        Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
+        Args:
+            logits: logits distribution shape (batch size x vocabulary size)
+            top_k > 0: keep only top k tokens with highest probability (top-k filtering).
+            top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
+                Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
+        From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
+    """
+    top_k = min(top_k, logits.size(-1))  # Safety check
+    if top_k > 0:
+        # Remove all tokens with a probability less than the last token of the top-k
+        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
+        logits[indices_to_remove] = filter_value
+
+    if top_p > 0.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+
+        # Remove tokens with cumulative probability above the threshold
+        sorted_indices_to_remove = cumulative_probs > top_p
+        # Shift the indices to the right to keep also the first token above the threshold
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+
+        # scatter sorted tensors to original indexing
+        indices_to_remove = sorted_indices_to_remove.scatter(
+            dim=-1, index=sorted_indices, src=sorted_indices_to_remove
+        )
+        logits[indices_to_remove] = filter_value
+    return logits
+
+
+def sample_old(logits, context, temperature, top_k, top_p, repetition_penalty):
+    """The sampling as it was done before TokenSampler."""
+    logits = top_k_top_p_filtering(logits[0], top_k=top_k, top_p=top_p)
+    logits = logits / temperature
+    for k in set(context):
+        logits[k] /= repetition_penalty
+    next_token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+    context.append(next_token.item())
+    return next_token
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--context-lengths", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--vocab-size", type=int, default=50257)
+    parser.add_argument("--temperature", type=float, default=0.3)
+    parser.add_argument("--top-k", type=int, default=0)
+    parser.add_argument("--top-p", type=float, default=0.8)
+    parser.add_argument("--rep-pen", type=float, default=1.2)
+    parser.add_argument("--sharpness", type=float, default=12.0, help="How much more likely the first tokens are")
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(1)
+    # A couple of dozen likely tokens, and then the rest
+    logits = torch.randn(args.steps, 1, args.vocab_size)
+    logits[:, :, :24] += args.sharpness * torch.rand(args.steps, 1, 24)
+    logits = logits[:, :, torch.randperm(args.vocab_size)]
+
+    results = []
+    for context_length in args.context_lengths:
+        context = torch.randint(0, args.vocab_size, (context_length,)).tolist()
+
+        old_context = list(context)
+        start = perf_counter()
+        for step_logits in logits:
+            sample_old(step_logits.clone(), old_context, args.temperature, args.top_k, args.top_p, args.rep_pen)
+        old_time = perf_counter() - start
+
+        sampler = TokenSampler([context], args.vocab_size, args.temperature, args.top_k, args.top_p, args.rep_pen)
+        start = perf_counter()
+        for step_logits in logits:
+            sampler.sample(step_logits)
+        new_time = perf_counter() - start
+
+        log_totals = torch.logsumexp(logits, dim=-1)
+        covered = torch.exp(torch.topk(logits, sampler.num_candidates, dim=-1)[0] - log_totals[..., None]).sum(-1) > args.top_p
+
+        result = {
+            "context_length": context_length,
+            "old_us_per_token": old_time / args.steps * 1e6,
+            "token_sampler_us_per_token": new_time / args.steps * 1e6,
+            "speedup": old_time / new_time,
+            "more_candidates_fraction": 0.0 if args.top_k > 0 else 1 - covered.float().mean().item(),
+        }
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Soak test of an NPC's short-term memory over a long session, against the plain list that it used to be.
+
+The exchanges of one conversation are added to both, like NLPManager does, and a prompt is made from each of them at
+regular intervals. The size of the remembered lines, the memory allocated since the start (measured with tracemalloc, so
+it includes the tokenizer's caches) and the time to make a prompt are reported at those intervals. The time to add a line doesn't include tokenizing
+it, which NLPManager does on its worker thread.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.short_term_memory --model language_models/<model folder>
+"""
+
+import argparse
+import json
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+from src.language_processing.gpt2generator import GPT2Generator
+from src.language_processing.short_term_memory import ShortTermMemory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--exchanges", type=int, default=10000)
+    parser.add_argument("--report-every", type=int, default=2500)
+    args = parser.parse_args()
+
+    generator = GPT2Generator(model_path=args.model)
+    context = "You are speaking to a person called Tabula Rasa."
+    prompt = "Tabula Rasa answers: \""
+    said = "You say: \"What happened here?\""
+
+    results = []
+    for name in ("list", "ShortTermMemory"):
+        tracemalloc.start()
+        memory = [] if name == "list" else ShortTermMemory()
+        append_time = 0.0
+        for exchange in range(1, args.exchanges + 1):
+            # Every line is different, like in a real conversation
+            lines = (f"You say: \"Where were you on day {exchange}?\"", f"{prompt}I was fishing {exchange} steps away.\"")
+            if name != "list":
+                for line in lines:
+                    generator.line_length(line)
+            start = perf_counter()
+            for line in lines:
+                if name == "list":
+                    memory.append(line)
+                else:
+                    memory.append(line, generator.line_length(line))
+            append_time += perf_counter() - start
+
+            if exchange % args.report_every == 0:
+                current_bytes = tracemalloc.get_traced_memory()[0]
+                start = perf_counter()
+                lines = memory if name == "list" else memory.lines()
+                generator.memory_merge(context, lines, said, prompt)
+                prompt_time = perf_counter() - start
+                result = {
+                    "memory": name,
+                    "exchanges": exchange,
+                    "lines": len(memory),
+                    "lines_kb": (sys.getsizeof(memory) + sum(sys.getsizeof(line) for line in lines)) / 2 ** 10,
+                    "traced_mb": current_bytes / 2 ** 20,
+                    "prompt_ms": prompt_time * 1e3,
+                    "append_us_per_line": append_time / (2 * exchange) * 1e6,
+                }
+                print(json.dumps(result))
+                results.append(result)
+        tracemalloc.stop()
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Benchmarks speculative decoding with a draft model against generating with the model alone.
+
+The same prompt is continued for a fixed number of tokens, with sample_sequence() and with
+sample_sequence_speculative(), greedily and at the configured temperature. The tokens per second of both are reported,
+together with how many tokens each forward pass of the model produced on average, which is one more than the accepted
+draft tokens. Greedily, both have to give the same text.
+
+Then a speaker's next turn is continued greedily, whose prompt starts with the previous turn's, once from scratch and
+once with the past key/values of both models cached from the previous turn, like GPT2Generator.generate() caches them.
+How many tokens each model is run on is reported for both.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.speculative_decoding --model language_models/<model folder> --draft-model language_models/<draft model folder>
+"""
+
+import argparse
+import json
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+from src.language_processing.gpt2generator import GPT2Generator, PastCache, sample_sequence, sample_sequence_speculative
+
+
+class CountingModel:
+    """Counts the forward passes of a model, and the tokens that it's run on."""
+
+
+    def __init__(self, model):
+        self.model = model
+        self.config = model.config
+        self.calls = 0
+        self.tokens = 0
+
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        self.tokens += kwargs["input_ids"].shape[-1]
+        return self.model(*args, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--draft-model", type=Path, required=True, help="Directory of the draft model")
+    parser.add_argument("--tokens", type=int, default=60, help="Tokens to generate")
+    parser.add_argument("--draft-tokens", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    generator = GPT2Generator(model_path=args.model, draft_model_path=args.draft_model, draft_tokens=args.draft_tokens)
+    context = "You are speaking to a person called Tabula Rasa."
+    prompt = "Tabula Rasa answers: \""
+    memory = ["You say: \"Have you seen the sword I lost?\""]
+    tokens = generator.memory_merge(context, memory, prompt)
+    # Nothing stops the generation early, so that both generate the same number of tokens
+    kwargs = dict(context=tokens, length=args.tokens, top_k=generator.top_k, top_p=generator.top_p,
+                  repetition_penalty=generator.repetition_penalty, device=generator.device, disallowed_starts=(),
+                  stop_chars_not_included=(), stop_tokens=[], tokenizer=generator.tokenizer)
+
+    results = []
+    for temperature in (0.0, generator.temp):
+        model = CountingModel(generator.model)
+        torch.manual_seed(args.seed)
+        start = perf_counter()
+        plain = sample_sequence(model=model, temperature=temperature, **kwargs)
+        plain_time = perf_counter() - start
+
+        model = CountingModel(generator.model)
+        torch.manual_seed(args.seed)
+        start = perf_counter()
+        speculative = sample_sequence_speculative(model=model, draft_model=generator.draft_model,
+                                                  draft_tokens=args.draft_tokens, temperature=temperature, **kwargs)
+        speculative_time = perf_counter() - start
+
+        result = {
+            "temperature": temperature,
+            "draft_tokens": args.draft_tokens,
+            "plain_tokens_per_s": args.tokens / plain_time,
+            "speculative_tokens_per_s": args.tokens / speculative_time,
+            "speedup": plain_time / speculative_time,
+            "tokens_per_model_pass": args.tokens / model.calls,
+        }
+        if temperature == 0:
+            result["same_greedy_text"] = plain == speculative
+        print(json.dumps(result))
+        results.append(result)
+
+    kwargs["temperature"] = 0.0
+    past_cache = PastCache(2 ** 40)
+    answer = sample_sequence_speculative(model=generator.model, draft_model=generator.draft_model,
+                                         draft_tokens=args.draft_tokens, past_cache=past_cache, cache_key="speaker",
+                                         **kwargs)
+    kwargs["context"] = generator.memory_merge(context, memory + [prompt + answer + "\"", "You say: \"Where?\""], prompt)
+    texts = []
+    result = {"prompt_tokens": len(kwargs["context"])}
+    for warm in (False, True):
+        model = CountingModel(generator.model)
+        draft_model = CountingModel(generator.draft_model)
+        start = perf_counter()
+        texts.append(sample_sequence_speculative(model=model, draft_model=draft_model, draft_tokens=args.draft_tokens,
+                                                 past_cache=past_cache if warm else None, cache_key="speaker", **kwargs))
+        name = "warm" if warm else "cold"
+        result[f"{name}_tokens_per_s"] = args.tokens / (perf_counter() - start)
+        result[f"{name}_model_input_tokens"] = model.tokens
+        result[f"{name}_draft_model_input_tokens"] = draft_model.tokens
+    result["same_greedy_text"] = texts[0] == texts[1]
+    print(json.dumps(result))
+    results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
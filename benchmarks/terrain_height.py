@@ -0,0 +1,114 @@
+"""Benchmarks TerrainHeightSampler against raycasting the terrain with Bullet.
+
+A random heightfield is turned into a BulletHeightfieldShape, and the same random points are queried with
+get_ground_z_pos(), TerrainHeightSampler.get_z() and TerrainHeightSampler.sample(). The largest difference to the raycast
+results is reported too.
+
+It also checks the ground planes that GroundQueryBatch gives to animals: the points are resolved in a batch, and then the
+elevations at random offsets from them are asked from Animal.get_ground_z_pos(), like the planned foot targets of a
+Humanoid are. These must match TerrainHeightSampler.get_z(), whether they were answered from a plane or not.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.terrain_height
+"""
+
+import argparse
+import json
+from time import perf_counter
+
+import numpy as np
+from panda3d.bullet import BulletWorld, BulletHeightfieldShape, BulletRigidBodyNode, ZUp
+from panda3d.core import BitMask32, NodePath
+
+from src.animal import Animal
+from src.terrain import TerrainHeightSampler, GroundQueryBatch
+from src.utils import array_to_pnm_image, get_ground_z_pos
+
+
+class GroundQueryPoints:
+    """Stands in for the animals of a GroundQueryBatch, and answers elevation queries like Animal does."""
+    get_ground_z_pos = Animal.get_ground_z_pos
+    set_ground_query_results = Animal.set_ground_query_results
+
+
+    def __init__(self, height_sampler, points):
+        self.height_sampler = height_sampler
+        self.points = points
+
+
+    def get_ground_query_points(self):
+        return self.points
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1025, help="Width and height of the heightfield")
+    parser.add_argument("--queries", type=int, default=10000)
+    parser.add_argument("--height", type=float, default=25.0, help="The terrain's max_height")
+    parser.add_argument("--max-offset", type=float, default=0.3,
+                        help="How far from the resolved points the ground planes are queried")
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    walk_map = array_to_pnm_image(rng.integers(0, 65536, size=(args.size, args.size, 1), dtype=np.uint16))
+
+    world = BulletWorld()
+    terrain_bullet_node = BulletRigidBodyNode("terrainBodyNode")
+    terrain_colshape = BulletHeightfieldShape(walk_map, args.height, ZUp)
+    terrain_colshape.set_use_diamond_subdivision(True)
+    terrain_bullet_node.add_shape(terrain_colshape)
+    NodePath(terrain_bullet_node).set_collide_mask(BitMask32.bit(0))
+    world.attach(terrain_bullet_node)
+
+    start = perf_counter()
+    height_sampler = TerrainHeightSampler(walk_map, args.height, diamond_subdivision=True)
+    build_time = perf_counter() - start
+
+    half_size = (args.size - 1) / 2
+    xs = rng.uniform(-half_size, half_size, args.queries)
+    ys = rng.uniform(-half_size, half_size, args.queries)
+
+    start = perf_counter()
+    raycast = [get_ground_z_pos(x, y, world, terrain_bullet_node) for x, y in zip(xs, ys)]
+    raycast_time = perf_counter() - start
+
+    start = perf_counter()
+    single = [height_sampler.get_z(x, y) for x, y in zip(xs, ys)]
+    single_time = perf_counter() - start
+
+    start = perf_counter()
+    batched = height_sampler.sample(xs, ys)
+    batched_time = perf_counter() - start
+
+    ground_query_points = GroundQueryPoints(height_sampler, list(zip(xs.tolist(), ys.tolist())))
+    ground_queries = GroundQueryBatch(height_sampler)
+    ground_queries.add(ground_query_points)
+    ground_queries.resolve()
+    plane_error = plane_hits = 0
+    for plane in ground_query_points.ground_planes:
+        offset_x, offset_y = rng.uniform(-args.max_offset, args.max_offset, 2)
+        x, y = plane[0] + offset_x, plane[1] + offset_y
+        ground_query_points.ground_planes = [plane]
+        plane_error = max(plane_error, abs(ground_query_points.get_ground_z_pos(x, y) - height_sampler.get_z(x, y)))
+        plane_hits += offset_x * offset_x + offset_y * offset_y <= plane[5] * plane[5]
+    assert plane_error < 1e-9, f"Ground planes differ from get_z() by up to {plane_error}"
+
+    result = {
+        "size": args.size,
+        "queries": args.queries,
+        "sampler_build_s": build_time,
+        "raycast_us_per_query": raycast_time / args.queries * 1e6,
+        "get_z_us_per_query": single_time / args.queries * 1e6,
+        "sample_us_per_query": batched_time / args.queries * 1e6,
+        "get_z_max_error": float(np.max(np.abs(np.array(single) - raycast))),
+        "sample_max_error": float(np.max(np.abs(batched - raycast))),
+        "ground_plane_max_error": plane_error,
+        "ground_plane_hits": plane_hits / args.queries,
+    }
+    print(json.dumps(result, indent=4))
+    return result
+
+
+if __name__ == "__main__":
+    main()
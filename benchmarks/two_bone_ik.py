@@ -0,0 +1,82 @@
+"""Benchmarks the closed-form two bone IK of IKChain against its CCD, on legs like those of Humanoid.
+
+Pairs of identical legs and their foot targets are moved to random places every frame. One leg of each pair is solved
+with IKChain.inverseKinematicsCCD(), the other with IKChain.inverseKinematicsTwoBone(). Reported are the time per leg,
+how far the feet are from their targets on average, how many of them reached their targets, and how many CCD solves used
+up all their iterations without reaching the target.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.two_bone_ik --legs 200 --frames 30
+"""
+
+import argparse
+import json
+import random
+from time import perf_counter
+
+from panda3d.core import Vec3
+
+from benchmarks.batch_ik import create_leg, foot_error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--legs", type=int, default=200)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--max-iterations", type=int, default=10, help="The maxIterations of the CCD")
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bodies = [render.attach_new_node("Body") for _ in range(args.legs)]
+    ccd_legs = [create_leg(body) for body in bodies]
+    two_bone_legs = [create_leg(body) for body in bodies]
+    assert all(leg.isTwoBoneChain() for leg in two_bone_legs)
+
+    ccd_time = two_bone_time = 0
+    ccd_error = two_bone_error = 0
+    ccd_reached = two_bone_reached = 0
+    for frame in range(args.frames):
+        for body, ccd_leg, two_bone_leg in zip(bodies, ccd_legs, two_bone_legs):
+            body.set_pos_hpr(rng.uniform(-5, 5), rng.uniform(-5, 5), 1, rng.uniform(-180, 180), 0, 0)
+            target = Vec3(body.get_x() + rng.uniform(-0.3, 0.3), body.get_y() + rng.uniform(-0.3, 0.3),
+                          rng.uniform(0.2, 0.6))
+            ccd_leg.target.set_pos(target)
+            two_bone_leg.target.set_pos(target)
+
+        start = perf_counter()
+        for leg in ccd_legs:
+            leg.inverseKinematicsCCD(maxIterations=args.max_iterations)
+        ccd_time += perf_counter() - start
+
+        start = perf_counter()
+        for leg in two_bone_legs:
+            leg.inverseKinematicsTwoBone()
+        two_bone_time += perf_counter() - start
+
+        for ccd_leg, two_bone_leg in zip(ccd_legs, two_bone_legs):
+            ccd_error += foot_error(ccd_leg)
+            two_bone_error += foot_error(two_bone_leg)
+            ccd_reached += ccd_leg.targetReached
+            two_bone_reached += two_bone_leg.targetReached
+
+    solves = args.legs * args.frames
+    result = {
+        "legs": args.legs,
+        "frames": args.frames,
+        "ccd_us_per_leg": ccd_time / solves * 1e6,
+        "two_bone_us_per_leg": two_bone_time / solves * 1e6,
+        "speedup": ccd_time / two_bone_time,
+        "ccd_mean_foot_error": ccd_error / solves,
+        "two_bone_mean_foot_error": two_bone_error / solves,
+        "ccd_reached": ccd_reached / solves,
+        "two_bone_reached": two_bone_reached / solves,
+        # The CCD only stops early when the target is reached
+        "ccd_used_max_iterations": 1 - ccd_reached / solves,
+    }
+    print(json.dumps(result))
+    return result
+
+
+if __name__ == "__main__":
+    main()
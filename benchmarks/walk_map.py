@@ -0,0 +1,83 @@
+"""Benchmarks the walk map creation against the old per-pixel implementation.
+
+Random heightfields and ocean maps are generated for each size, and both implementations mask them. The results are also
+compared to make sure that they are identical.
+
+Run from the root directory of SpecuSim:
+    python3 -m benchmarks.walk_map
+"""
+
+import argparse
+import json
+from time import perf_counter
+
+import numpy as np
+from panda3d.core import PNMImage
+
+from src.utils import pnm_image_to_array, array_to_pnm_image, unfiltered_stretch_array, mask_walk_map
+
+
+def mask_per_pixel(resized_heightfield, ocean_map):
+    """The walk map masking as it was done before NumPy."""
+    if ocean_map.get_x_size() % 2 == 0:
+        ocean_resized = PNMImage(ocean_map.get_x_size() + 1, ocean_map.get_y_size() + 1, ocean_map.get_num_channels(),
+                                 ocean_map.get_maxval(), ocean_map.get_type(), ocean_map.get_color_space())
+        ocean_resized.unfiltered_stretch_from(ocean_map)
+    else:
+        ocean_resized = ocean_map
+
+    for x in range(ocean_resized.get_x_size()):
+        for y in range(ocean_resized.get_y_size()):
+            if ocean_resized.get_green(x, y) == 0:
+                resized_heightfield.set_gray(x, y, 1)
+    return resized_heightfield
+
+
+def mask_vectorized(resized_heightfield, ocean_map):
+    """The walk map masking as done by create_or_load_walk_map()."""
+    ocean = pnm_image_to_array(ocean_map)
+    if ocean.shape[1] % 2 == 0:
+        ocean = unfiltered_stretch_array(ocean, ocean.shape[1] + 1, ocean.shape[0] + 1)
+    return array_to_pnm_image(mask_walk_map(pnm_image_to_array(resized_heightfield), ocean))
+
+
+def make_test_images(size, rng):
+    heightfield = rng.integers(0, 65536, size=(size + 1, size + 1, 1), dtype=np.uint16)
+    # Roughly a third of the map is ocean
+    ocean = np.zeros((size, size, 3), dtype=np.uint8)
+    ocean[:, :, 1] = (rng.random((size, size)) > 0.33) * rng.integers(1, 256, size=(size, size))
+    return array_to_pnm_image(heightfield), array_to_pnm_image(ocean)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1025, 2049, 4097],
+                        help="Walk map sizes to test. The ocean map will be one pixel smaller.")
+    parser.add_argument("--skip-per-pixel", action="store_true", help="Only time the vectorized version")
+    parser.add_argument("--seed", type=int, default=16783)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for size in args.sizes:
+        heightfield, ocean = make_test_images(size - 1, rng)
+        result = {"size": size}
+
+        start = perf_counter()
+        vectorized = mask_vectorized(PNMImage(heightfield), ocean)
+        result["vectorized_s"] = perf_counter() - start
+
+        if not args.skip_per_pixel:
+            start = perf_counter()
+            per_pixel = mask_per_pixel(PNMImage(heightfield), ocean)
+            result["per_pixel_s"] = perf_counter() - start
+            result["speedup"] = result["per_pixel_s"] / result["vectorized_s"]
+            result["identical"] = bool(np.array_equal(pnm_image_to_array(per_pixel), pnm_image_to_array(vectorized)))
+
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
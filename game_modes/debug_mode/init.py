@@ -14,6 +14,8 @@ from src.default_controls import setup_controls, interpret_controls
 from src.gui.default_gui import DefaultGUI
 from src.getconfig import logger, debug
 from src.humanoid import Humanoid
+from src.inverse_kinematics.BatchIKSolver import BatchIKSolver
+from src.terrain import TerrainHeightSampler, GroundQueryBatch
 from src.utils import create_and_texture_terrain, create_or_load_walk_map
 from src.weapons.sword import Sword
 
@@ -54,7 +56,13 @@ class Game:
 
         # Characters must be created only after the terrain_bullet_node has been finalized
         self.terrain_init_thread.join()
-        self.player = Humanoid(self.world, self.terrain_bullet_node, 0, 0, debug=debug.getboolean("debug-joints"))
+        # Solves the legs of all characters together, once there are enough of them
+        self.ik_solver = BatchIKSolver()
+        self.player = Humanoid(self.world, self.terrain_bullet_node, 0, 0, debug=debug.getboolean("debug-joints"),
+                               height_sampler=self.height_sampler)
+        self.ground_queries.add(self.player)
+        for leg in self.player.leg:
+            self.ik_solver.addChain(leg)
         self.weapon = Sword(self.world, self.player.lower_torso)
         self.player.grab_right(self.weapon.getAttachmentInfo())
         # self.player.grab_both(self.weapon.getAttachmentInfo())
@@ -66,7 +74,10 @@ class Game:
                     continue
                 self.doppelgangers.append(
                     Humanoid(self.world, self.terrain_bullet_node, i * 2 - (self.doppelganger_num - 1),
-                             j * 2 - (self.doppelganger_num - 1)))
+                             j * 2 - (self.doppelganger_num - 1), height_sampler=self.height_sampler))
+                self.ground_queries.add(self.doppelgangers[-1])
+                for leg in self.doppelgangers[-1].leg:
+                    self.ik_solver.addChain(leg)
 
         self.gui = DefaultGUI(text_input_func=self.player_say)
 
@@ -110,10 +121,12 @@ class Game:
         create_and_texture_terrain(elevation_img, self.terrain_height, texture_img)
 
         # Collision detection for the terrain. Preferably the image should have a size 1 pixel taller and wider than elevation_img.
-        terrain_colshape = BulletHeightfieldShape(
-            create_or_load_walk_map("worldmaps/debug_heightmap.png", "worldmaps/debug_ocean.png"),
-            self.terrain_height, ZUp)
+        walk_map = create_or_load_walk_map("worldmaps/debug_heightmap.png", "worldmaps/debug_ocean.png")
+        terrain_colshape = BulletHeightfieldShape(walk_map, self.terrain_height, ZUp)
         terrain_colshape.set_use_diamond_subdivision(True)
+        # Elevation queries for characters, without raycasting against the collision shape
+        self.height_sampler = TerrainHeightSampler(walk_map, self.terrain_height, diamond_subdivision=True)
+        self.ground_queries = GroundQueryBatch(self.height_sampler)
 
         self.terrain_bullet_node.add_shape(terrain_colshape)
         self.terrain_np = render.attach_new_node(self.terrain_bullet_node)
@@ -137,6 +150,7 @@ class Game:
         dt = globalClock.get_dt()
 
         self.world.do_physics(dt, 5, 1.0 / 80.0)
+        self.ground_queries.resolve()
 
         # Define controls
         if self.gui.input_field.is_focused():
@@ -147,6 +161,7 @@ class Game:
             interpret_controls(self.player)
             for doppelganger in self.doppelgangers:
                 interpret_controls(doppelganger)
+        self.ik_solver.solve()
 
         return task.cont
 
@@ -17,6 +17,7 @@ from src.default_controls import setup_controls, interpret_controls
 from src.gui.default_gui import DefaultGUI
 from src.getconfig import logger, debug
 from src.humanoid import Humanoid
+from src.terrain import TerrainHeightSampler, GroundQueryBatch
 from src.language_processing.load_model import load_language_model
 from src.language_processing.nlp_manager import NLPManager
 from src.utils import create_or_load_walk_map, create_and_texture_terrain
@@ -76,7 +77,8 @@ class Game:
             return task.cont
         # Characters must be created only after the terrain_bullet_node has been finalized
         self.terrain_init_thread.join()
-        self.npc1 = Humanoid(self.world, self.terrain_bullet_node, -2, 2)
+        self.npc1 = Humanoid(self.world, self.terrain_bullet_node, -2, 2, height_sampler=self.height_sampler)
+        self.ground_queries.add(self.npc1)
         self.nlp_manager = NLPManager(self.generator_load_return[0])
         self.start_game()
         return task.done
@@ -90,10 +92,12 @@ class Game:
         create_and_texture_terrain(elevation_img, self.terrain_height, texture_img)
 
         # Collision detection for the terrain. Preferably the image should have a size 1 pixel taller and wider than elevation_img.
-        terrain_colshape = BulletHeightfieldShape(
-            create_or_load_walk_map("worldmaps/seed_16783_grayscale.png", "worldmaps/seed_16783_ocean.png"),
-            self.terrain_height, ZUp)
+        walk_map = create_or_load_walk_map("worldmaps/seed_16783_grayscale.png", "worldmaps/seed_16783_ocean.png")
+        terrain_colshape = BulletHeightfieldShape(walk_map, self.terrain_height, ZUp)
         terrain_colshape.set_use_diamond_subdivision(True)
+        # Elevation queries for characters, without raycasting against the collision shape
+        self.height_sampler = TerrainHeightSampler(walk_map, self.terrain_height, diamond_subdivision=True)
+        self.ground_queries = GroundQueryBatch(self.height_sampler)
 
         self.terrain_bullet_node.add_shape(terrain_colshape)
         self.terrain_np = render.attach_new_node(self.terrain_bullet_node)
@@ -104,7 +108,9 @@ class Game:
     def start_game(self):
         self.notice_text_obj.hide()
 
-        self.player = Humanoid(self.world, self.terrain_bullet_node, 0, 0, debug=debug.getboolean("debug-joints"))
+        self.player = Humanoid(self.world, self.terrain_bullet_node, 0, 0, debug=debug.getboolean("debug-joints"),
+                               height_sampler=self.height_sampler)
+        self.ground_queries.add(self.player)
         self.weapon = Sword(self.world, self.player.lower_torso)
         self.player.grab_right(self.weapon.getAttachmentInfo())
 
@@ -149,6 +155,7 @@ class Game:
         dt = globalClock.get_dt()
 
         self.world.do_physics(dt, 5, 1.0 / 80.0)
+        self.ground_queries.resolve()
 
         # Define controls
         if self.gui.input_field.is_focused():
@@ -19,6 +19,7 @@ from src.default_controls import setup_controls, interpret_controls
 from src.gui.default_gui import DefaultGUI
 from src.getconfig import debug, logger
 from src.humanoid import Humanoid
+from src.terrain import TerrainHeightSampler, GroundQueryBatch
 from src.utils import create_or_load_walk_map, create_and_texture_terrain, paste_into, is_focused
 from src.gui.inputfield import InputField
 
@@ -114,8 +115,12 @@ class Game:
 
         # Characters must be created only after the terrain_bullet_node has been finalized
         self.terrain_init_thread.join()
-        self.player = Humanoid(self.world, self.terrain_bullet_node, 0, 0, debug=debug.getboolean("debug-joints"))
-        self.opponent = Humanoid(self.world, self.terrain_bullet_node, 2, 0, debug=debug.getboolean("debug-joints"))
+        self.player = Humanoid(self.world, self.terrain_bullet_node, 0, 0, debug=debug.getboolean("debug-joints"),
+                               height_sampler=self.height_sampler)
+        self.opponent = Humanoid(self.world, self.terrain_bullet_node, 2, 0, debug=debug.getboolean("debug-joints"),
+                                 height_sampler=self.height_sampler)
+        self.ground_queries.add(self.player)
+        self.ground_queries.add(self.opponent)
         self.player_start_time = time() % 10
         self.opponent_start_time = -1
         self.network_listen_thread = threading.Thread(target=self.network_listen_initial, args=())
@@ -211,10 +216,12 @@ class Game:
         create_and_texture_terrain(elevation_img, self.terrain_height, texture_img)
 
         # Collision detection for the terrain
-        terrain_colshape = BulletHeightfieldShape(
-            create_or_load_walk_map("worldmaps/seed_16783_grayscale.png", "worldmaps/seed_16783_ocean.png"),
-            self.terrain_height, ZUp)
+        walk_map = create_or_load_walk_map("worldmaps/seed_16783_grayscale.png", "worldmaps/seed_16783_ocean.png")
+        terrain_colshape = BulletHeightfieldShape(walk_map, self.terrain_height, ZUp)
         terrain_colshape.set_use_diamond_subdivision(True)
+        # Elevation queries for characters, without raycasting against the collision shape
+        self.height_sampler = TerrainHeightSampler(walk_map, self.terrain_height, diamond_subdivision=True)
+        self.ground_queries = GroundQueryBatch(self.height_sampler)
 
         self.terrain_bullet_node.add_shape(terrain_colshape)
         self.terrain_np = render.attach_new_node(self.terrain_bullet_node)
@@ -261,6 +268,7 @@ class Game:
         dt = globalClock.get_dt()
 
         self.world.do_physics(dt, 5, 1.0 / 80.0)
+        self.ground_queries.resolve()
 
         # Define controls
         interpret_controls(self.player)
@@ -85,5 +85,7 @@ class MyApp(ShowBase):
         import game_modes.main.init
 
 
-app = MyApp()
-app.run()
+# Guarded, because the language model's process imports this module too
+if __name__ == "__main__":
+    app = MyApp()
+    app.run()
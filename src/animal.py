@@ -9,6 +9,7 @@ from math import cos, sin, radians, degrees, acos, copysign
 from panda3d.core import Vec2, Vec3
 
 from src.language_processing.nlp_manager import NLPManager
+from src.language_processing.short_term_memory import ShortTermMemory
 from src.utils import get_ground_z_pos
 
 
@@ -25,13 +26,21 @@ class Animal:
         slope_linear_damping (float): Linear damping exponent while climbing
         negligible_speed (float, optional): Speed in m/s below which it's assumed the organism is at halt
         debug_text_node (OnscreenText, optional): A place in the GUI to write debug information to
+        height_sampler (TerrainHeightSampler, optional): Used for elevation queries instead of raycasts, if given
     """
+    # Terrain planes as (x, y, z, dz_dx, dz_dy, radius), given by a GroundQueryBatch. A class attribute, because subclasses
+    # may need elevation information before calling Animal's constructor.
+    ground_planes = ()
+    # Whether the same answer may be given when asked the same thing with the same memories, instead of generating a new
+    # one. Always the case when the temperature is 0, as the answer would be the same anyway.
+    allow_response_reuse = False
 
 
     def __init__(self, world, terrain_bullet_node, body_node, feet, slope_difficult, slope_max,
-                 slope_linear_damping=0.6, negligible_speed=0.2, ground_offset=0, debug_text_node=None):
+                 slope_linear_damping=0.6, negligible_speed=0.2, ground_offset=0, debug_text_node=None, height_sampler=None):
         self.world = world
         self.terrain_bullet_node = terrain_bullet_node
+        self.height_sampler = height_sampler
         self.body = body_node
         self.ground_offset = ground_offset
         self.slope_difficult = radians(slope_difficult)
@@ -44,7 +53,7 @@ class Animal:
         # We store this here, in case somebody wants to switch speech bubble styles
         self.can_talk_time = datetime(1, 1, 1, 1, 1, 1, 342380)
         self.can_talk_more = True
-        self.short_term_memory = []
+        self.short_term_memory = ShortTermMemory()
 
 
     def get_body(self):
@@ -84,6 +93,48 @@ class Animal:
             self.speech_field.hide_task = taskMgr.doMethodLater(on_screen_time, self.hide_speech_field, 'HSB', extraArgs=[])
 
 
+    def get_ground_z_pos(self, x, y):
+        """Gets the terrain's elevation at the given point
+
+        Args:
+            x (float): X coordinate in world space
+            y (float): Y coordinate in world space
+
+        Returns:
+            float: Z coordinate of the terrain's surface
+        """
+        for plane_x, plane_y, z, dz_dx, dz_dy, radius in self.ground_planes:
+            dx = x - plane_x
+            dy = y - plane_y
+            # Only exact on the same triangle of the terrain
+            if dx * dx + dy * dy <= radius * radius:
+                return z + dz_dx * dx + dz_dy * dy
+
+        if self.height_sampler:
+            return self.height_sampler.get_z(x, y)
+        return get_ground_z_pos(x, y, self.world, self.terrain_bullet_node)
+
+
+    def get_ground_query_points(self):
+        """Gets the points whose elevation is going to be needed during the next movement update.
+
+        Returns:
+            List[Tuple[float, float]]: X and Y coordinates in world space
+        """
+        return [(self.body.getX(), self.body.getY())]
+
+
+    def set_ground_query_results(self, planes):
+        """Sets the terrain's surface around the points from get_ground_query_points().
+
+        Args:
+            planes (List[Tuple[float, float, float, float, float, float]]): The points' coordinates, elevations and
+                slopes, and the radii around them where the slopes are exact, as (x, y, z, dz_dx, dz_dy, radius). Queries
+                within these radii are answered from them, and the rest from the height sampler.
+        """
+        self.ground_planes = planes
+
+
     def get_ground_z_velocity(self, current_z_pos=None):
         """Calculates a vertical velocity at which the creature will stay on the surface of the terrain
 
@@ -115,8 +166,7 @@ class Animal:
             average_z += foot.getZ(render)
         average_z /= len(self.feet)
 
-        average_z -= self.ground_offset + get_ground_z_pos(self.body.getX() + offset_x, self.body.getY() + offset_y, self.world,
-                                      self.terrain_bullet_node)
+        average_z -= self.ground_offset + self.get_ground_z_pos(self.body.getX() + offset_x, self.body.getY() + offset_y)
         return average_z
 
 
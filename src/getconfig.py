@@ -32,6 +32,26 @@ setting_info = {
     "force-cpu":        ["Whether to force CPU instead of GPU usage in language processing", 0],
     "generate-num":     ["Approximate number of words to generate.", 60],
     "enable-fps-meter": ["Show a frames per second counter", 1],
+    "kv-cache-mb":      ["Memory in megabytes for remembering the language model's state between an NPC's replies. It "
+                         "takes n_layer * 2 * n_embd * 4 bytes per token in 32-bit, e.g. 600 KB for GPT-2 XL. 0 fits "
+                         "the whole context of 4 NPCs", 0],
+    "nlp-batch-size":   ["How many NPCs' replies may be generated at the same time", 4],
+    "weight-cache":     ["Convert language models once into a format that loads faster, but takes extra disk space", 1],
+    "nlp-model-type":   ["gpt2, or gpt2-experimental for a faster implementation that continues one reply at a time",
+                         "gpt2"],
+    "quantize":         ["none, or int8 to make the language model smaller and faster on the CPU, at some loss in quality",
+                         "none"],
+    "draft-model":      ["A small model in language_models with the same vocabulary, to speed up generating. Empty for none",
+                         ""],
+    "draft-tokens":     ["How many tokens the draft model proposes at a time", 4],
+    "response-cache-size": ["How many answers to remember for reusing, when the temperature is 0 or an NPC allows it. "
+                            "0 turns it off, as no NPC allows it at the default temperature", 0],
+    "response-cache-file": ["A file to keep the reusable answers in between sessions. Empty to only keep them in memory",
+                            ""],
+    "nlp-process":      ["Run the language model in a separate process, so that generating text doesn't slow down the game",
+                         0],
+    "nlp-server":       ["Address of a language model server to use instead of loading the model, e.g. 127.0.0.1:8765",
+                         ""],
 }
 
 debug_info = {
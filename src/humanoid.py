@@ -6,9 +6,9 @@ from src.inverse_kinematics.IKChain import IKChain
 from src.inverse_kinematics.Utils import *
 from src.inverse_kinematics.WalkCycle import WalkCycle
 from src.inverse_kinematics.ArmatureUtils import ArmatureUtils
-from src.shapes import create_rounded_box, create_physics_sphere, create_sphere
+from src.shapes import create_rounded_box, create_physics_sphere, create_sphere, instance_visual
 from src.speech_bubble import SpeechBubble
-from src.utils import angle_diff, normalize_angle, get_ground_z_pos
+from src.utils import angle_diff, normalize_angle
 from shaders.basic_lighting import basic_lighting_shader
 from src.body_parts.humanoid_arm import HumanoidArm
 from panda3d.bullet import BulletGenericConstraint, BulletConeTwistConstraint, BulletHingeConstraint
@@ -19,9 +19,11 @@ class Humanoid(Animal):
     """
 
 
-    def __init__(self, world, terrain_bullet_node, x, y, height=1.7, start_heading=Vec3(0, 0, 0), debug=False, debug_text_node=None):
+    def __init__(self, world, terrain_bullet_node, x, y, height=1.7, start_heading=Vec3(0, 0, 0), debug=False, debug_text_node=None,
+                 height_sampler=None):
         self.world = world
         self.terrain_bullet_node = terrain_bullet_node
+        self.height_sampler = height_sampler
         self.debug = debug
 
         self.in_left_hand = None
@@ -53,7 +55,7 @@ class Humanoid(Animal):
 
         # Control node and the whole body collision box
         self.lower_torso = create_rounded_box(self.chest_width, 0.2, self.lower_torso_height)
-        start_position = Vec3(x, y, self.target_height + get_ground_z_pos(x, y, self.world, self.terrain_bullet_node))
+        start_position = Vec3(x, y, self.target_height + self.get_ground_z_pos(x, y))
         self.lower_torso.set_pos_hpr(start_position, start_heading)
         self.lower_torso.node().set_mass(35.0)
         self.lower_torso.node().set_angular_factor(Vec3(0, 0, 0.1))
@@ -75,9 +77,7 @@ class Humanoid(Animal):
         self.chest.set_pos_hpr(Vec3(start_position.get_x(), start_position.get_y(),
                                     start_position.get_z() + self.lower_torso_height / 2 + self.chest_height), start_heading)
         self.world.attach(self.chest.node())
-        chest_visual = loader.loadModel("3d-assets/unit_cylinder.bam")
-        chest_visual.setScale(Vec3(self.chest_width, 0.2, self.chest_height))
-        chest_visual.reparentTo(self.chest)
+        instance_visual("3d-assets/unit_cylinder.bam", self.chest, Vec3(self.chest_width, 0.2, self.chest_height))
         self.chest.node().set_angular_sleep_threshold(0.05)
 
         frame_a = TransformState.make_pos_hpr(Point3(0, 0, -self.chest_height / 2), Vec3(0, 0, 0))
@@ -96,9 +96,7 @@ class Humanoid(Animal):
         self.head = NodePath("Head")
         self.head.reparent_to(self.chest)
         self.head.set_z((self.chest_height + self.head_height) / 2)
-        head = loader.load_model("3d-assets/unit_sphere.bam")
-        head.reparent_to(self.head)
-        head.set_scale(self.head_height)
+        instance_visual("3d-assets/unit_sphere.bam", self.head, Vec3(self.head_height))
 
         self.arm_constraint_up = radians(-95)
         self.arm_constraint_down = radians(135)
@@ -133,16 +131,16 @@ class Humanoid(Animal):
         # Set up information needed by inverse kinematics
         self.thigh = []
         lower_leg = []
+        foot_joint = []
         self.foot = []
         self.leg = []
         self.foot_target = []
         self.planned_foot_target = []
+        horizontal_placements = (-1, 1)
 
+        # Both legs are part of the same skeleton, so that the humanoid has a single actor:
         for i in range(2):
-            if i == 0:
-                horizontal_placement = -1
-            else:
-                horizontal_placement = 1
+            horizontal_placement = horizontal_placements[i]
 
             # Place the hip
             root_joint = au.createJoint("root" + str(i))
@@ -153,25 +151,29 @@ class Humanoid(Animal):
 
             lower_leg.append(au.createJoint("lowerLeg" + str(i), parentJoint=self.thigh[i], translate=-LVector3f.unitZ() *
                                                                                                       self.thigh_length))
-            foot_joint = au.createJoint("foot" + str(i), parentJoint=lower_leg[i], translate=-LVector3f.unitZ() * self.lower_leg_length)
+            foot_joint.append(au.createJoint("foot" + str(i), parentJoint=lower_leg[i],
+                                             translate=-LVector3f.unitZ() * self.lower_leg_length))
+
+        # IMPORTANT! Let the ArmatureUtils create the actor and set up control nodes, once all joints exist:
+        au.finalize()
+        # IMPORTANT! Attach the created actor to the scene, otherwise you won't see anything!
+        au.getActor().reparentTo(self.lower_torso)
 
-            # IMPORTANT! Let the ArmatureUtils create the actor and set up control nodes:
-            au.finalize()
-            # IMPORTANT! Attach the created actor to the scene, otherwise you won't see anything!
-            au.getActor().reparentTo(self.lower_torso)
+        for i in range(2):
+            horizontal_placement = horizontal_placements[i]
 
-            self.foot.append(au.getControlNode( foot_joint.getName() ).attach_new_node("Foot"))
+            self.foot.append(au.getControlNode( foot_joint[i].getName() ).attach_new_node("Foot"))
             self.foot[i].set_pos_hpr(Vec3(0, self.foot_height / 2, 0), Vec3(0, 0, 0))
 
             self.leg.append(IKChain(au.getActor()))
 
             bone = self.leg[i].addJoint(self.thigh[i], au.getControlNode(self.thigh[i].getName()))
             bone = self.leg[i].addJoint(lower_leg[i], au.getControlNode(lower_leg[i].getName()), parentBone=bone)
-            bone = self.leg[i].addJoint(foot_joint, au.getControlNode(foot_joint.getName()), parentBone=bone)
+            bone = self.leg[i].addJoint(foot_joint[i], au.getControlNode(foot_joint[i].getName()), parentBone=bone)
 
             self.leg[i].setBallConstraint(self.thigh[i].getName(), minAng=-math.pi * 0.2, maxAng=math.pi * 0.2)
             self.leg[i].setHingeConstraint(lower_leg[i].getName(), LVector3f.unitX(), minAng=-math.pi * 0.7, maxAng=0)
-            self.leg[i].setBallConstraint(foot_joint.getName(), minAng=0, maxAng=math.pi * 0.6)
+            self.leg[i].setBallConstraint(foot_joint[i].getName(), minAng=0, maxAng=math.pi * 0.6)
 
             if self.debug:
                 self.leg[i].debugDisplay()
@@ -182,8 +184,7 @@ class Humanoid(Animal):
             # Set up a target that the foot should reach:
             self.foot_target.append(render.attach_new_node("FootTarget"))
             self.foot_target[i].setZ(
-                self.target_height + get_ground_z_pos(self.foot_target[i].getX(), self.foot_target[i].getY(), self.world,
-                                                      self.terrain_bullet_node))
+                self.target_height + self.get_ground_z_pos(self.foot_target[i].getX(), self.foot_target[i].getY()))
             self.leg[i].setTarget(self.foot_target[i])
 
             # Set up nodes which stay (rigidly) infront of the body, on the floor.
@@ -198,20 +199,18 @@ class Humanoid(Animal):
                 self.planned_foot_target[i].attach_new_node(geom)
 
             # Add visuals to the bones. These MUST be after finalize().
+            # Humanoids of the same height share them, like the collision shapes, see instance_visual().
 
-            visual = loader.load_model("3d-assets/unit_cylinder.bam")
-            visual.set_scale(Vec3(thigh_diameter, thigh_diameter, self.thigh_length))
-            visual.reparent_to(au.getControlNode(self.thigh[i].getName()))
-            visual.set_pos((visual.get_pos() - LVector3f.unitZ() * self.thigh_length) / 2)
+            instance_visual("3d-assets/unit_cylinder.bam", au.getControlNode(self.thigh[i].getName()),
+                            Vec3(thigh_diameter, thigh_diameter, self.thigh_length),
+                            pos=-LVector3f.unitZ() * self.thigh_length / 2)
 
-            visual = loader.load_model("3d-assets/unit_cylinder.bam")
-            visual.set_scale(Vec3(lower_leg_diameter, lower_leg_diameter, self.lower_leg_length))
-            visual.reparent_to(au.getControlNode(lower_leg[i].getName()))
-            visual.set_pos((visual.get_pos() - LVector3f.unitZ() * self.lower_leg_length) / 2)
+            instance_visual("3d-assets/unit_cylinder.bam", au.getControlNode(lower_leg[i].getName()),
+                            Vec3(lower_leg_diameter, lower_leg_diameter, self.lower_leg_length),
+                            pos=-LVector3f.unitZ() * self.lower_leg_length / 2)
 
-            foot_visual = loader.load_model("3d-assets/unit_cube.bam")
-            foot_visual.reparent_to(self.foot[i])
-            foot_visual.set_scale(Vec3(lower_leg_diameter, self.foot_length, self.foot_height))
+            instance_visual("3d-assets/unit_cube.bam", self.foot[i],
+                            Vec3(lower_leg_diameter, self.foot_length, self.foot_height))
 
         self.lower_torso.node().set_gravity(Vec3(0, 0, 0))
 
@@ -224,7 +223,7 @@ class Humanoid(Animal):
         self.desired_heading = self.lower_torso.getH()
 
         super().__init__(world, terrain_bullet_node, body_node=self.lower_torso, feet=self.foot, slope_difficult=20, slope_max=50,
-                         debug_text_node=debug_text_node, ground_offset=self.foot_height)
+                         debug_text_node=debug_text_node, ground_offset=self.foot_height, height_sampler=height_sampler)
 
         # Humanoids automatically come equipped with a speaking capability. Neat, huh?
         self.set_speech_field(
@@ -319,13 +318,11 @@ class Humanoid(Animal):
         left = 0
         right = 1
         self.planned_foot_target[left].set_pos(-self.pelvis_width / 4, step_dist, -self.target_height)
-        self.planned_foot_target[left].setZ(render, get_ground_z_pos(self.planned_foot_target[left].getX(render),
-                                                                     self.planned_foot_target[left].getY(render), self.world,
-                                                                     self.terrain_bullet_node))
+        self.planned_foot_target[left].setZ(render, self.get_ground_z_pos(self.planned_foot_target[left].getX(render),
+                                                                          self.planned_foot_target[left].getY(render)))
         self.planned_foot_target[right].set_pos(self.pelvis_width / 4, step_dist, -self.target_height)
-        self.planned_foot_target[right].setZ(render, get_ground_z_pos(self.planned_foot_target[right].getX(render),
-                                                                      self.planned_foot_target[right].getY(render), self.world,
-                                                                      self.terrain_bullet_node))
+        self.planned_foot_target[right].setZ(render, self.get_ground_z_pos(self.planned_foot_target[right].getX(render),
+                                                                           self.planned_foot_target[right].getY(render)))
 
         # Update the walkcycle to determine if a step needs to be taken:
         update = cur_walk_dist
@@ -363,6 +360,15 @@ class Humanoid(Animal):
         self.leg[right].updateIK()
 
 
+    def get_ground_query_points(self):
+        # The planned foot targets stay where the previous frame left them, which is usually close enough to where they'll
+        # be put next. If they end up on another triangle of the terrain, they're looked up again.
+        points = super().get_ground_query_points()
+        for planned_foot_target in self.planned_foot_target:
+            points.append((planned_foot_target.getX(render), planned_foot_target.getY(render)))
+        return points
+
+
     def turn_left(self):
         if abs(angle_diff(-self.lower_torso.getH(), self.desired_heading)) > 170:
             return
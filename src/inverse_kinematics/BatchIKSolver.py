@@ -0,0 +1,387 @@
+import math
+import numpy as np
+from panda3d.core import Quat
+
+
+# Quaternions are arrays of (r, i, j, k), like Panda3D's Quat, with any number of leading dimensions.
+
+def cross( a, b ):
+    """ Cross product over the last axis. Faster than np.cross for small arrays.
+    """
+    ax, ay, az = a[...,0], a[...,1], a[...,2]
+    bx, by, bz = b[...,0], b[...,1], b[...,2]
+    return np.stack( (ay*bz - az*by, az*bx - ax*bz, ax*by - ay*bx), axis=-1 )
+
+def dot( a, b ):
+    return np.einsum( "...i,...i->...", a, b )
+
+def quatMul( a, b ):
+    """ Same as a*b for Panda3D's Quat, i.e. the rotation a followed by the rotation b.
+    """
+    ar, ai, aj, ak = a[...,0], a[...,1], a[...,2], a[...,3]
+    br, bi, bj, bk = b[...,0], b[...,1], b[...,2], b[...,3]
+    return np.stack( (
+        br*ar - bi*ai - bj*aj - bk*ak,
+        br*ai + bi*ar + bj*ak - bk*aj,
+        br*aj - bi*ak + bj*ar + bk*ai,
+        br*ak + bi*aj - bj*ai + bk*ar ), axis=-1 )
+
+def quatRotate( q, v ):
+    """ Same as q.xform( v ) for Panda3D's Quat.
+    """
+    u = q[...,1:]
+    t = 2*cross( u, v )
+    return v + q[...,:1]*t + cross( u, t )
+
+def quatConjugate( q ):
+    return q*np.array( (1.0, -1.0, -1.0, -1.0) )
+
+def quatFromAxisAngle( ang, axis ):
+    """ Same as Quat.setFromAxisAngleRad( ang, axis ), for a normalized axis.
+    """
+    return np.concatenate( (np.cos( ang*0.5 )[...,None], axis*np.sin( ang*0.5 )[...,None]), axis=-1 )
+
+def rotationBetween( src, dest ):
+    """ Same as getRotationBetween( src, dest ) from Utils, without a fallback axis.
+    """
+    v0 = normalized( src )
+    v1 = normalized( dest )
+    d = dot( v0, v1 )
+    # Half a turn around any axis that's perpendicular to src:
+    axis = cross( np.array( (1.0, 0.0, 0.0) ), v0 )
+    axis = normalized( np.where( (dot( axis, axis ) < 1e-9)[...,None], cross( np.array( (0.0, 1.0, 0.0) ), v0 ), axis ) )
+    halfTurn = np.concatenate( (np.zeros_like( d )[...,None], axis), axis=-1 )
+    s = np.sqrt( np.maximum( (1 + d)*2, 1e-12 ) )
+    q = normalized( np.concatenate( ((s*0.5)[...,None], cross( v0, v1 )/s[...,None]), axis=-1 ) )
+    q = np.where( (d < 1e-6 - 1)[...,None], halfTurn, q )
+    return np.where( (d >= 1)[...,None], np.array( (1.0, 0.0, 0.0, 0.0) ), q )
+
+def wrapAngle( ang ):
+    """ Forces the angles into the minimum absolute value residue class, so that -180 < angle <= 180.
+    """
+    ang = ang % (math.pi*2)
+    return np.where( ang > math.pi, ang - 2*math.pi, ang )
+
+def normalized( v ):
+    """ v divided by its length, or zero where the length is (almost) zero, like Panda3D's normalized().
+    """
+    length = np.sqrt( dot( v, v ) )[...,None]
+    return np.where( length > 1e-12, v/np.maximum( length, 1e-12 ), 0.0 )
+
+
+class ChainGroup():
+    """ The constant data of all registered chains with the same number of bones, as arrays. Two bone chains (see
+    IKChain.isTwoBoneChain()) are grouped separately from the others.
+    """
+
+    def __init__( self, numBones, twoBone ):
+        self.numBones = numBones
+        self.twoBone = twoBone
+        self.chains = []
+        self.offsets = np.zeros( (0, numBones, 3) )
+        self.axes = np.zeros( (0, numBones, 3) )
+        self.hasAxis = np.zeros( (0, numBones), dtype=bool )
+        self.minAngs = np.zeros( (0, numBones) )
+        self.maxAngs = np.zeros( (0, numBones) )
+        self.static = np.zeros( (0, numBones), dtype=bool )
+
+    def add( self, chain ):
+        bones = chain.bones
+        self.chains.append( chain )
+        self.offsets = np.append( self.offsets, [[tuple(b.controlNode.getPos()) for b in bones]], axis=0 )
+        self.axes = np.append( self.axes, [[tuple(b.axis) if b.axis else (0, 0, 0) for b in bones]], axis=0 )
+        self.hasAxis = np.append( self.hasAxis, [[b.axis is not None for b in bones]], axis=0 )
+        self.minAngs = np.append( self.minAngs, [[b.minAng for b in bones]], axis=0 )
+        self.maxAngs = np.append( self.maxAngs, [[b.maxAng for b in bones]], axis=0 )
+        self.static = np.append( self.static, [[b.static for b in bones]], axis=0 )
+
+    def remove( self, chain ):
+        i = self.chains.index( chain )
+        del self.chains[i]
+        for name in ("offsets", "axes", "hasAxis", "minAngs", "maxAngs", "static"):
+            setattr( self, name, np.delete( getattr( self, name ), i, axis=0 ) )
+
+
+class BatchIKSolver():
+    """ Solves many IKChains at once, with the same algorithms and constraints as IKChain.inverseKinematics(): two bone
+    chains in closed form, and all others with CCD.
+
+    Once a chain is added, its updateIK() only asks for the chain to be solved. solve(), which should be called once a
+    frame after all the chains have been updated, then reads the bone rotations and targets of all of those chains into
+    arrays, solves all of them together with NumPy, and writes the results back with one setQuat()
+    per bone.
+
+    Each NumPy call has a fixed cost, so with fewer than minBatchSize chains to solve, solve() lets each chain solve
+    itself with IKChain.inverseKinematics() instead.
+
+    The bone offsets and the constraints are read when a chain is added, so they mustn't change afterwards. The chain's
+    actor and bones mustn't be scaled. The end effector is the origin of the last bone, like in IKChain.
+
+    Example:
+        ikSolver = BatchIKSolver()
+        ikSolver.addChain( leg )
+        ...
+        leg.updateIK()
+        ikSolver.solve()
+    """
+
+    def __init__( self, threshold=1e-2, minIterations=1, maxIterations=10, minBatchSize=64 ):
+        self.threshold = threshold
+        self.minIterations = minIterations
+        self.maxIterations = maxIterations
+        self.minBatchSize = minBatchSize
+        self.groups = {}
+        self.requested = []
+
+    def addChain( self, chain ):
+        assert len(chain.bones) > 0, "BatchIKSolver requires at least one bone in each chain!"
+        key = self.groupKey( chain )
+        if key not in self.groups:
+            self.groups[key] = ChainGroup( *key )
+        self.groups[key].add( chain )
+        chain.solver = self
+
+    def removeChain( self, chain ):
+        self.groups[self.groupKey( chain )].remove( chain )
+        if chain in self.requested:
+            self.requested.remove( chain )
+        chain.solver = None
+        # A requested chain might not have been solved yet:
+        chain.solvedTargetPos = None
+
+    @staticmethod
+    def groupKey( chain ):
+        return ( len(chain.bones), chain.isTwoBoneChain() )
+
+    def request( self, chain ):
+        """ Called by IKChain.updateIK(). The chain will be solved by the next solve().
+        """
+        self.requested.append( chain )
+
+    def solve( self ):
+        """ Solves all the chains whose updateIK() has been called since the last solve().
+        """
+        if not self.requested:
+            return
+        requested = dict.fromkeys( self.requested )
+        self.requested = []
+        if len(requested) < self.minBatchSize:
+            for chain in requested:
+                chain.inverseKinematics( self.threshold, self.minIterations, self.maxIterations )
+            return
+        for group in self.groups.values():
+            indices = [i for i, chain in enumerate(group.chains) if chain in requested]
+            if indices:
+                self.solveGroup( group, np.array( indices ) )
+
+    def solveGroup( self, group, indices ):
+        chains = [group.chains[i] for i in indices]
+        # Everything is in the space of the chain's actor, which the first bone's control node is attached to
+        targets = np.array( [tuple(chain.target.getPos( chain.actor )) for chain in chains] )
+        quats = np.array( [[tuple(bone.controlNode.getQuat()) for bone in chain.bones] for chain in chains] )
+        offsets = group.offsets[indices]
+        axes = group.axes[indices]
+        hasAxis = group.hasAxis[indices]
+        minAngs = group.minAngs[indices]
+        maxAngs = group.maxAngs[indices]
+        static = group.static[indices]
+
+        if group.twoBone:
+            reached = self.inverseKinematicsTwoBone( quats, offsets, targets, axes, minAngs, maxAngs )
+        else:
+            reached = self.inverseKinematicsCCD( quats, offsets, targets, axes, hasAxis, minAngs, maxAngs, static )
+
+        for chain, chainQuats, chainReached in zip( chains, quats.tolist(), reached.tolist() ):
+            for bone, q in zip( chain.bones, chainQuats ):
+                bone.controlNode.setQuat( Quat( *q ) )
+            chain.targetReached = chainReached
+
+    def inverseKinematicsCCD( self, quats, offsets, targets, axes, hasAxis, minAngs, maxAngs, static ):
+        """ Runs the CCD iterations on arrays, with the same steps as IKChain.inverseKinematicsCCD().
+
+        Args:
+            quats (np.ndarray): (chains, bones, 4) rotations of the bones relative to their parents. Updated in place.
+            offsets (np.ndarray): (chains, bones, 3) positions of the bones relative to their parents
+            targets (np.ndarray): (chains, 3) the targets, in the space of the chains' roots
+            axes (np.ndarray): (chains, bones, 3) hinge axes
+            hasAxis (np.ndarray): (chains, bones) whether each bone is a hinge rather than a ball joint
+            minAngs (np.ndarray): (chains, bones) constraints
+            maxAngs (np.ndarray): (chains, bones) constraints
+            static (np.ndarray): (chains, bones) bones that aren't rotated
+
+        Returns:
+            np.ndarray: (chains,) whether each chain's end effector reached its target
+        """
+        numChains, numBones = quats.shape[:2]
+        reached = np.zeros( numChains, dtype=bool )
+        # The chains that are still being solved, and their data. Chains that reach their targets are left out of the
+        # following iterations:
+        indices = np.arange( numChains )
+        data = [quats, offsets, targets, axes, hasAxis, minAngs, maxAngs, static]
+        for i in range(self.maxIterations):
+
+            # The bones are updated from the end of the chain backwards, so the rotations and positions of the bones
+            # before the one that's being updated are still those from the start of the iteration:
+            rotations, positions = self.forwardKinematics( data[0], data[1] )
+            if i >= self.minIterations:
+                diff = data[2] - positions[:,-1]
+                done = dot( diff, diff ) < self.threshold**2
+                if done.any():
+                    reached[indices[done]] = True
+                    quats[indices] = data[0]
+                    if done.all():
+                        return reached
+                    remaining = ~done
+                    indices = indices[remaining]
+                    data = [a[remaining] for a in data]
+                    rotations, positions = rotations[remaining], positions[remaining]
+            q, offs, targs, axs, hasAx, mins, maxs, stat = data
+
+            # The target in the space of each bone:
+            localTargets = quatRotate( quatConjugate( rotations ), targs[:,None] - positions )
+            # The end effector in the space of the bone that's being updated:
+            ee = offs[:,-1]
+            for b in range(numBones-2, -1, -1):
+                update = ~stat[:,b]
+                if update.any():
+                    q[:,b] = self.rotateBone( q[:,b], localTargets[:,b], ee, update, axs[:,b], hasAx[:,b], mins[:,b],
+                            maxs[:,b] )
+                if b > 0:
+                    ee = offs[:,b] + quatRotate( q[:,b], ee )
+        quats[indices] = data[0]
+        return reached
+
+    def inverseKinematicsTwoBone( self, quats, offsets, targets, axes, minAngs, maxAngs ):
+        """ Solves two bone chains in a single pass, with the same steps as IKChain.inverseKinematicsTwoBone().
+
+        Args:
+            quats (np.ndarray): (chains, 3, 4) rotations of the bones relative to their parents. Updated in place.
+            offsets (np.ndarray): (chains, 3, 3) positions of the bones relative to their parents
+            targets (np.ndarray): (chains, 3) the targets, in the space of the chains' roots
+            axes (np.ndarray): (chains, 3, 3) hinge axes, of which only the second bone's is used
+            minAngs (np.ndarray): (chains, 3) constraints
+            maxAngs (np.ndarray): (chains, 3) constraints
+
+        Returns:
+            np.ndarray: (chains,) whether each chain's end effector reached its target
+        """
+        toTarget = targets - offsets[:,0]
+
+        # With the hinge bent by ang, the end effector is at knee + o2Par + o2Perp*cos(ang) + o2Side*sin(ang) in the
+        # upper bone's space:
+        knee = offsets[:,1]
+        o2 = offsets[:,2]
+        axis = axes[:,1]
+        o2Par = dot( o2, axis )[:,None]*axis
+        o2Perp = o2 - o2Par
+        o2Side = cross( axis, o2Perp )
+
+        # Its squared distance from the ball joint is then c + a*cos(ang) + b*sin(ang):
+        a = 2*dot( knee, o2Perp )
+        b = 2*dot( knee, o2Side )
+        c = dot( knee + o2Par, knee + o2Par ) + dot( o2Perp, o2Perp )
+        dist2 = dot( toTarget, toTarget )
+
+        currentAng = 2*np.arctan2( dot( quats[:,1,1:], axis ), quats[:,1,0] )
+        r = np.sqrt( a*a + b*b )
+        phi = np.arctan2( b, a )
+        delta = np.arccos( np.clip( (dist2 - c)/np.maximum( r, 1e-9 ), -1.0, 1.0 ) )
+        candidates = np.where( (r > 1e-9)[:,None], np.stack( (phi + delta, phi - delta), axis=-1 ), currentAng[:,None] )
+        ang = self.chooseHingeAngle( candidates, currentAng, minAngs[:,1], maxAngs[:,1],
+                lambda ang: np.abs( c[:,None] + a[:,None]*np.cos( ang ) + b[:,None]*np.sin( ang ) - dist2[:,None] ) )
+        ee = knee + quatRotate( quatFromAxisAngle( ang, axis ), o2 )
+
+        qUpper = normalized( quatMul( quats[:,0], rotationBetween( quatRotate( quats[:,0], ee ), toTarget ) ) )
+
+        rotAxis = normalized( qUpper[:,1:] )
+        upperAng = wrapAngle( np.arccos( np.clip( qUpper[:,0], -1.0, 1.0 ) )*2 )
+        clampedAng = np.clip( upperAng, minAngs[:,0], maxAngs[:,0] )
+        clamped = (dot( rotAxis, rotAxis ) > 1e-3) & (np.abs( upperAng ) > 1e-6) & (clampedAng != upperAng)
+        if clamped.any():
+            qUpper = np.where( clamped[:,None], quatFromAxisAngle( clampedAng, rotAxis ), qUpper )
+            # The hinge angle that brings the end effector closest to the target, seen from the upper bone:
+            w = quatRotate( quatConjugate( qUpper ), toTarget ) - knee - o2Par
+            best = np.arctan2( dot( w, o2Side ), dot( w, o2Perp ) )
+
+            def distance2( ang ):
+                diff = w[:,None] - o2Perp[:,None]*np.cos( ang )[...,None] - o2Side[:,None]*np.sin( ang )[...,None]
+                return dot( diff, diff )
+
+            closest = self.chooseHingeAngle( best[:,None], ang, minAngs[:,1], maxAngs[:,1], distance2 )
+            ang = np.where( clamped, closest, ang )
+            ee = knee + quatRotate( quatFromAxisAngle( ang, axis ), o2 )
+
+        quats[:,0] = qUpper
+        quats[:,1] = quatFromAxisAngle( ang, axis )
+        diff = quatRotate( qUpper, ee ) - toTarget
+        return dot( diff, diff ) < self.threshold**2
+
+    @staticmethod
+    def chooseHingeAngle( candidates, currentAng, minAng, maxAng, error ):
+        """ Like IKChain.chooseHingeAngle(), for arrays of (chains, candidates) angles.
+        """
+        candidates = np.clip( wrapAngle( candidates ), minAng[:,None], maxAng[:,None] )
+        errors = np.maximum( error( candidates ) - 1e-6, 0 )
+        # The smallest error, and among those the closest to the current angle:
+        order = np.lexsort( (np.abs( candidates - currentAng[:,None] ), errors), axis=-1 )
+        return np.take_along_axis( candidates, order[:,:1], axis=-1 )[:,0]
+
+    @staticmethod
+    def rotateBone( quat, d1, d2, update, axis, hasAxis, minAng, maxAng ):
+        """ One CCD step for one bone of each chain, like the loop body of IKChain.inverseKinematicsCCD().
+
+        Args:
+            quat (np.ndarray): (chains, 4) rotations of the bone relative to its parent
+            d1 (np.ndarray): (chains, 3) the target in the bone's space
+            d2 (np.ndarray): (chains, 3) the end effector in the bone's space
+            update (np.ndarray): (chains,) the chains whose bone should be rotated
+
+        Returns:
+            np.ndarray: (chains, 4) the new rotations
+        """
+        rotCross = cross( d1, d2 )
+        sinAng = np.sqrt( dot( rotCross, rotCross ) )
+        cosAng = dot( d1, d2 )
+        ang = -np.arctan2( sinAng, cosAng )
+        # Like in IKChain, a hinge whose end effector points exactly away from the target bends to the middle of its
+        # limits, rather than around an axis that's only rounding noise
+        opposite = hasAxis & (sinAng**2 < 1e-8*dot( d1, d1 )*dot( d2, d2 )) & (cosAng < 0)
+        rotCross = np.where( opposite[:,None], axis, normalized( rotCross ) )
+        ang = np.where( opposite, (minAng + maxAng)*0.5, ang )
+        update = update & (opposite | (dot( rotCross, rotCross ) >= 1e-9))
+        q = quatFromAxisAngle( ang, rotCross )
+        # Add this rotation to the current rotation:
+        qNew = normalized( quatMul( q, quat ) )
+
+        # Correct rotation for hinge, by keeping only the twist around the axis:
+        twist = normalized( np.concatenate( (qNew[:,:1], dot( qNew[:,1:], axis )[:,None]*axis), axis=-1 ) )
+        qNew = np.where( hasAxis[:,None], twist, qNew )
+
+        rotAxis = normalized( qNew[:,1:] )
+        ang = np.arccos( np.clip( qNew[:,0], -1.0, 1.0 ) )*2
+        update &= (dot( rotAxis, rotAxis ) > 1e-3) & (ang > 0)
+
+        # Force into the minimum absolute value residue class, so that -180 < angle <= 180
+        ang = np.where( ang > math.pi, ang - 2*math.pi, ang )
+        flipped = hasAxis & (dot( rotAxis - axis, rotAxis - axis ) > 0.5)
+        lower = np.where( flipped, -maxAng, minAng )
+        upper = np.where( flipped, -minAng, maxAng )
+        ang = np.where( np.abs( ang ) > 1e-6, np.clip( ang, lower, upper ), ang )
+
+        return np.where( update[:,None], quatFromAxisAngle( ang, rotAxis ), quat )
+
+    @staticmethod
+    def forwardKinematics( quats, offsets ):
+        """ The rotations and positions of the bones in the space of the chains' roots.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (chains, bones, 4) rotations and (chains, bones, 3) positions
+        """
+        rotations = np.empty_like( quats )
+        positions = np.empty_like( offsets )
+        rotations[:,0] = quats[:,0]
+        positions[:,0] = offsets[:,0]
+        for b in range(1, quats.shape[1]):
+            positions[:,b] = positions[:,b-1] + quatRotate( rotations[:,b-1], offsets[:,b] )
+            rotations[:,b] = quatMul( quats[:,b], rotations[:,b-1] )
+        return rotations, positions
@@ -23,6 +23,12 @@ class IKChain():
 
         self.endEffector = None
 
+        # A BatchIKSolver that solves this chain together with others, if one was given this chain
+        self.solver = None
+
+        # Where the target was in the actor's space when the chain was last solved, or None if it must be solved again
+        self.solvedTargetPos = None
+
 
     def addJoint( self, joint, controlNode, parentBone=None, static=False ):
 
@@ -52,12 +58,14 @@ class IKChain():
     def setStatic( self, jointName, static=True ):
         b = self.getBone( jointName )
         b.static = static
+        self.solvedTargetPos = None
 
     def setHingeConstraint( self, jointName, axis, minAng=-math.pi, maxAng=math.pi ):
         b = self.getBone( jointName )
         b.axis = axis.normalized()
         b.minAng = minAng
         b.maxAng = maxAng
+        self.solvedTargetPos = None
 
         if self.debugDisplayEnabled:
             self.debugDisplay()
@@ -67,22 +75,142 @@ class IKChain():
         b.axis = None
         b.minAng = minAng
         b.maxAng = maxAng
+        self.solvedTargetPos = None
 
         if self.debugDisplayEnabled:
             self.debugDisplay()
 
-    def updateIK( self, threshold = 1e-2, minIterations=1, maxIterations=10 ):
+    def updateIK( self, threshold = 1e-2, minIterations=1, maxIterations=10, tolerance=5e-3 ):
+        """ Solves the chain for the current target, starting from the current rotations of the bones.
+
+        Solving is skipped while the target, seen from the actor, is less than tolerance away from where it was at the
+        last solve, as that would give the same result. Only CCD that hasn't reached the target yet keeps iterating.
+        The control nodes are the bones' own, so there's nothing to copy to the mesh afterwards.
+        """
 
         assert len(self.bones) > 0, "IKChain requires at least one bone for updateIK() to work!"
 
+        if not self.target:
+            return
+
+        targetPos = self.target.getPos( self.actor )
+        if self.solvedTargetPos is not None and (targetPos - self.solvedTargetPos).lengthSquared() < tolerance**2 and \
+                (self.targetReached or self.isTwoBoneChain()):
+            return
+        self.solvedTargetPos = targetPos
+
+        # The solver solves this chain in its next solve(), with its own parameters:
+        if self.solver:
+            self.solver.request( self )
+            return
+
         # Solve the IK chain for the IK nodes:
-        if self.target:
+        self.inverseKinematics( threshold, minIterations, maxIterations )
+
+    def inverseKinematics( self, threshold = 1e-2, minIterations=1, maxIterations=10 ):
+        """ Solves the chain in closed form if it's a two bone chain (see isTwoBoneChain()), and with CCD otherwise.
+        """
+        if self.isTwoBoneChain():
+            self.inverseKinematicsTwoBone( threshold )
+        else:
             self.inverseKinematicsCCD( threshold, minIterations, maxIterations )
 
-        # Copy the data from the IK chain to the actual bones.
-        # This will end up affecting the actual mesh.
-        for bone in self.bones:
-            bone.controlNode.setQuat( bone.controlNode.getQuat() )
+    def isTwoBoneChain( self ):
+        """ Whether the chain is a ball joint, followed by a hinge and an end bone, like a thigh, lower leg and foot.
+        """
+        if len(self.bones) != 3:
+            return False
+        upper, lower, end = self.bones
+        return upper.axis is None and lower.axis is not None and not upper.static and not lower.static and \
+                lower.parent is upper and end.parent is lower
+
+    def inverseKinematicsTwoBone( self, threshold = 1e-2 ):
+        """ Solves a two bone chain in a single pass, without iterating.
+
+        The hinge is bent so that the end effector is as far from the ball joint as the target is, within the hinge's
+        limits. Then the ball joint is turned by the smallest rotation that points the end effector at the target, and
+        clamped to its limits like in inverseKinematicsCCD(). If the clamp moved the end effector away from the target,
+        the hinge is bent once more to get it as close to the target as possible.
+        """
+        upper, lower, end = self.bones
+        upperNode = upper.controlNode
+        lowerNode = lower.controlNode
+
+        # The target, relative to the ball joint, in the space of the upper bone's parent:
+        toTarget = self.target.getPos( upperNode.getParent() ) - upperNode.getPos()
+
+        # With the hinge bent by ang, the end effector is at knee + o2Par + o2Perp*cos(ang) + o2Side*sin(ang) in the
+        # upper bone's space:
+        knee = lowerNode.getPos()
+        o2 = end.controlNode.getPos()
+        axis = lower.axis
+        o2Par = axis*o2.dot( axis )
+        o2Perp = o2 - o2Par
+        o2Side = axis.cross( o2Perp )
+
+        # Its squared distance from the ball joint is then c + a*cos(ang) + b*sin(ang):
+        a = 2*knee.dot( o2Perp )
+        b = 2*knee.dot( o2Side )
+        c = (knee + o2Par).lengthSquared() + o2Perp.lengthSquared()
+        dist2 = toTarget.lengthSquared()
+
+        qLower = lowerNode.getQuat()
+        currentAng = 2*math.atan2( LVector3f( qLower.getI(), qLower.getJ(), qLower.getK() ).dot( axis ), qLower.getR() )
+        r = math.sqrt( a*a + b*b )
+        if r > 1e-9:
+            phi = math.atan2( b, a )
+            delta = math.acos( max( -1.0, min( 1.0, (dist2 - c)/r ) ) )
+            candidates = ( phi + delta, phi - delta )
+        else:
+            # The hinge doesn't change the distance:
+            candidates = ( currentAng, )
+        ang = self.chooseHingeAngle( lower, candidates, currentAng,
+                lambda ang: abs( c + a*math.cos( ang ) + b*math.sin( ang ) - dist2 ) )
+
+        qLower = Quat()
+        qLower.setFromAxisAngleRad( ang, axis )
+        ee = knee + qLower.xform( o2 )
+
+        qUpper = upperNode.getQuat()
+        qUpper = qUpper*getRotationBetween( qUpper.xform( ee ), toTarget )
+        qUpper.normalize()
+
+        rotAxis = qUpper.getAxis()
+        rotAxis.normalize()
+        upperAng = qUpper.getAngleRad() % (math.pi*2)
+        # force into the minimum absolute value residue class, so that -180 < angle <= 180
+        if upperAng > math.pi:
+            upperAng -= 2*math.pi
+        if rotAxis.lengthSquared() > 1e-3 and abs(upperAng) > 1e-6:
+            # Clamp the rotation value:
+            clampedAng = max( upper.minAng, min( upper.maxAng, upperAng ) )
+            if clampedAng != upperAng:
+                qUpper.setFromAxisAngleRad( clampedAng, rotAxis )
+                # The hinge angle that brings the end effector closest to the target, seen from the upper bone:
+                w = qUpper.conjugate().xform( toTarget ) - knee - o2Par
+                ang = self.chooseHingeAngle( lower, ( math.atan2( w.dot( o2Side ), w.dot( o2Perp ) ), ), ang,
+                        lambda ang: (w - o2Perp*math.cos( ang ) - o2Side*math.sin( ang )).lengthSquared() )
+                qLower.setFromAxisAngleRad( ang, axis )
+                ee = knee + qLower.xform( o2 )
+
+        upperNode.setQuat( qUpper )
+        lowerNode.setQuat( qLower )
+        self.targetReached = (qUpper.xform( ee ) - toTarget).length() < threshold
+
+    def chooseHingeAngle( self, bone, candidates, currentAng, error ):
+        """ The candidate angle with the smallest error after clamping it to the hinge's limits. Angles that are equally
+        good are decided by how close they are to the current angle.
+        """
+        best = None
+        for ang in candidates:
+            ang = ang % (math.pi*2)
+            if ang > math.pi:
+                ang -= 2*math.pi
+            ang = max( bone.minAng, min( bone.maxAng, ang ) )
+            key = ( max( error( ang ) - 1e-6, 0 ), abs( ang - currentAng ) )
+            if best is None or key < best[0]:
+                best = ( key, ang )
+        return best[1]
 
     def inverseKinematicsCCD( self, threshold = 1e-2, minIterations=1, maxIterations=10 ):
 
@@ -118,11 +246,18 @@ class IKChain():
                 d1 = target-pos
                 d2 = ee-pos
 
-                cross = d1.cross(d2).normalized()
-                if cross.lengthSquared() < 1e-9:
-                    continue
+                cross = d1.cross(d2)
+                if bone.axis and cross.lengthSquared() < 1e-8*d1.lengthSquared()*d2.lengthSquared() and d1.dot(d2) < 0:
+                    # The end effector points exactly away from the target, so the rotation axis and the direction
+                    # of the half turn would only be rounding noise. Bend the hinge to the middle of its limits instead:
+                    cross = bone.axis
+                    ang = (bone.minAng + bone.maxAng)*0.5
+                else:
+                    cross = cross.normalized()
+                    if cross.lengthSquared() < 1e-9:
+                        continue
+                    ang = d2.normalized().signedAngleRad( d1.normalized(), cross )
 
-                ang = d2.normalized().signedAngleRad( d1.normalized(), cross )
                 q = Quat()
                 q.setFromAxisAngleRad( ang, cross )
                 # Add this rotation to the current rotation:
@@ -171,6 +306,7 @@ class IKChain():
 
     def setTarget( self, node ):
         self.target = node
+        self.solvedTargetPos = None
 
     def debugDisplay( self, lineLength=0.2, xRay=True, drawConstraints=True ):
 
@@ -21,13 +21,61 @@ class Conv1D(torch.nn.Module):
         w = torch.empty(nx, nf)
         torch.nn.init.normal_(w, std=0.02)
         self.weight = torch.nn.Parameter(w)
-        self._weightT = None
         self.bias = torch.nn.Parameter(torch.zeros(nf))
 
     def forward(self, x):
-        if self._weightT is None:
-            self._weightT = self.weight.T
-        return torch.nn.functional.linear(x, self._weightT, self.bias)
+        # Not cached, because the view would keep pointing to the old weights after e.g. a dtype conversion
+        return torch.nn.functional.linear(x, self.weight.T, self.bias)
+
+
+class KVCache:
+    """Keys and values of every layer for the tokens so far, in one preallocated buffer that is written in place.
+
+    The buffer only grows when it's full, and then geometrically, so adding a token doesn't normally allocate anything.
+
+    Args:
+        config (GPT2Config): The model's configuration
+        capacity (int): How many tokens to make room for
+        dtype (torch.dtype): The model's precision
+        device (torch.device): The model's device
+    """
+    headroom = 64  # Extra tokens to make room for, when created by the model
+
+    def __init__(self, config, capacity, dtype, device):
+        self.max_capacity = config.n_positions
+        head_features = config.n_embd // config.n_head
+        self.buffer = torch.empty((config.n_layer, 2, config.n_head, capacity, head_features), dtype=dtype, device=device)
+        self.length = 0
+
+    @property
+    def capacity(self):
+        return self.buffer.size(-2)
+
+    @property
+    def nbytes(self):
+        return self.buffer.element_size() * self.buffer.nelement()
+
+    def reserve(self, length):
+        """Makes sure that there's room for length tokens, keeping the current ones.
+
+        Args:
+            length (int): How many tokens there should be room for
+        """
+        if length <= self.capacity:
+            return
+        capacity = min(max(length, self.capacity * 2), max(length, self.max_capacity))
+        buffer = self.buffer.new_empty(self.buffer.shape[:3] + (capacity,) + self.buffer.shape[4:])
+        buffer[..., :self.length, :] = self.buffer[..., :self.length, :]
+        self.buffer = buffer
+
+    def truncate(self, length):
+        """Forgets the tokens after the first length ones. The next ones will be written over them.
+
+        Returns:
+            KVCache: self
+        """
+        self.length = min(length, self.length)
+        return self
 
 
 class Attention(torch.nn.Module):
@@ -61,29 +109,25 @@ class Attention(torch.nn.Module):
         x = x.view(*new_x_shape)  # in Tensorflow implem: fct split_states
         return x.permute(1, 0, 2)  # (batch, head, seq_length, head_features)
 
-    def forward(self, x, layer_past, mask):
+    def forward(self, x, layer_cache, start, mask):
         x = self.c_attn(x)
         x = x.view((x.size(0), 3, self.n_embd))
         query, key, value = x[:, 0], x[:, 1], x[:, 2]
         # query, key, value = x.split(self.n_embd, dim=2)
         query = self.split_heads(query)
-        key = self.split_heads(key)  # , k=True)
-        value = self.split_heads(value)
-
-        if layer_past is not None:
-            past_value = layer_past[1]  # transpose back cf below
-            value = torch.cat((past_value, value), dim=-2)
+        end = start + x.size(0)
 
-            past_key = layer_past[0]  # .transpose(-2, -1)
-            key = torch.cat((past_key, key), dim=-2)
-
-        present = torch.stack([key, value])  # transpose to have same shapes for stacking
+        # Written in place into the preallocated cache, instead of concatenating with the past ones
+        layer_cache[0, :, start:end] = self.split_heads(key)
+        layer_cache[1, :, start:end] = self.split_heads(value)
+        key = layer_cache[0, :, :end]
+        value = layer_cache[1, :, :end]
 
         a = self._attn(query, key.transpose(-2, -1), value, mask)
         a = self.merge_heads(a)
         a = self.c_proj(a)
 
-        return a, present
+        return a
 
 
 class MLP(torch.nn.Module):
@@ -91,9 +135,10 @@ class MLP(torch.nn.Module):
         super(MLP, self).__init__()
         self.c_fc = Conv1D(n_state, config.n_embd)
         self.c_proj = Conv1D(config.n_embd, n_state)
-        if hasattr(torch.nn, 'GELU'):
-            self.act = torch.nn.GELU()  # New in torch 1.4.0, but different results from transformers gelu
-        else:
+        try:
+            # The same tanh approximation as in transformers. New in torch 1.12.0
+            self.act = torch.nn.GELU(approximate="tanh")
+        except TypeError:
             self.act = gelu  # the original gelu, written in pytorch
 
     def forward(self, x):
@@ -111,12 +156,11 @@ class Block(torch.nn.Module):
         self.ln_2 = torch.nn.LayerNorm(n_embd, eps=config.layer_norm_epsilon)
         self.mlp = MLP(4 * n_embd, config)
 
-    def forward(self, x, layer_past, mask):
-        a, present = self.attn(self.ln_1(x), layer_past, mask)
-        x = x + a
+    def forward(self, x, layer_cache, start, mask):
+        x = x + self.attn(self.ln_1(x), layer_cache, start, mask)
         x += self.mlp(self.ln_2(x))  # residual
 
-        return x, present  # x, present
+        return x
 
 
 class GPT2Model(GPT2PreTrainedModel):
@@ -128,7 +172,7 @@ class GPT2Model(GPT2PreTrainedModel):
         self.wpe = torch.nn.Embedding(config.n_positions, config.n_embd)
         self.h = torch.nn.ModuleList([Block(config.n_ctx, config) for _ in range(config.n_layer)])
         self.ln_f = torch.nn.LayerNorm(config.n_embd, eps=config.layer_norm_epsilon)
-        self.register_buffer("bigmask", torch.tril(torch.ones((config.n_ctx, config.n_ctx), dtype=torch.uint8)))
+        self.register_buffer("bigmask", torch.tril(torch.ones((config.n_ctx, config.n_ctx), dtype=torch.bool)))
         self.init_weights()
 
     def get_input_embeddings(self):
@@ -137,28 +181,37 @@ class GPT2Model(GPT2PreTrainedModel):
     def set_input_embeddings(self, new_embeddings):
         self.wte = new_embeddings
 
-    def forward(self, input_ids: torch.Tensor, past: torch.Tensor):
+    def forward(self, input_ids: torch.Tensor, past: KVCache = None):
+        """
+        Args:
+            input_ids (torch.Tensor): (length) tokens. There's no batch dimension.
+            past (KVCache, optional): The keys and values of the earlier tokens. They're added to in place.
+
+        Returns:
+            Tuple[torch.Tensor, KVCache]: The hidden states, and the keys and values of all of the tokens
+        """
         if input_ids is None:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
 
         input_len = input_ids.size(0)
-        past_length = past.size(-2) if past is not None else 0
+        past_length = past.length if past is not None else 0
         total_len = input_len + past_length
+        if past is None:
+            past = KVCache(self.config, min(total_len + KVCache.headroom, max(total_len, self.config.n_positions)),
+                           self.wte.weight.dtype, self.wte.weight.device)
+        past.reserve(total_len)
         position_embeds = self.wpe.weight.data[past_length:total_len]
 
         inputs_embeds = self.wte(input_ids)
         hidden_states = inputs_embeds + position_embeds
 
         mask = self.bigmask[None, past_length:total_len, :total_len]
-        presents = []
         for i in range(self.config.n_layer):
-            layer_past = past[i] if past is not None else None
-            trans_block = self.h[i]
-            hidden_states, present = trans_block(hidden_states, layer_past, mask)
-            presents.append(present)
+            hidden_states = self.h[i](hidden_states, past.buffer[i], past_length, mask)
+        past.length = total_len
 
         hidden_states = self.ln_f(hidden_states)
-        return hidden_states, torch.stack(presents)
+        return hidden_states, past
 
 
 class GPT2LMHeadModelExperimental(GPT2PreTrainedModel):
@@ -178,7 +231,7 @@ class GPT2LMHeadModelExperimental(GPT2PreTrainedModel):
         self._tie_or_clone_weights(self.lm_head,
                                    self.transformer.wte)
 
-    def forward(self, input_ids: torch.Tensor, **kwargs):
-        hidden_states, pasts = self.transformer(input_ids, **kwargs)
+    def forward(self, input_ids: torch.Tensor, past: KVCache = None):
+        hidden_states, pasts = self.transformer(input_ids, past)
         lm_logits = self.lm_head(hidden_states)
         return lm_logits, pasts
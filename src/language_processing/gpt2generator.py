@@ -4,6 +4,11 @@ With this module, you can give a start input to generate(), and it will continue
 The module was heavily streamlined from Clover Edition. Some experimental features were removed in the process, too.
 """
 
+import codecs
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
 from typing import Union
 
@@ -12,7 +17,10 @@ import torch.nn.functional as F
 from transformers import GPT2Tokenizer, GPT2LMHeadModel
 
 from src.getconfig import settings, logger, debug
+from .gpt2 import GPT2LMHeadModelExperimental, KVCache
+from .quantization import QUANTIZATIONS, load_quantized
 from .utils import format_result
+from .weight_cache import load_pretrained
 
 if not settings.getboolean('force-cpu') and not torch.cuda.is_available():
     logger.warning('CUDA is not available, you are limited to CPU only.')
@@ -25,55 +33,579 @@ logger.info('Cuda Available: {}    Force CPU: {}    Precision: {}'.format(torch.
 # warnings.filterwarnings("ignore")
 MODEL_CLASSES = {
     "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
-    # "gpt2-experimental": (GPT2LMHeadModelExperimental, GPT2Tokenizer),
+    "gpt2-experimental": (GPT2LMHeadModelExperimental, GPT2Tokenizer),
 }
 
+# How many speakers' whole contexts fit in the past key/values cache when its size isn't set
+PAST_CACHE_SPEAKERS = 4
+
 
 # the tokenizer does not preserve white space at the front of the string.
 # so we will append something else to the front of the string and then remove it after tokenization
+# The same lines are in every prompt of an NPC's conversation, so they're only tokenized once
+@lru_cache(maxsize=2 ** 12)
 def encode_prepend_newline(tokenizer, s):
-    return tokenizer.encode('====\n\n' + s)[2:]
+    return tuple(tokenizer.encode('====\n\n' + s)[2:])
+
+
+@lru_cache(maxsize=2 ** 10)
+def remove_newline(tokenizer, token):
+    """The token(s) that the first token of a prompt becomes without the newline that encode_prepend_newline() adds."""
+    return tuple(tokenizer.encode('====\n' + tokenizer.decode(token))[2:])
+
+
+class TokenSampler:
+    """Picks the next token for each sequence of a batch.
+
+    Does top-k and nucleus (top-p) filtering, dividing by the temperature and the repetition penalty from CTRL
+    (https://arxiv.org/abs/1909.05858), in that order, but only for the most likely tokens instead of the whole
+    vocabulary. Which tokens have been seen is kept in a presence mask, so the penalty is one masked division.
+
+    Args:
+        contexts (List[List[int]]): The tokens of each sequence so far. They are penalized for repetition.
+        vocab_size (int): Size of the model's vocabulary
+        temperature (float): 0 for greedy sampling
+        top_k (int): Keep only this many of the most likely tokens, or 0 for no limit
+        top_p (float): Keep the most likely tokens until their probabilities add up to this, or 0 for no limit
+        repetition_penalty (float): What to divide the logits of seen tokens by
+        device (torch.device): Where the logits are
+        num_candidates (int, optional): How many of the most likely tokens to look at first when top_k is 0. If their
+            probabilities don't add up to top_p, more are looked at.
+    """
+
+
+    def __init__(self, contexts, vocab_size, temperature=1, top_k=0, top_p=0.8, repetition_penalty=1.0, device="cpu",
+                 num_candidates=64):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.num_candidates = num_candidates
+        self.presence = torch.zeros((len(contexts), vocab_size), dtype=torch.bool, device=device)
+        for row, context in enumerate(contexts):
+            self.presence[row, torch.tensor(context, dtype=torch.long, device=device)] = True
+        # The distribution that the last tokens were sampled from, for debugging
+        self.last_probs = None
+        self.last_indices = None
+
+
+    def sample(self, logits, banned=None):
+        """Picks the next tokens, and marks them as seen.
+
+        Args:
+            logits (torch.Tensor): (batch, vocabulary) logits of the next tokens
+            banned (torch.Tensor, optional): (batch, vocabulary) or (vocabulary,) mask of the tokens that mustn't be
+                picked. The others are sampled as if the banned ones had never been possible.
+
+        Returns:
+            torch.Tensor: (batch,) the tokens
+        """
+        values, indices = self._penalized_candidates(logits, banned)
+
+        if self.temperature == 0:  # greedy sampling:
+            choices = torch.argmax(values, dim=-1, keepdim=True)
+        else:
+            self.last_probs = F.softmax(values, dim=-1)
+            self.last_indices = indices
+            choices = torch.multinomial(self.last_probs, num_samples=1)
+
+        tokens = choices if indices is None else indices.gather(-1, choices)
+        self.mark(tokens)
+        return tokens.squeeze(-1)
+
+
+    def probabilities(self, logits, banned=None):
+        """The probabilities that sample() would pick each token with, without picking any.
+
+        Args:
+            logits (torch.Tensor): (batch, vocabulary) logits of the next tokens
+            banned (torch.Tensor, optional): See sample()
+
+        Returns:
+            torch.Tensor: (batch, vocabulary) the probabilities. With a temperature of 0, the most likely token has 1.
+        """
+        values, indices = self._penalized_candidates(logits, banned)
+        if self.temperature == 0:
+            probs = torch.zeros_like(values).scatter_(-1, torch.argmax(values, dim=-1, keepdim=True), 1.0)
+        else:
+            probs = F.softmax(values, dim=-1)
+        if indices is None:
+            return probs
+        return torch.zeros_like(logits, dtype=probs.dtype).scatter_(-1, indices, probs)
+
+
+    def mark(self, tokens):
+        """Marks tokens as seen, for the repetition penalty.
+
+        Args:
+            tokens (torch.Tensor): (batch, n) tokens
+        """
+        self.presence.scatter_(-1, tokens, True)
+
 
+    def keep_rows(self, rows):
+        """Drops the sequences that are not in rows.
 
-def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
-    """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
         Args:
-            logits: logits distribution shape (batch size x vocabulary size)
-            top_k > 0: keep only top k tokens with highest probability (top-k filtering).
-            top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
-                Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
-        From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
+            rows (torch.Tensor): Indices of the sequences to keep
+        """
+        self.presence = self.presence.index_select(0, rows)
+
+
+    def _penalized_candidates(self, logits, banned=None):
+        logits = logits.float()
+        if banned is not None:
+            logits = logits.masked_fill(banned, -float("Inf"))
+        values, indices = self._candidates(logits)
+
+        values = values / (self.temperature if self.temperature > 0 else 1.0)
+
+        seen = self.presence if indices is None else self.presence.gather(-1, indices)
+        return torch.where(seen, values / self.repetition_penalty, values), indices
+
+
+    def _candidates(self, logits):
+        """Top-k/top-p filtering.
+
+        Returns:
+            Tuple[torch.Tensor, Optional[torch.Tensor]]: The logits of the most likely tokens, most likely first, with
+            the filtered ones set to -inf, and their indices in the vocabulary. The indices are None if the logits are
+            the whole vocabulary as is.
+        """
+        vocab_size = logits.size(-1)
+        if self.top_k > 0:
+            values, indices = torch.topk(logits, min(self.top_k, vocab_size), dim=-1)
+            if self.top_p <= 0.0:
+                return values, indices
+            cumulative_probs = torch.cumsum(F.softmax(values, dim=-1), dim=-1)
+        elif self.top_p > 0.0:
+            log_total = torch.logsumexp(logits, dim=-1, keepdim=True)
+            num_candidates = self.num_candidates
+            while True:
+                if num_candidates >= vocab_size:
+                    values, indices = torch.sort(logits, dim=-1, descending=True)
+                else:
+                    values, indices = torch.topk(logits, num_candidates, dim=-1)
+                cumulative_probs = torch.cumsum(torch.exp(values - log_total), dim=-1)
+                if num_candidates >= vocab_size or (cumulative_probs[:, -1] > self.top_p).all():
+                    break
+                # The candidates didn't cover top_p
+                num_candidates *= 16
+        else:
+            return logits, None
+
+        # Remove tokens with cumulative probability above the threshold, but keep the first one above it
+        to_remove = cumulative_probs > self.top_p
+        to_remove[..., 1:] = to_remove[..., :-1].clone()
+        to_remove[..., 0] = False
+        return values.masked_fill(to_remove, -float("Inf")), indices
+
+
+def past_length(pasts):
+    """How many tokens the past key/values cover, for both GPT2LMHeadModel and GPT2LMHeadModelExperimental."""
+    if isinstance(pasts, KVCache):
+        return pasts.length
+    return pasts[0].size(-2)
+
+
+def truncate_pasts(pasts, length):
+    """The past key/values of only the first length tokens. A KVCache is truncated in place."""
+    if isinstance(pasts, KVCache):
+        return pasts.truncate(length)
+    return tuple(past[..., :length, :] for past in pasts)
+
+
+def past_nbytes_per_token(config, dtype):
+    """How much memory the past key/values of a model take per token: a key and a value of n_embd elements in each layer.
+    That's about 600 KB for GPT-2 XL in float32."""
+    return config.n_layer * 2 * config.n_embd * torch.empty((), dtype=dtype).element_size()
+
+
+def pasts_nbytes(pasts):
+    """How much memory the past key/values take."""
+    if isinstance(pasts, KVCache):
+        return pasts.nbytes
+    return sum(past.element_size() * past.nelement() for past in pasts)
+
+
+class PastCache:
+    """Keeps the past key/values of earlier generations, keyed by speaker.
+
+    A speaker's next prompt usually begins with the same tokens as the previous one did, so the model only needs to be run
+    on the part after the common prefix. With speculative decoding, the draft model's past key/values are kept in the same
+    entry, so that it doesn't have to be run on the whole prompt again either. The least recently used entries are evicted
+    when over the memory budget.
+
+    Args:
+        max_bytes (int): How much memory the cached tensors may take in total
     """
-    top_k = min(top_k, logits.size(-1))  # Safety check
-    if top_k > 0:
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
-
-    if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        # scatter sorted tensors to original indexing
-        indices_to_remove = sorted_indices_to_remove.scatter(
-            dim=-1, index=sorted_indices, src=sorted_indices_to_remove
-        )
-        logits[indices_to_remove] = filter_value
-    return logits
 
 
-# length should be max length, other settings should be removed, device should not be set
-# we could possibly optimize this by having larger batch sizes but it would likely double or more the memory requirements
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (tokens, pasts, draft pasts, size in bytes)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.warned_too_big = False
+
+
+    def lookup(self, key, tokens):
+        """Finds the longest cached prefix of the given tokens.
+
+        The entry is taken out of the cache, as the pasts may be written to in place. It's put back by store().
+
+        Args:
+            key: The speaker or some other hashable identifier
+            tokens (List[int]): The prompt about to be run through the model
+
+        Returns:
+            Tuple[int, Optional[Union[Tuple[torch.Tensor], KVCache]], Optional[Union[Tuple[torch.Tensor], KVCache]]]: How
+            many tokens from the start are covered by the pasts, the pasts, and the draft model's pasts, which may cover
+            fewer tokens. At least one token is always left uncovered, so that the model has something to produce logits
+            for.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return 0, None, None
+            self._remove(key)
+        cached_tokens, pasts, draft_pasts, _ = entry
+
+        prefix_len = 0
+        for cached, new in zip(cached_tokens, tokens):
+            if cached != new:
+                break
+            prefix_len += 1
+        prefix_len = min(prefix_len, len(tokens) - 1)
+        if prefix_len <= 0:
+            return 0, None, None
+        if draft_pasts is not None:
+            draft_pasts = truncate_pasts(draft_pasts, min(past_length(draft_pasts), prefix_len))
+        return prefix_len, truncate_pasts(pasts, prefix_len), draft_pasts
+
+
+    def store(self, key, tokens, pasts, draft_pasts=None):
+        """Caches the pasts of a generation.
+
+        Args:
+            key: The speaker or some other hashable identifier
+            tokens (List[int]): The tokens that the pasts were computed for
+            pasts (Union[Tuple[torch.Tensor], KVCache]): The model's past key/values
+            draft_pasts (Union[Tuple[torch.Tensor], KVCache], optional): The draft model's past key/values, of the first
+                tokens
+        """
+        size = pasts_nbytes(pasts) + (pasts_nbytes(draft_pasts) if draft_pasts is not None else 0)
+        with self.lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                log = logger.debug if self.warned_too_big else logger.warning
+                log(f"The past key/values of {len(tokens)} tokens take {size / 2 ** 20:.1f} MB, more than the "
+                    f"{self.max_bytes / 2 ** 20:.0f} MB of kv-cache-mb, so they're not cached")
+                self.warned_too_big = True
+                return
+            while self.entries and self.total_bytes + size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+            self.entries[key] = (tokens, pasts, draft_pasts, size)
+            self.total_bytes += size
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[3]
+
+
+class StreamingDetokenizer:
+    """Decodes the tokens one at a time, giving the same text as tokenizer.decode() of all of them together.
+
+    Only the bytes of the new token are decoded. A character whose bytes are split between tokens is final only once all
+    of its bytes have arrived; until then, it's decoded like tokenizer.decode() would. Tokenizers with added tokens are not
+    supported.
+
+    Args:
+        tokenizer (GPT2Tokenizer): The tokenizer
+    """
+
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.special_ids = set(tokenizer.all_special_ids)
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors=tokenizer.errors)
+        self.chunks = []
+        self.final_length = 0
+        # The characters at the end that may still change with the next token
+        self.pending_text = ""
+
+
+    @property
+    def text(self):
+        """str: The text so far"""
+        return "".join(self.chunks) + self.pending_text
+
+
+    @property
+    def length(self):
+        """int: The length of the text so far"""
+        return self.final_length + len(self.pending_text)
+
+
+    def add_token(self, token):
+        """Adds the next token.
+
+        Args:
+            token (int): The token
+
+        Returns:
+            str: The characters that were finalized by the token. The ones that are still pending are in
+            pending_text.
+        """
+        new_text = self.decoder.decode(token_bytes(self.tokenizer, token)) if token not in self.special_ids else ""
+        self.chunks.append(new_text)
+        self.final_length += len(new_text)
+        self.pending_text = self.decoder.getstate()[0].decode("utf-8", errors=self.tokenizer.errors)
+        return new_text
+
+
+def token_bytes(tokenizer, token):
+    byte_decoder = tokenizer.byte_decoder
+    return bytes(byte_decoder[c] for c in tokenizer.convert_ids_to_tokens(token))
+
+
+def token_text(tokenizer, token):
+    """The token decoded on its own, like tokenizer.decode([token]). It doesn't skip special tokens when given one."""
+    return token_bytes(tokenizer, token).decode("utf-8", errors=tokenizer.errors)
+
+
+class StopTokenIndex:
+    """The tokens of a vocabulary that contain stop characters, or that a reply mustn't start with.
+
+    Built once for each tokenizer and set of characters by stop_token_index(), so that finding out whether a sampled
+    token stops the reply is a set lookup, instead of decoding it and searching its text.
+
+    Args:
+        tokenizer (GPT2Tokenizer): The tokenizer
+        disallowed_starts (Tuple[str]): See Continuation
+        stop_chars_included (Tuple[str]): See Continuation
+        stop_chars_not_included (Tuple[str]): See Continuation
+
+    Attributes:
+        disallowed_first (FrozenSet[int]): Tokens that the reply can't start with
+        stop_included (FrozenSet[int]): Tokens that contain one of stop_chars_included
+        stop_not_included (FrozenSet[int]): Tokens that contain one of stop_chars_not_included
+        empty_start (FrozenSet[int]): Tokens that make the result empty if they come before anything visible, because
+            they're in disallowed_first or they stop the reply before anything visible
+    """
+
+
+    def __init__(self, tokenizer, disallowed_starts, stop_chars_included, stop_chars_not_included):
+        disallowed_first, stop_included, stop_not_included, empty_start = [], [], [], []
+        for token in range(len(tokenizer)):
+            text = token_text(tokenizer, token)
+            if any(result_replace(text).startswith(ele) for ele in disallowed_starts):
+                disallowed_first.append(token)
+                empty_start.append(token)
+            if any(ele in text for ele in stop_chars_included):
+                stop_included.append(token)
+            if any(ele in text for ele in stop_chars_not_included):
+                stop_not_included.append(token)
+                # Like Continuation.add_token(), the first stop character in the order they're given in counts
+                place = next(text.find(ele) for ele in stop_chars_not_included if ele in text)
+                if not format_result(result_replace(text[:place])):
+                    empty_start.append(token)
+        self.disallowed_first = frozenset(disallowed_first)
+        self.stop_included = frozenset(stop_included)
+        self.stop_not_included = frozenset(stop_not_included)
+        self.empty_start = frozenset(empty_start)
+
+
+    @lru_cache(maxsize=2 ** 2)
+    def empty_start_mask(self, vocab_size, device):
+        """
+        Returns:
+            torch.Tensor: (vocab_size,) mask of empty_start, for TokenSampler.sample()
+        """
+        mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        mask[torch.tensor(sorted(self.empty_start), dtype=torch.long, device=device)] = True
+        return mask
+
+
+@lru_cache(maxsize=2 ** 4)
+def stop_token_index(tokenizer, disallowed_starts=('\"',), stop_chars_included=(),
+                     stop_chars_not_included=('\"', "\n")):
+    """The StopTokenIndex of a tokenizer. The characters must be tuples, so that the index can be cached."""
+    return StopTokenIndex(tokenizer, disallowed_starts, stop_chars_included, stop_chars_not_included)
+
+
+class StreamingFormatter:
+    """Keeps format_result(result_replace(text)) up to date for a text that only grows at the end.
+
+    No formatting rule matches across two adjacent letters or digits, except for "<br>" between "b" and "r". So the text
+    can be cut there, and both sides formatted separately. Everything before the last such cut is formatted only once.
+    """
+
+
+    def __init__(self):
+        self.formatted_head = ""
+        self.tail = ""
+
+
+    def update(self, new_text, pending_text=""):
+        """Adds text to the end.
+
+        Args:
+            new_text (str): The new characters that won't change anymore
+            pending_text (str, optional): Characters after them that may still change the next time
+
+        Returns:
+            str: The formatted text so far
+        """
+        tail = self.tail + new_text
+        cut = self._last_cut(tail)
+        if cut > 0:
+            if self.formatted_head:
+                self.formatted_head += format_result(replace_characters(tail[:cut]), strip=False)
+            else:
+                self.formatted_head = format_result(result_replace(tail[:cut]), strip=False).lstrip()
+            tail = tail[cut:]
+        self.tail = tail
+
+        if self.formatted_head:
+            return self.formatted_head + format_result(replace_characters(tail + pending_text), strip=False).rstrip()
+        return format_result(result_replace(tail + pending_text))
+
+
+    @staticmethod
+    def _last_cut(text):
+        for i in range(len(text) - 1, 0, -1):
+            if text[i - 1].isalnum() and text[i].isalnum() and text[i - 1:i + 1] != "br":
+                return i
+        return 0
+
+
+class Continuation:
+    """Turns the tokens sampled for one sequence into text, and decides when the sequence is finished.
+
+    Args:
+        tokenizer: The tokenizer to decode with
+        output (optional): Any object that has a set_text method. Receives the formatted text after every token.
+        disallowed_starts (Tuple[str]): If the text starts with one of these, the result is empty
+        stop_chars_included (Tuple[str]): Stop at these, including them in the result
+        stop_chars_not_included (Tuple[str]): Stop at these, excluding them from the result
+        stop_tokens (List[int], optional): Stop after these tokens, if they come late enough
+
+    Only the sampled tokens that contain stop characters are decoded on their own, which the vocabulary's StopTokenIndex
+    tells.
+    """
+
+
+    def __init__(self, tokenizer, output=None, disallowed_starts=('\"',), stop_chars_included=(),
+                 stop_chars_not_included=('\"', "\n"), stop_tokens=None):
+        self.tokenizer = tokenizer
+        self.output = output
+        self.disallowed_starts = disallowed_starts
+        self.disallowed_start_len = len(max(disallowed_starts, key=len, default=""))
+        self.stop_chars_included = stop_chars_included
+        self.stop_chars_not_included = stop_chars_not_included
+        self.stop_tokens = frozenset(stop_tokens) if stop_tokens is not None else None
+        self.index = stop_token_index(tokenizer, tuple(disallowed_starts), tuple(stop_chars_included),
+                                      tuple(stop_chars_not_included))
+        self.detokenizer = StreamingDetokenizer(tokenizer)
+        self.formatter = StreamingFormatter()
+        self.tokens = []
+        self.formatted_text = ""
+        self.finished = False
+
+
+    @property
+    def text(self):
+        """str: The plain decoded text"""
+        return self.detokenizer.text
+
+
+    def banned_tokens(self, vocab_size, device):
+        """The tokens that mustn't come next, so that the result isn't empty.
+
+        Until something visible has been generated, the tokens that would stop the reply or make it start with a
+        disallowed start are banned. This keeps the model from having to generate the reply again.
+
+        Returns:
+            Optional[torch.Tensor]: (vocab_size,) mask for TokenSampler.sample(), or None if every token is allowed
+        """
+        if self.formatted_text:
+            return None
+        return self.index.empty_start_mask(vocab_size, torch.device(device))
+
+
+    def add_token(self, token):
+        """Adds a newly sampled token.
+
+        Args:
+            token (int): The token
+
+        Returns:
+            bool: Whether the sequence is finished. The result is in formatted_text.
+        """
+        self.tokens.append(token)
+        previous_length = self.detokenizer.length
+        new_text = self.detokenizer.add_token(token)
+
+        if previous_length <= self.disallowed_start_len:
+            for ele in self.disallowed_starts:
+                if result_replace(self.text).startswith(ele):
+                    self.formatted_text = ""
+                    self.finished = True
+                    return True
+
+        if token in self.index.stop_not_included:
+            last_token = token_text(self.tokenizer, token)
+            for ele in self.stop_chars_not_included:
+                place = last_token.find(ele)
+                if place >= 0:
+                    return self._finish(self.formatted_text + last_token[:place])
+
+        if token in self.index.stop_included:
+            last_token = token_text(self.tokenizer, token)
+            for ele in self.stop_chars_included:
+                place = last_token.find(ele)
+                if place >= 0:
+                    return self._finish(self.formatted_text + last_token[:place + len(ele)])
+
+        self.formatted_text = self.formatter.update(new_text, self.detokenizer.pending_text)
+        if self.output is not None:
+            self.output.set_text(self.formatted_text)
+
+        # Why the minimum tokens. Because sometimes the models starts with whitespace, which will strip away anyway.
+        # Having a minimum amount of tokens before we stop usually means we don't just stop because of "\n " or similar
+        if self.stop_tokens is not None and len(self.tokens) > 5 and token in self.stop_tokens:
+            logger.debug(
+                "Stopping generation as we found stop tokens. One of `%s`, in '%s'. token generated `%s`",
+                self.stop_tokens,
+                token,
+                len(self.tokens) - 1,
+            )
+            self.finished = True
+        return self.finished
+
+
+    def _finish(self, text):
+        self.formatted_text = format_result(result_replace(text))
+        if self.output is not None:
+            self.output.set_text(self.formatted_text)
+        logger.debug("Generated result is: `%r`", self.text)
+        self.finished = True
+        return True
+
+
 def sample_sequence(
         model, length, context, temperature=1, top_k=0, top_p=0.8, repetition_penalty=1.0, device="cpu",
         disallowed_starts=('\"',), stop_chars_included=(), stop_chars_not_included=('\"', "\n"),
-        stop_tokens=None, tokenizer=None, output=None,
+        stop_tokens=None, tokenizer=None, output=None, past_cache=None, cache_key=None,
 ):
     """Actually generate the tokens"""
     logger.debug(f'temp: {temperature}    generate_num: {length}    rep-pen: {repetition_penalty}')
@@ -82,95 +614,257 @@ def sample_sequence(
     generated = context
     next_token = context
     pasts = None
-    formatted_text = ""
-    disallowed_start_len = len(max(disallowed_starts, key=len, default=""))
+    if past_cache is not None:
+        prefix_len, pasts, _ = past_cache.lookup(cache_key, context_tokens)
+        next_token = context[prefix_len:]
+        logger.debug(f'Reusing cached pasts for {prefix_len} of {len(context_tokens)} context tokens')
+    continuation = Continuation(tokenizer, output, disallowed_starts, stop_chars_included, stop_chars_not_included, stop_tokens)
+    sampler = TokenSampler([context_tokens], model.config.vocab_size, temperature, top_k, top_p, repetition_penalty, device)
     if debug.getboolean("nlp-debug"):
         print("\n")
         print("Token probabilities:")
-    with torch.no_grad():
-        for j in range(length):
-            input_ids_next = next_token
+    try:
+        with torch.no_grad():
+            for j in range(length):
+                input_ids_next = next_token
 
-            # Note: we could also use 'past' with GPT-2/Transfo-XL/XLNet/CTRL (cached hidden-states)
-            logits, pasts = model(input_ids=input_ids_next, past=pasts)
-            logits = logits[-1, :].float()
+                logits, pasts = model(input_ids=input_ids_next, past=pasts)
+                next_token = sampler.sample(logits[-1:, :], continuation.banned_tokens(model.config.vocab_size, device))
+                if debug.getboolean("nlp-debug") and sampler.last_probs is not None:
+                    for t, prob in enumerate(sampler.last_probs[0].tolist()):
+                        if prob > 0.001:
+                            token = t if sampler.last_indices is None else sampler.last_indices[0, t].item()
+                            print(f"{tokenizer.decode([token])}, {prob}")
+                    print("------------------")
 
-            # Originally the order was Temperature, Repetition Penalty, then top-k/p
-            logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+                generated = torch.cat((generated, next_token), dim=-1)
+                if continuation.add_token(next_token.item()):
+                    break
+    finally:
+        # The pasts cover every token that has been run through the model, i.e. all but the last sampled one
+        if past_cache is not None and pasts is not None:
+            past_cache.store(cache_key, generated.tolist()[:past_length(pasts)], pasts)
+    logger.debug("Generated result is: `%r`", continuation.formatted_text)
+    return continuation.formatted_text
 
-            logits = logits / (temperature if temperature > 0 else 1.0)
 
-            # repetition penalty from CTRL (https://arxiv.org/abs/1909.05858)
-            for k in set(generated.tolist()):
-                logits[k] /= repetition_penalty
+def sample_sequence_speculative(
+        model, draft_model, length, context, draft_tokens=4, temperature=1, top_k=0, top_p=0.8, repetition_penalty=1.0,
+        device="cpu", disallowed_starts=('\"',), stop_chars_included=(), stop_chars_not_included=('\"', "\n"),
+        stop_tokens=None, tokenizer=None, output=None, past_cache=None, cache_key=None,
+):
+    """Generates like sample_sequence(), but with speculative sampling (https://arxiv.org/abs/2211.17192).
 
-            if temperature == 0:  # greedy sampling:
-                next_token = torch.argmax(logits, dim=-1).unsqueeze(-1)
-            else:
-                tokens = F.softmax(logits, dim=-1)
-                if debug.getboolean("nlp-debug"):
-                    for t, token in enumerate(tokens):
-                        if token.item() > 0.001:
-                            print(f"{tokenizer.decode([t])}, {token.item()}")
-                    print("------------------")
+    The draft model, which must have the same vocabulary, proposes draft_tokens tokens one at a time, and the model checks
+    all of them in one forward pass. Each proposed token is accepted with probability min(1, p / q), where p and q are the
+    probabilities that the model and the draft model give it, after the same temperature, top-k/top-p filtering and
+    repetition penalty. At the first rejected one, a token is sampled from the normalized max(0, p - q) instead, and if
+    all of them are accepted, one more is sampled from the model. This way the tokens are distributed exactly as if they
+    were sampled from the model alone, but the model runs once for up to draft_tokens + 1 tokens.
 
-                next_token = torch.multinomial(
-                    tokens, num_samples=1
-                )
+    Returns:
+        str: The formatted result
+    """
+    logger.debug(f'temp: {temperature}    generate_num: {length}    rep-pen: {repetition_penalty}    '
+                 f'draft tokens: {draft_tokens}')
+    tokens = list(context)
+    pasts = draft_pasts = None
+    if past_cache is not None:
+        prefix_len, pasts, draft_pasts = past_cache.lookup(cache_key, tokens)
+        logger.debug(f'Reusing cached pasts for {prefix_len} of {len(tokens)} context tokens, and draft pasts for '
+                     f'{past_length(draft_pasts) if draft_pasts is not None else 0}')
+    continuation = Continuation(tokenizer, output, disallowed_starts, stop_chars_included, stop_chars_not_included, stop_tokens)
+    sampler = TokenSampler([tokens], model.config.vocab_size, temperature, top_k, top_p, repetition_penalty, device)
+    accepted_count = proposed_count = 0
+    try:
+        with torch.no_grad():
+            generated = 0
+            while generated < length:
+                # Until the reply has visibly started, tokens are picked one at a time, with the banned ones masked
+                banned = continuation.banned_tokens(model.config.vocab_size, device)
+                num_drafts = min(draft_tokens, length - generated - 1) if banned is None else 0
+                presence = sampler.presence.clone()
 
-            generated = torch.cat((generated, next_token), dim=-1)
-            # Decode into plain text
-            o = generated[len(context_tokens):].tolist()
-            generated.text = tokenizer.decode(
-                o, clean_up_tokenization_spaces=False, skip_special_tokens=True
-            )
+                # The draft model proposes tokens, like sample_sequence() would pick them
+                drafts, draft_probs = [], []
+                for _ in range(num_drafts):
+                    start = past_length(draft_pasts) if draft_pasts is not None else 0
+                    input_ids = torch.tensor((tokens + drafts)[start:], dtype=torch.long, device=device)
+                    logits, draft_pasts = draft_model(input_ids=input_ids, past=draft_pasts)[:2]
+                    probs = sampler.probabilities(logits[-1:, :])
+                    if temperature == 0:
+                        draft = torch.argmax(probs, dim=-1, keepdim=True)
+                    else:
+                        draft = torch.multinomial(probs, num_samples=1)
+                    sampler.mark(draft)
+                    drafts.append(draft.item())
+                    draft_probs.append(probs[0])
 
-            # Check whether stop characters were in there
-            last_token = tokenizer.decode(o[-1], clean_up_tokenization_spaces=False, skip_special_tokens=True)
+                # The model checks them all at once
+                start = past_length(pasts) if pasts is not None else 0
+                input_ids = torch.tensor((tokens + drafts)[start:], dtype=torch.long, device=device)
+                logits, pasts = model(input_ids=input_ids, past=pasts)[:2]
+                logits = logits[-(num_drafts + 1):, :]
 
-            if len(generated.text) - len(last_token) <= disallowed_start_len:
-                for ele in disallowed_starts:
-                    if result_replace(generated.text).startswith(ele):
-                        return ""
+                sampler.presence = presence
+                new_tokens = []
+                for i, draft in enumerate(drafts):
+                    probs = sampler.probabilities(logits[i:i + 1, :])[0]
+                    if torch.rand(()).item() * draft_probs[i][draft] < probs[draft]:
+                        new_tokens.append(draft)
+                        sampler.mark(torch.tensor([[draft]], device=device))
+                        continue
+                    # Rejected. The probability that's missing from the draft model's distribution is sampled instead.
+                    residual = torch.clamp(probs - draft_probs[i], min=0)
+                    if residual.sum() <= 0:
+                        residual = probs
+                    new_tokens.append(torch.multinomial(residual, num_samples=1).item())
+                    break
+                else:
+                    probs = sampler.probabilities(logits[-1:, :], banned)[0]
+                    new_tokens.append(torch.multinomial(probs, num_samples=1).item())
+                sampler.mark(torch.tensor([new_tokens[-1:]], device=device))
+                accepted_count += len(new_tokens) - 1
+                proposed_count += num_drafts
 
-            for ele in stop_chars_not_included:
-                place = last_token.find(ele)
-                if place >= 0:
-                    formatted_text = format_result(result_replace(formatted_text + last_token[:place]))
-                    if output is not None:
-                        output.set_text(formatted_text)
-                    logger.debug("Generated result is: `%r`", generated.text)
-                    return formatted_text
+                # Both models only keep the key/values of the tokens that were accepted
+                kept = len(tokens) + len(new_tokens) - 1
+                pasts = truncate_pasts(pasts, min(past_length(pasts), kept))
+                if draft_pasts is not None:
+                    draft_pasts = truncate_pasts(draft_pasts, min(past_length(draft_pasts), kept))
 
-            for ele in stop_chars_included:
-                place = last_token.find(ele)
-                if place >= 0:
-                    formatted_text = format_result(result_replace(formatted_text + last_token[:place + len(ele)]))
-                    if output is not None:
-                        output.set_text(formatted_text)
-                    logger.debug("Generated result is: `%r`", generated.text)
-                    return formatted_text
-
-            formatted_text = format_result(result_replace(generated.text))
-            if output is not None:
-                output.set_text(formatted_text)
-
-            if (
-                    (stop_tokens is not None)
-                    and (j > 4)
-                    and (next_token[0] in stop_tokens)
-            ):
-                # Why the minimum tokens, j>X. Because sometimes the models starts with whitespace, which will strip away anyway.
-                # Having a minimum amount of tokens before we stop usually means we don't just stop because of "\n " or similar
-                logger.debug(
-                    "Stopping generation as we found stop tokens. One of `%s`, in '%s'. token generated `%s`",
-                    stop_tokens,
-                    next_token,
-                    j,
-                )
+                finished = False
+                for token in new_tokens:
+                    tokens.append(token)
+                    generated += 1
+                    if continuation.add_token(token):
+                        finished = True
+                        break
+                if finished:
+                    break
+    finally:
+        if past_cache is not None and pasts is not None:
+            past_cache.store(cache_key, tokens[:past_length(pasts)], pasts, draft_pasts)
+    if proposed_count:
+        logger.debug(f"Accepted {accepted_count} of {proposed_count} draft tokens")
+    logger.debug("Generated result is: `%r`", continuation.formatted_text)
+    return continuation.formatted_text
+
+
+def masked_forward(model, input_ids, pasts, attention_mask, position_ids):
+    """Runs GPT2LMHeadModel with an attention mask that covers the past tokens too.
+
+    GPT2Model.forward() reshapes the attention mask to the length of input_ids, so it can't mask the pasts. This relies on
+    the transformer blocks of transformers 2.3.0, so benchmarks/nlp_batching.py checks that it gives the same logits for
+    left padded batches as the model's own forward() gives for each sequence alone.
+
+    Args:
+        model (GPT2LMHeadModel): The model
+        input_ids (torch.Tensor): (batch, length) tokens
+        pasts (List[torch.Tensor], optional): The key/values of the earlier tokens, like GPT2Model.forward() returns them
+        attention_mask (torch.Tensor): (batch, past length + length) ones for tokens to attend to, and zeros for padding
+        position_ids (torch.Tensor): (batch, length) positions of the tokens
+
+    Returns:
+        Tuple[torch.Tensor, Tuple[torch.Tensor]]: The logits, and the key/values of all of the tokens
+    """
+    transformer = model.transformer
+    if pasts is None:
+        pasts = [None] * len(transformer.h)
+    mask = attention_mask[:, None, None, :].to(dtype=next(model.parameters()).dtype)
+    mask = (1.0 - mask) * -10000.0
+    hidden_states = transformer.drop(transformer.wte(input_ids) + transformer.wpe(position_ids))
+    presents = ()
+    for block, layer_past in zip(transformer.h, pasts):
+        hidden_states, present = block(hidden_states, layer_past=layer_past, attention_mask=mask)[:2]
+        presents = presents + (present,)
+    return model.lm_head(transformer.ln_f(hidden_states)), presents
+
+
+def pad_batch(contexts, device="cpu"):
+    """Pads token lists from the left into a batch for masked_forward().
+
+    Args:
+        contexts (List[List[int]]): The token lists
+        device (str, optional): Where to put the tensors
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: The input_ids, attention_mask and position_ids of the batch
+    """
+    max_len = max(len(context) for context in contexts)
+    # The padding token doesn't matter, because it's masked out
+    input_ids = torch.tensor([[0] * (max_len - len(context)) + context for context in contexts], dtype=torch.long, device=device)
+    attention_mask = torch.tensor([[0] * (max_len - len(context)) + [1] * len(context) for context in contexts],
+                                  dtype=torch.long, device=device)
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    return input_ids, attention_mask, position_ids
+
+
+def sample_sequence_batch(
+        model, length, contexts, temperature=1, top_k=0, top_p=0.8, repetition_penalty=1.0, device="cpu",
+        disallowed_starts=('\"',), stop_chars_included=(), stop_chars_not_included=('\"', "\n"),
+        stop_tokens=None, tokenizer=None, outputs=None,
+):
+    """Generates continuations for several contexts at once, running the model once per step for all of them.
+
+    The contexts are padded from the left and masked. Each sequence stops on its own, like in sample_sequence(), and
+    finished sequences are dropped from the batch.
+
+    Returns:
+        List[str]: The results, in the same order as the contexts
+    """
+    logger.debug(f'temp: {temperature}    generate_num: {length}    rep-pen: {repetition_penalty}    batch: {len(contexts)}')
+    outputs = outputs if outputs is not None else [None] * len(contexts)
+    input_ids, attention_mask, position_ids = pad_batch(contexts, device)
+
+    continuations = [Continuation(tokenizer, output, disallowed_starts, stop_chars_included, stop_chars_not_included,
+                                  stop_tokens) for output in outputs]
+    sampler = TokenSampler(contexts, model.config.vocab_size, temperature, top_k, top_p, repetition_penalty, device)
+    allowed = torch.zeros(model.config.vocab_size, dtype=torch.bool, device=device)
+    active = list(range(len(contexts)))
+    pasts = None
+    with torch.no_grad():
+        for j in range(length):
+            logits, pasts = masked_forward(model, input_ids, pasts, attention_mask, position_ids)
+            banned = [continuations[i].banned_tokens(model.config.vocab_size, device) for i in active]
+            if all(mask is None for mask in banned):
+                banned = None
+            else:
+                banned = torch.stack([mask if mask is not None else allowed for mask in banned])
+            next_tokens = sampler.sample(logits[:, -1, :], banned)
+
+            unfinished_rows = []
+            for row, (i, token) in enumerate(zip(active, next_tokens.tolist())):
+                if not continuations[i].add_token(token):
+                    unfinished_rows.append(row)
+            if not unfinished_rows:
                 break
-    logger.debug("Generated result is: `%r`", formatted_text)
-    return formatted_text
+
+            if len(unfinished_rows) < len(active):
+                keep = torch.tensor(unfinished_rows, dtype=torch.long, device=device)
+                pasts = [past.index_select(1, keep) for past in pasts]
+                attention_mask = attention_mask.index_select(0, keep)
+                position_ids = position_ids.index_select(0, keep)
+                next_tokens = next_tokens.index_select(0, keep)
+                sampler.keep_rows(keep)
+                active = [active[row] for row in unfinished_rows]
+
+            input_ids = next_tokens.unsqueeze(-1)
+            attention_mask = torch.cat((attention_mask, attention_mask.new_ones((len(active), 1))), dim=-1)
+            position_ids = position_ids[:, -1:] + 1
+
+    results = [continuation.formatted_text for continuation in continuations]
+    logger.debug("Generated results are: `%r`", results)
+    return results
+
+
+def replace_characters(result):
+    """The part of result_replace() that doesn't depend on where the text starts."""
+    #        result = result.replace('."', '".')
+    result = result.replace("#", "")
+    result = result.replace("*", "")
+    # TODO look at this I think blank lines should be fine or blacklisted at generation time
+    return result.replace("\n\n", "\n")
 
 
 def result_replace(result):
@@ -179,13 +873,9 @@ def result_replace(result):
     if len(result) == 0:
         return ""
     first_letter_capitalized = result[0].isupper()
-    #        result = result.replace('."', '".')
-    result = result.replace("#", "")
-    result = result.replace("*", "")
-    # TODO look at this I think blank lines should be fine or blacklisted at generation time
-    result = result.replace("\n\n", "\n")
+    result = replace_characters(result)
 
-    if not first_letter_capitalized:
+    if result and not first_letter_capitalized:
         result = result[0].lower() + result[1:]
 
     # this is annoying since we can already see the AIs output
@@ -194,17 +884,46 @@ def result_replace(result):
     return result
 
 
+def generator_settings():
+    """
+    Returns:
+        dict: The arguments for GPT2Generator from config.ini, except for the model path
+    """
+    return {
+        "generate_num": settings.getint("generate-num"),
+        "temperature": settings.getfloat("temp"),
+        "repetition_penalty": settings.getfloat("rep-pen"),
+        "past_cache_mb": settings.getint("kv-cache-mb"),
+        "weight_cache": settings.getboolean("weight-cache"),
+        "model_type": settings.get("nlp-model-type"),
+        "quantize": settings.get("quantize"),
+        "draft_model_path": Path("language_models", settings.get("draft-model")) if settings.get("draft-model") else None,
+        "draft_tokens": settings.getint("draft-tokens"),
+    }
+
+
 class GPT2Generator:
     def __init__(
             self, generate_num=60, temperature=0.4, top_k=0, top_p=0.8, dtype=DTYPE,
             model_path: Union[str, Path] = Path('models', 'pytorch-gpt2-xl-aid2-v5'), repetition_penalty=1.2,
+            past_cache_mb=0, weight_cache=True, model_type="gpt2", quantize="none", draft_model_path=None,
+            draft_tokens=4,
     ):
+        """
+        Args:
+            past_cache_mb (int, optional): How much memory the past key/values of the speakers' earlier generations may
+                take in megabytes, together with the draft model's. 0 fits the whole context of PAST_CACHE_SPEAKERS
+                speakers.
+            draft_model_path (Path, optional): A smaller model with the same vocabulary. If given, generate() lets it
+                propose draft_tokens tokens at a time, which the model checks at once (see sample_sequence_speculative)
+        """
         self.generate_num = generate_num
         self.temp = temperature
         self.top_k = top_k
         self.top_p = top_p
         self.dtype = dtype
         self.repetition_penalty = repetition_penalty
+        self.draft_tokens = draft_tokens
         self.max_history_tokens = 1024 - generate_num
 
         if isinstance(model_path, Path):
@@ -220,20 +939,71 @@ class GPT2Generator:
         logger.info(
             "Using device={}, checkpoint={}, dtype={}".format(self.device, str(self.checkpoint_path), self.dtype))
 
+        if quantize not in QUANTIZATIONS:
+            raise ValueError(f"quantize must be one of {QUANTIZATIONS}, got {quantize}")
+        if quantize != "none" and self.device.type != "cpu":
+            logger.warning("Quantization is only supported on the CPU, so it's not used. Turn on force-cpu to use it.")
+            quantize = "none"
+        # Identifies what the answers depend on, e.g. for caching them
+        self.model_id = f"{self.checkpoint_path.name} {model_type} {quantize} {str(self.dtype).replace('torch.', '')}"
+
         # Load tokenizer and model
-        model_class, tokenizer_class = MODEL_CLASSES["gpt2"]
+        model_class, tokenizer_class = MODEL_CLASSES[model_type]
         self.tokenizer = tokenizer_class.from_pretrained(str(self.checkpoint_path))
-        self.model = model_class.from_pretrained(str(self.checkpoint_path))
-        self.model.to(self.dtype).to(self.device)
-        self.model.eval()
+        self.stop_tokens = self.tokenizer.encode(["<|endoftext|>", ">"])
+        # Built now, rather than when the first reply is generated
+        stop_token_index(self.tokenizer)
+        self.model = self._load_model(model_class, self.checkpoint_path, quantize, weight_cache)
+
+        self.draft_model = None
+        if draft_model_path is not None:
+            if not draft_model_path.exists():
+                raise FileNotFoundError(f"Could not find the draft model {draft_model_path}")
+            logger.info(f"Using draft model {draft_model_path}, {draft_tokens} tokens at a time")
+            self.draft_model = self._load_model(model_class, draft_model_path, quantize, weight_cache)
+            if self.draft_model.config.vocab_size != self.model.config.vocab_size:
+                raise ValueError(f"The draft model's vocabulary ({self.draft_model.config.vocab_size} tokens) must be "
+                                 f"the model's ({self.model.config.vocab_size} tokens)")
+
+        if past_cache_mb > 0:
+            past_cache_bytes = past_cache_mb * 2 ** 20
+        else:
+            nbytes_per_token = sum(past_nbytes_per_token(model.config, self.dtype)
+                                   for model in (self.model, self.draft_model) if model is not None)
+            past_cache_bytes = PAST_CACHE_SPEAKERS * self.model.config.n_positions * nbytes_per_token
+        logger.info(f"Caching up to {past_cache_bytes / 2 ** 20:.0f} MB of past key/values")
+        self.past_cache = PastCache(past_cache_bytes)
+
+
+    def _load_model(self, model_class, path, quantize, weight_cache):
+        if quantize == "int8":
+            model = load_quantized(model_class, path, cache=weight_cache)
+        elif weight_cache:
+            model = load_pretrained(model_class, path, self.dtype)
+        else:
+            model = model_class.from_pretrained(str(path))
+            model.to(self.dtype)
+        model.to(self.device)
+        model.eval()
+        return model
 
 
     def generate(
             self, tokens, generate_num=None, temperature=None, top_k=None, top_p=None,
-            repetition_penalty=None, stop_tokens=None, depth=0, output=None
+            repetition_penalty=None, stop_tokens=None, output=None, cache_key=None
     ):
+        """Continues the given tokens.
+
+        Tokens that would make the result empty are not sampled until the reply has visibly started, so the result is
+        only empty if nothing visible was generated at all.
+
+        Args:
+            cache_key (optional): If given, the model's past key/values are cached under this key (e.g. the speaker), and
+                the next call with the same key only runs the part of the tokens that differs from this call through the
+                model
+        """
         if stop_tokens is None:
-            stop_tokens = self.tokenizer.encode(["<|endoftext|>", ">"])
+            stop_tokens = self.stop_tokens
 
         assert (temperature is not None)
         assert repetition_penalty
@@ -248,7 +1018,13 @@ class GPT2Generator:
         top_p = top_p if top_p is not None else self.top_p
         repetition_penalty = repetition_penalty if repetition_penalty is not None else self.repetition_penalty
 
-        result = sample_sequence(
+        if self.draft_model is not None:
+            speculative_kwargs = dict(draft_model=self.draft_model, draft_tokens=self.draft_tokens)
+            sample = sample_sequence_speculative
+        else:
+            speculative_kwargs = {}
+            sample = sample_sequence
+        result = sample(
             model=self.model,
             context=tokens,
             length=generate_num,
@@ -260,49 +1036,122 @@ class GPT2Generator:
             stop_tokens=stop_tokens,
             tokenizer=self.tokenizer,
             output=output,
+            past_cache=self.past_cache if cache_key is not None else None,
+            cache_key=cache_key,
+            **speculative_kwargs,
         )
 
         if len(result) == 0:
-            if depth < 20:
-                logger.info("Model generated empty text trying again %r", depth)
-                return self.generate(
-                    tokens, generate_num=generate_num, temperature=temperature, top_p=top_p, top_k=top_k,
-                    repetition_penalty=repetition_penalty, depth=depth + 1, output=output
-                )
-            else:
-                logger.warn(
-                    "Model generated empty text %r times. Try another action", depth
-                )
+            logger.warning("Model generated empty text. Try another action")
         return result
 
 
+    def generate_batch(
+            self, token_lists, generate_num=None, temperature=None, top_k=None, top_p=None,
+            repetition_penalty=None, stop_tokens=None, outputs=None
+    ):
+        """Continues several token lists at once. Each one is continued like generate() would.
+
+        The model is run once per step for all of the sequences, which is a lot cheaper than running it for each of them.
+        The past key/value cache of generate() is not used.
+        GPT2LMHeadModelExperimental has no batch dimension, so with it, the token lists are continued one at a time.
+
+        Args:
+            token_lists (List[List[int]]): The tokens to continue
+            outputs (List, optional): Objects with a set_text method, one for each token list
+
+        Returns:
+            List[str]: The results, in the same order as token_lists
+        """
+        if stop_tokens is None:
+            stop_tokens = self.stop_tokens
+
+        assert (temperature is not None)
+        assert repetition_penalty
+
+        generate_num = generate_num if (generate_num is not None) else self.generate_num
+        temperature = temperature if (temperature is not None) else self.temp
+        top_k = top_k if top_k is not None else self.top_k
+        top_p = top_p if top_p is not None else self.top_p
+        repetition_penalty = repetition_penalty if repetition_penalty is not None else self.repetition_penalty
+        outputs = outputs if outputs is not None else [None] * len(token_lists)
+
+        if isinstance(self.model, GPT2LMHeadModelExperimental):
+            return [self.generate(
+                tokens, generate_num=generate_num, temperature=temperature, top_p=top_p, top_k=top_k,
+                repetition_penalty=repetition_penalty, stop_tokens=stop_tokens, output=output
+            ) for tokens, output in zip(token_lists, outputs)]
+
+        results = sample_sequence_batch(
+            model=self.model,
+            contexts=token_lists,
+            length=generate_num,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            device=self.device,
+            stop_tokens=stop_tokens,
+            tokenizer=self.tokenizer,
+            outputs=outputs,
+        )
+
+        if not all(results):
+            logger.warning("Model generated empty text in a batch. Try another action")
+        return results
+
+
+    def line_length(self, line):
+        """
+        Args:
+            line (str): A line for memory_merge()
+
+        Returns:
+            int: How many tokens the line takes in a prompt
+        """
+        return len(encode_prepend_newline(self.tokenizer, line))
+
+
     def memory_merge(self, *args):
-        result = self._memory_merge(*args)
-        assert (result)
-        first, *rest = result
-        # Finally remove the very first newline by doing some trickery
-        return self.tokenizer.encode('====\n' + self.tokenizer.decode(first))[2:] + rest
+        """Puts together a prompt from strings and lists of strings, each on a line of its own.
+
+        Args:
+            *args (Union[str, List[str]]): e.g. the context, the short-term memory, and what was said
+
+        Returns:
+            List[int]: The tokens of the prompt
+        """
+        tokens = list(chain.from_iterable(self._memory_merge(*args)))
+        assert (tokens)
+        # Finally remove the very first newline
+        return list(remove_newline(self.tokenizer, tokens[0])) + tokens[1:]
 
 
     def _memory_merge(self, *args):
-        merge_objects = [[]] * len(args)
-        reversed_args = reversed(args)
+        """Picks the lines that fit in max_history_tokens. Strings are always included, and then the last lines of the
+        lists, as many as fit.
+
+        Returns:
+            List[Tuple[int]]: The tokens of each line, in order
+        """
+        merge_objects = [[] for _ in args]  # The lines of each argument, the last one first
         length = 0
         max_len = 0
 
         # Prioritize arguments that were plain strings, not lists
-        for i, arg in enumerate(reversed_args, start=1):
+        for i in reversed(range(len(args))):
+            arg = args[i]
             if isinstance(arg, str):
                 new_tokens = encode_prepend_newline(self.tokenizer, arg)
                 length += len(new_tokens)
                 if length > self.max_history_tokens:
-                    return sum(merge_objects, [])
-                merge_objects[-i] = new_tokens
+                    return self._merged_lines(merge_objects)
+                merge_objects[i].append(new_tokens)
             else:
                 max_len = max(len(arg), max_len)
 
         for i in range(1, max_len + 1):
-            for j, arg in enumerate(args, start=1):
+            for j, arg in enumerate(args):
                 if isinstance(arg, str):
                     continue
                 if len(arg) < i:
@@ -310,7 +1159,12 @@ class GPT2Generator:
                 new_tokens = encode_prepend_newline(self.tokenizer, arg[-i])
                 length += len(new_tokens)
                 if length > self.max_history_tokens:
-                    return sum(merge_objects, [])
-                merge_objects[j] = new_tokens + merge_objects[j]
+                    return self._merged_lines(merge_objects)
+                merge_objects[j].append(new_tokens)
+
+        return self._merged_lines(merge_objects)
+
 
-        return sum(merge_objects, [])
+    @staticmethod
+    def _merged_lines(merge_objects):
+        return [line for lines in merge_objects for line in reversed(lines)]
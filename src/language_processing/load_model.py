@@ -7,14 +7,26 @@ import torch
 from direct.stdpy import threading
 from panda3d.core import PNMImage, Filename
 
-from src.getconfig import settings
-from src.language_processing.gpt2generator import GPT2Generator
+from src.getconfig import settings, logger
+from src.language_processing.gpt2generator import GPT2Generator, generator_settings
+from src.language_processing.nlp_process import GeneratorProcess
+from src.language_processing.nlp_server import GeneratorClient
 from src.gui.menu import Menu
 
 
 def load_language_model(notice_text_obj, menu_img, return_value):
+    server_url = settings.get("nlp-server")
+    if server_url:
+        # The model is already loaded by the server
+        try:
+            return_value.append(GeneratorClient(server_url))
+            return
+        except OSError as e:
+            logger.warning("Could not connect to the language model server at %s, loading the model instead: %s",
+                           server_url, e)
+
     model_dir = "language_models"
-    models = [x for x in Path(model_dir).iterdir() if x.is_dir()]
+    models = [x for x in Path(model_dir).iterdir() if x.is_dir() and x.name != settings.get("draft-model")]
     failed_env_load = False
     while True:
         try:
@@ -55,7 +67,7 @@ def load_language_model(notice_text_obj, menu_img, return_value):
                                        "subfolder"
                 base.graphicsEngine.render_frame()
                 # Scan for models again
-                models = [x for x in Path(model_dir).iterdir() if x.is_dir()]
+                models = [x for x in Path(model_dir).iterdir() if x.is_dir() and x.name != settings.get("draft-model")]
             else:
                 failed_env_load = True
                 notice_text_obj.text = "Model could not be loaded. Please try another model."
@@ -72,9 +84,7 @@ def _nlp_model_chosen(model, notice_text_obj, return_value):
     load_nlp_task = threading.Thread(target=_load_generator, kwargs={
         "return_value": return_value,
         "model_path": model,
-        "generate_num": settings.getint("generate-num"),
-        "temperature": settings.getfloat("temp"),
-        "repetition_penalty": settings.getfloat("rep-pen")})
+        **generator_settings()})
     load_nlp_task.start()
 
     while load_nlp_task.is_alive():
@@ -87,4 +97,5 @@ def _nlp_model_chosen(model, notice_text_obj, return_value):
 
 
 def _load_generator(return_value="", **kwargs):
-    return_value.append(GPT2Generator(**kwargs))
+    generator_class = GeneratorProcess if settings.getboolean("nlp-process") else GPT2Generator
+    return_value.append(generator_class(**kwargs))
@@ -1,20 +1,23 @@
 # Credit: AI Dungeon 2: Clover Edition
 
 import traceback
+from collections import deque
 from datetime import datetime
 from os import _exit
-from queue import PriorityQueue
+from queue import PriorityQueue, Empty
 
 from direct.stdpy import thread, threading
 
 from src.getconfig import settings, debug
+from .response_cache import ResponseCache
 
 
-def act(generator, tokens, output=None):
+def act(generator, tokens, output=None, cache_key=None):
     temperature = settings.getfloat('temp')
     repetition_penalty = settings.getfloat('rep-pen')
     try:
-        return generator.generate(tokens, temperature=temperature, repetition_penalty=repetition_penalty, output=output)
+        return generator.generate(tokens, temperature=temperature, repetition_penalty=repetition_penalty, output=output,
+                                  cache_key=cache_key)
 
     except Exception as e:
         print()
@@ -33,11 +36,109 @@ def act(generator, tokens, output=None):
         return ""
 
 
+def act_batch(generator, token_lists, outputs=None):
+    temperature = settings.getfloat('temp')
+    repetition_penalty = settings.getfloat('rep-pen')
+    try:
+        return generator.generate_batch(token_lists, temperature=temperature, repetition_penalty=repetition_penalty,
+                                        outputs=outputs)
+
+    except Exception as e:
+        print()
+        print("Natural language processing has crashed!")
+        print("Batch of " + str(len(token_lists)) + " token lists: " + str(token_lists))
+        print("Temperature: " + str(temperature))
+        print("Repetition penalty: " + str(repetition_penalty))
+        print()
+        traceback.print_exc()
+        print(e)
+
+        if debug.getboolean("nlp-debug"):
+            # Probably a bad idea, but for now hastens the debugging process
+            _exit(1)
+        return [""] * len(token_lists)
+
+
+class TextStream:
+    """Carries what the language model generates from the worker threads to the main thread.
+
+    The worker threads push events without locking, and the main thread handles them once per frame in apply(). This way
+    the scene graph is only touched from the main thread, and each speech field is updated at most once per frame, however
+    many tokens were generated in between.
+    """
+
+
+    def __init__(self):
+        self.events = deque()  # Appending and popping are thread-safe
+
+
+    def output_for(self, speech_field):
+        """Gets an output for the generator, which streams the texts that it's given into the speech field.
+
+        Args:
+            speech_field: Any object that has a set_text method
+
+        Returns:
+            StreamedOutput: The output
+        """
+        return StreamedOutput(self, speech_field)
+
+
+    def push_text(self, speech_field, text):
+        self.events.append((speech_field, text))
+
+
+    def push_finished(self, speech_task, result, line_lengths):
+        self.events.append((speech_task, (result, line_lengths)))
+
+
+    def apply(self):
+        """Sets the latest text of each speech field that has a new one, and gives back the finished speech tasks.
+
+        Call this from the main thread.
+
+        Returns:
+            List[Tuple[SpeechTask, str, List[int]]]: The speech tasks that were finished, with their results and the
+            lengths of the lines they're remembered as, see NLPManager.finished_lines()
+        """
+        latest_texts = {}
+        finished = []
+        for _ in range(len(self.events)):
+            target, text = self.events.popleft()
+            if isinstance(target, SpeechTask):
+                finished.append((target, *text))
+            else:
+                latest_texts[target] = text
+        for speech_field, text in latest_texts.items():
+            speech_field.set_text(text)
+        return finished
+
+
+class StreamedOutput:
+    """An output for the generator that streams into a speech field through a TextStream.
+
+    Args:
+        stream (TextStream): The stream
+        speech_field: Any object that has a set_text method
+    """
+
+
+    def __init__(self, stream, speech_field):
+        self.stream = stream
+        self.speech_field = speech_field
+
+
+    def set_text(self, text):
+        self.stream.push_text(self.speech_field, text)
+
+
 class SpeechTask:
     def __init__(self, priority, speaker, text):
         self.priority = priority
         self.speaker = speaker
         self.text = text
+        self.response_key = None  # Set if the answer may be taken from, and stored in, the response cache
+        self.result = None  # Set once it's answered
 
 
     def __lt__(self, obj):
@@ -68,39 +169,134 @@ class SpeechTask:
 class NLPManager:
     lock = threading.Lock()  # Just in case
     talking_speed = 5  # How long (in characters per second) the speech bubble should stay visible
+    context = "You are speaking to a person called Tabula Rasa."
+    prompt = "Tabula Rasa answers: \""
 
 
-    def __init__(self, generator):
+    def __init__(self, generator, num_threads=1, max_batch_size=None, response_cache=None):
+        """
+        Args:
+            generator (Union[GPT2Generator, GeneratorProcess]): The language model
+            num_threads (int, optional): How many threads to generate with. Each thread takes all of the queued
+                speech tasks at once, up to max_batch_size, so more threads would only split them into smaller batches
+                that run the same model at the same time and compete for the same cores.
+            max_batch_size (int, optional): How many speech tasks a thread may answer at once. Defaults to the
+                nlp-batch-size setting.
+            response_cache (ResponseCache, optional): Where to reuse answers from, for speakers that allow it or when the
+                temperature is 0. Defaults to one made from the response-cache settings, if its size isn't 0.
+        """
         self.queue = PriorityQueue()
         self.wait_queue = []
+        self.text_stream = TextStream()
         self.generator = generator
-        for _ in range(4):
+        self.max_batch_size = max_batch_size if max_batch_size is not None else settings.getint("nlp-batch-size")
+        if response_cache is None and settings.getint("response-cache-size") > 0:
+            response_cache = ResponseCache(settings.getint("response-cache-size"), settings.get("response-cache-file"))
+        self.response_cache = response_cache
+        for _ in range(num_threads):
             thread.start_new_thread(self.thread_loop, args=())
 
 
+    def get_speech_tasks(self):
+        """Waits for a speech task, and then takes the ones that are already queued too, up to max_batch_size.
+
+        Returns:
+            List[SpeechTask]: The speech tasks, by priority
+        """
+        speech_tasks = [self.queue.get(block=True)]
+        while len(speech_tasks) < self.max_batch_size:
+            try:
+                speech_tasks.append(self.queue.get(block=False))
+            except Empty:
+                break
+        return speech_tasks
+
+
     def thread_loop(self):
         while True:
-            speech_task = self.queue.get(block=True)
+            speech_tasks = self.get_speech_tasks()
+
             # talking_started = datetime.now()
-            context = "You are speaking to a person called Tabula Rasa."
-            prompt = f"Tabula Rasa answers: \""
+            token_lists = [self.generator.memory_merge(self.context, speech_task.speaker.short_term_memory.lines(),
+                                                       speech_task.text, self.prompt)
+                           for speech_task in speech_tasks]
+            if len(speech_tasks) == 1:
+                # Alone, the speaker's cached past key/values can be reused
+                results = [act(self.generator, token_lists[0], output=self.text_stream.output_for(speech_tasks[0].speaker.speech_field),
+                               cache_key=speech_tasks[0].speaker)]
+            else:
+                results = act_batch(self.generator, token_lists,
+                                    outputs=[self.text_stream.output_for(speech_task.speaker.speech_field)
+                                             for speech_task in speech_tasks])
+
+            for speech_task, result in zip(speech_tasks, results):
+                speech_task.result = result
+                # Measured here, so that the main thread never has to wait for the generator, which may be in another
+                # process or on a server
+                line_lengths = [self.generator.line_length(line) for line in self.finished_lines(speech_task)]
+                if speech_task.response_key is not None:
+                    self.response_cache.store(speech_task.response_key, result, line_lengths)
+                self.text_stream.push_finished(speech_task, result, line_lengths)
+
+
+    def finish_speech_task(self, speech_task, result, line_lengths):
+        """Remembers what was said, and lets the speaker talk again. Called from the main thread.
+
+        Args:
+            speech_task (SpeechTask): The speech task
+            result (str): What was answered
+            line_lengths (List[int]): The lengths of finished_lines() in tokens
+        """
+        on_screen_time = max(30.0 / self.talking_speed, len(result) / self.talking_speed)
+        with self.lock:
+            for line, length in zip(self.finished_lines(speech_task), line_lengths):
+                speech_task.speaker.short_term_memory.append(line, length)
+            speech_task.speaker.speech_field.hide_task = taskMgr.doMethodLater(on_screen_time, speech_task.speaker.hide_speech_field,
+                                                                               'HSB', extraArgs=[])
+            speech_task.speaker.can_talk_more = True
+
+
+    def finished_lines(self, speech_task):
+        """The lines that an answered speech task is remembered as."""
+        return speech_task.text, self.answer_line(speech_task.result)
 
-            result = act(self.generator, self.generator.memory_merge(context, speech_task.speaker.short_term_memory, speech_task.text,
-                                                                     prompt),
-                         output=speech_task.speaker.speech_field)
 
-            on_screen_time = max(30.0 / self.talking_speed, len(result) / self.talking_speed)
-            with self.lock:
-                speech_task.speaker.short_term_memory.append(speech_task.text)
-                speech_task.speaker.short_term_memory.append(prompt + result + '\"')
-                speech_task.speaker.speech_field.hide_task = taskMgr.doMethodLater(on_screen_time, speech_task.speaker.hide_speech_field,
-                                                                                   'HSB', extraArgs=[])
-                speech_task.speaker.can_talk_more = True
+    def answer_line(self, result):
+        """The line that an answer is remembered as."""
+        return self.prompt + result + '\"'
+
+
+    def response_key(self, speech_task):
+        """The key of the answer in the response cache, made from everything that the answer depends on.
+
+        Args:
+            speech_task (SpeechTask): The speech task
+
+        Returns:
+            Optional[str]: The key, or None if the answer shouldn't be reused
+        """
+        temperature = settings.getfloat('temp')
+        if self.response_cache is None or (temperature != 0 and not speech_task.speaker.allow_response_reuse):
+            return None
+        sampling = [temperature, settings.getfloat('rep-pen'), self.generator.top_k, self.generator.top_p,
+                    self.generator.generate_num]
+        return ResponseCache.make_key(self.generator.model_id, self.context, speech_task.speaker.short_term_memory.lines(),
+                                      speech_task.text, self.prompt, sampling)
 
 
     def _put_in_queue(self, task):
-        self.queue.put(task)
         task.speaker.can_talk_more = False
+        task.response_key = self.response_key(task)
+        if task.response_key is not None:
+            cached = self.response_cache.lookup(task.response_key)
+            if cached is not None:
+                # Answered without the language model or the worker threads, and shown and finished on the next frame
+                # like a generated answer
+                task.result, line_lengths = cached
+                self.text_stream.output_for(task.speaker.speech_field).set_text(task.result)
+                self.text_stream.push_finished(task, task.result, line_lengths)
+                return
+        self.queue.put(task)
 
 
     def new_speech_task(self, speaker, text):
@@ -117,14 +313,17 @@ class NLPManager:
 
 
     def update(self):
-        """Bookkeeping that needs to be done every frame
+        """Bookkeeping that needs to be done every frame, including showing what has been generated since the last frame
         """
+        for speech_task, result, line_lengths in self.text_stream.apply():
+            self.finish_speech_task(speech_task, result, line_lengths)
+
         i = 0
         with self.lock:
             while i < len(self.wait_queue):
                 if self.wait_queue[i].speaker.can_talk_more:
                     speech_task = self.wait_queue.pop(i)
                     speech_task.priority = datetime.now()
-                    self._put_in_queue(task)
+                    self._put_in_queue(speech_task)
                 else:
                     i += 1
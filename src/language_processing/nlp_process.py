@@ -0,0 +1,161 @@
+"""Running the language model in a process of its own
+
+Tokenizing, the sampling loop and formatting the text are Python code that holds the GIL. In the game's process, that
+takes time away from rendering, however the work is divided between threads. GeneratorProcess moves all of that into a
+child process, and NLPManager's threads only wait for it to send back what it generated.
+"""
+
+import multiprocessing
+import threading
+import traceback
+
+from src.getconfig import logger
+from .gpt2generator import GPT2Generator, MODEL_CLASSES, encode_prepend_newline
+
+
+class ConnectionOutput:
+    """An output for the generator in the child process, which sends the texts that it's given to the game's process.
+
+    Args:
+        connection (multiprocessing.connection.Connection): The child process's end of the pipe
+        index (int): Which of the outputs of the request this is
+    """
+
+
+    def __init__(self, connection, index):
+        self.connection = connection
+        self.index = index
+
+
+    def set_text(self, text):
+        self.connection.send(("text", self.index, text))
+
+
+def send_error(connection, exception):
+    try:
+        connection.send(("error", exception, traceback.format_exc()))
+    except Exception:
+        # The exception couldn't be pickled
+        connection.send(("error", RuntimeError(repr(exception)), traceback.format_exc()))
+
+
+def serve(connection, generator_kwargs):
+    """The main function of the child process. Loads the generator, and then answers requests until the pipe is closed.
+
+    Each request is a (method, args, kwargs) tuple. It's answered with any number of ("text", output index, text)
+    messages, and then ("result", result) or ("error", exception, traceback).
+
+    Args:
+        connection (multiprocessing.connection.Connection): The child process's end of the pipe
+        generator_kwargs (dict): Arguments for GPT2Generator
+    """
+    try:
+        generator = GPT2Generator(**generator_kwargs)
+    except Exception as e:
+        send_error(connection, e)
+        return
+    connection.send(("result", {name: getattr(generator, name) for name in GeneratorProcess.attributes}))
+
+    while True:
+        try:
+            method, args, kwargs = connection.recv()
+        except EOFError:  # The game has quit
+            return
+        # The outputs can't be sent to this process, so only whether there is one is sent, and the texts are sent back
+        if "output" in kwargs:
+            kwargs["output"] = ConnectionOutput(connection, 0) if kwargs["output"] else None
+        if kwargs.get("outputs") is not None:
+            kwargs["outputs"] = [ConnectionOutput(connection, i) if output else None
+                                 for i, output in enumerate(kwargs["outputs"])]
+        try:
+            if method not in GeneratorProcess.methods:
+                raise AttributeError(f"GPT2Generator.{method} can't be called through GeneratorProcess")
+            result = getattr(generator, method)(*args, **kwargs)
+        except Exception as e:
+            send_error(connection, e)
+        else:
+            connection.send(("result", result))
+
+
+class GeneratorProcess:
+    """GPT2Generator in a child process, with the same methods and attributes that NLPManager uses.
+
+    The process is started with the spawn method, so that it doesn't inherit the game's window or threads. It's a daemon
+    process, so it's stopped when the game quits. One method call is handled at a time.
+
+    Args:
+        **generator_kwargs: Arguments for GPT2Generator. The tokenizer is loaded from its model_path in this process too,
+            for line_length().
+    """
+    methods = ("generate", "generate_batch", "memory_merge")
+    attributes = ("model_id", "generate_num", "temp", "top_k", "top_p", "repetition_penalty", "max_history_tokens")
+
+
+    def __init__(self, **generator_kwargs):
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve, args=(child_connection, generator_kwargs), name="nlp-worker",
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.lock = threading.Lock()
+
+        # Waits until the model has been loaded, and raises the same error as GPT2Generator would have if it couldn't be
+        try:
+            self.__dict__.update(self._receive())
+        except EOFError as e:
+            raise RuntimeError(f"The language model's process has stopped (exit code {self.process.exitcode})") from e
+        tokenizer_class = MODEL_CLASSES[generator_kwargs.get("model_type", "gpt2")][1]
+        self.tokenizer = tokenizer_class.from_pretrained(str(generator_kwargs["model_path"]))
+
+
+    def generate(self, tokens, output=None, cache_key=None, **kwargs):
+        # The speaker can't be sent to the child process. It's only used as a key, so its id will do.
+        cache_key = id(cache_key) if cache_key is not None else None
+        return self._call("generate", (tokens,), dict(kwargs, output=output is not None, cache_key=cache_key),
+                          [output])
+
+
+    def generate_batch(self, token_lists, outputs=None, **kwargs):
+        outputs = outputs if outputs is not None else [None] * len(token_lists)
+        return self._call("generate_batch", (token_lists,),
+                          dict(kwargs, outputs=[output is not None for output in outputs]), outputs)
+
+
+    def memory_merge(self, *args):
+        return self._call("memory_merge", args, {})
+
+
+    def line_length(self, line):
+        """Like GPT2Generator.line_length(), but in this process, so that it doesn't wait for a generation to finish."""
+        return len(encode_prepend_newline(self.tokenizer, line))
+
+
+    def close(self):
+        """Stops the child process."""
+        with self.lock:
+            self.connection.close()
+        self.process.join(timeout=5)
+
+
+    def _call(self, method, args, kwargs, outputs=()):
+        with self.lock:
+            try:
+                self.connection.send((method, args, kwargs))
+                return self._receive(outputs)
+            except (EOFError, OSError) as e:
+                raise RuntimeError(f"The language model's process has stopped (exit code {self.process.exitcode})") from e
+
+
+    def _receive(self, outputs=()):
+        while True:
+            message = self.connection.recv()
+            if message[0] == "text":
+                _, index, text = message
+                outputs[index].set_text(text)
+            elif message[0] == "result":
+                return message[1]
+            else:
+                _, exception, child_traceback = message
+                logger.error("Error in the language model's process:\n%s", child_traceback)
+                raise exception
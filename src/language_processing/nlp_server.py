@@ -0,0 +1,354 @@
+"""A local inference server for the language model, and a client for it
+
+The server loads the model once and keeps it loaded, so the game can be restarted without loading the model again, and
+several games on the same computer can share it. The requests of all clients are generated together in batches when
+they have the same sampling settings.
+
+Start the server from the root directory of SpecuSim, and set nlp-server in config.ini to its address:
+    python3 -m src.language_processing.nlp_server --model language_models/model_v5
+
+The protocol is JSON over HTTP. GET /info gives the generator's settings. POST /memory_merge and /line_length take the
+arguments of the GPT2Generator methods of the same name, and answer with {"result": ...}. POST /generate takes token
+lists and streams back JSON lines: {"text": ..., "index": ...} as the text of a token list grows, and finally
+{"result": [...]} or {"error": ...}.
+"""
+
+import argparse
+import http.client
+import json
+import queue
+import threading
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from src.getconfig import settings, logger
+from .gpt2generator import GPT2Generator, generator_settings
+
+DEFAULT_PORT = 8765
+# The generator's attributes that NLPManager uses
+ATTRIBUTES = ("model_id", "generate_num", "temp", "top_k", "top_p", "repetition_penalty", "max_history_tokens")
+# The keyword arguments of GPT2Generator.generate() that clients may set
+SAMPLING_KEYS = ("temperature", "repetition_penalty", "top_k", "top_p")
+
+
+def sampling_settings(sampling):
+    """Checks the sampling settings of a request.
+
+    Args:
+        sampling (dict): Keyword arguments for GPT2Generator.generate(), from the client
+
+    Returns:
+        dict: The same settings
+
+    Raises:
+        ValueError: If they aren't numbers for the keys in SAMPLING_KEYS
+    """
+    if not isinstance(sampling, dict):
+        raise ValueError(f"The sampling settings must be an object, not {sampling!r}")
+    for key, value in sampling.items():
+        if key not in SAMPLING_KEYS:
+            raise ValueError(f"Unknown sampling setting {key!r}. Only {', '.join(SAMPLING_KEYS)} may be given.")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"The sampling setting {key!r} must be a number, not {value!r}")
+    return sampling
+
+
+class Job:
+    """Token lists to continue for one request.
+
+    Args:
+        token_lists (List[List[int]]): The tokens to continue
+        sampling (dict): Keyword arguments for GPT2Generator.generate(), see SAMPLING_KEYS
+        streamed (List[bool]): Whether to stream the text of each token list
+        cache_key (str, optional): The key of the past key/value cache, if there's one token list
+    """
+
+
+    def __init__(self, token_lists, sampling, streamed, cache_key=None):
+        self.token_lists = token_lists
+        self.sampling = sampling
+        self.outputs = [JobOutput(self, i) if stream else None for i, stream in enumerate(streamed)]
+        self.cache_key = cache_key
+        self.events = queue.Queue()  # Dictionaries to send to the client as JSON lines
+        # Jobs with the same sampling settings can be generated in the same batch
+        self.batch_key = json.dumps(sampling, sort_keys=True)
+
+
+class JobOutput:
+    """An output for the generator, which passes the texts that it's given on to the request's handler."""
+
+
+    def __init__(self, job, index):
+        self.job = job
+        self.index = index
+
+
+    def set_text(self, text):
+        self.job.events.put({"text": text, "index": self.index})
+
+
+class BatchingGenerator:
+    """Runs the jobs of all requests on one generator, in a thread of its own.
+
+    The jobs that are waiting are generated together, up to max_batch_size token lists at a time, if their sampling
+    settings are the same. Otherwise they're generated in the order that they came in.
+
+    Args:
+        generator (GPT2Generator): The language model
+        max_batch_size (int): How many token lists to generate at once
+    """
+
+
+    def __init__(self, generator, max_batch_size):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.pending = deque()  # Jobs taken from the queue, but not generated yet
+        threading.Thread(target=self.loop, name="nlp-server-generator", daemon=True).start()
+
+
+    def submit(self, job):
+        self.queue.put(job)
+
+
+    def next_batch(self):
+        """Waits for jobs, and takes the oldest one and the ones that can be generated with it.
+
+        Returns:
+            List[Job]: The jobs
+        """
+        if not self.pending:
+            self.pending.append(self.queue.get())
+        while True:
+            try:
+                self.pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        batch = [self.pending.popleft()]
+        size = len(batch[0].token_lists)
+        for job in list(self.pending):
+            if job.batch_key == batch[0].batch_key and size + len(job.token_lists) <= self.max_batch_size:
+                self.pending.remove(job)
+                batch.append(job)
+                size += len(job.token_lists)
+        return batch
+
+
+    def loop(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                if len(batch) == 1 and len(batch[0].token_lists) == 1:
+                    # Alone, the cached past key/values can be reused
+                    job = batch[0]
+                    results = [self.generator.generate(job.token_lists[0], output=job.outputs[0], cache_key=job.cache_key,
+                                                       **job.sampling)]
+                else:
+                    results = self.generator.generate_batch([tokens for job in batch for tokens in job.token_lists],
+                                                            outputs=[output for job in batch for output in job.outputs],
+                                                            **batch[0].sampling)
+            except Exception:
+                logger.error("Generation failed:\n%s", traceback.format_exc())
+                for job in batch:
+                    job.events.put({"error": traceback.format_exc()})
+                continue
+
+            for job in batch:
+                job.events.put({"result": results[:len(job.token_lists)]})
+                results = results[len(job.token_lists):]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = "SpecuSimNLP/1.0"
+
+
+    def do_GET(self):
+        if self.path == "/info":
+            self.send_json({name: getattr(self.server.generator, name) for name in ATTRIBUTES})
+        else:
+            self.send_error(404)
+
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        except (TypeError, ValueError):
+            self.send_error(400)
+            return
+
+        generator = self.server.generator
+        try:
+            if self.path == "/memory_merge":
+                self.send_json({"result": generator.memory_merge(*request["args"])})
+            elif self.path == "/line_length":
+                self.send_json({"result": generator.line_length(request["line"])})
+            elif self.path == "/generate":
+                job = Job(request["token_lists"], sampling_settings(request.get("sampling", {})), request["streamed"],
+                          request.get("cache_key"))
+                self.server.batching_generator.submit(job)
+                self.stream_job(job)
+            else:
+                self.send_error(404)
+        except (KeyError, TypeError, ValueError):
+            self.send_error(400, explain=traceback.format_exc())
+
+
+    def send_json(self, value):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def stream_job(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        while True:
+            event = job.events.get()
+            try:
+                self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+            except OSError:  # The client has gone, e.g. the game was closed. The job is finished anyway.
+                pass
+            if "text" not in event:
+                return
+
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """An HTTP server for a GPT2Generator. Each request is handled in a thread of its own.
+
+    Args:
+        address (Tuple[str, int]): The host and port to listen on
+        generator (GPT2Generator): The language model
+        max_batch_size (int): How many token lists to generate at once
+    """
+    daemon_threads = True
+
+
+    def __init__(self, address, generator, max_batch_size):
+        super().__init__(address, RequestHandler)
+        self.generator = generator
+        self.batching_generator = BatchingGenerator(generator, max_batch_size)
+
+
+class GeneratorClient:
+    """GPT2Generator on an inference server, with the same methods and attributes that NLPManager uses.
+
+    Args:
+        url (str): The server's address, e.g. http://127.0.0.1:8765
+        timeout (float): How many seconds to wait for the server to answer
+        stream_timeout (float): How many seconds to wait for the next part of a generation. This includes waiting for
+            the generations of other clients that are ahead in the server's queue, and the whole generation if the text
+            isn't streamed.
+    """
+    max_cached_lines = 2 ** 12
+
+
+    def __init__(self, url, timeout=60.0, stream_timeout=300.0):
+        address = urlsplit(url if "//" in url else "//" + url)
+        self.host = address.hostname or "127.0.0.1"
+        self.port = address.port or DEFAULT_PORT
+        self.timeout = timeout
+        self.stream_timeout = stream_timeout
+        # Distinguishes the past key/value cache keys of this client from those of other clients
+        self.client_id = uuid.uuid4().hex
+        self.line_lengths = OrderedDict()
+        self.lock = threading.Lock()
+        self.__dict__.update(self._request("GET", "/info"))
+
+
+    def generate(self, tokens, output=None, cache_key=None, **kwargs):
+        cache_key = f"{self.client_id} {id(cache_key)}" if cache_key is not None else None
+        return self._generate([tokens], [output], kwargs, cache_key)[0]
+
+
+    def generate_batch(self, token_lists, outputs=None, **kwargs):
+        outputs = outputs if outputs is not None else [None] * len(token_lists)
+        return self._generate(token_lists, outputs, kwargs)
+
+
+    def memory_merge(self, *args):
+        return self._request("POST", "/memory_merge", {"args": args})["result"]
+
+
+    def line_length(self, line):
+        """Like GPT2Generator.line_length(). Cached in this process, as it's called for every line that's remembered."""
+        with self.lock:
+            if line in self.line_lengths:
+                self.line_lengths.move_to_end(line)
+                return self.line_lengths[line]
+        length = self._request("POST", "/line_length", {"line": line})["result"]
+        with self.lock:
+            self.line_lengths[line] = length
+            if len(self.line_lengths) > self.max_cached_lines:
+                self.line_lengths.popitem(last=False)
+        return length
+
+
+    def _generate(self, token_lists, outputs, sampling, cache_key=None):
+        request = {"token_lists": token_lists, "streamed": [output is not None for output in outputs],
+                   "sampling": sampling, "cache_key": cache_key}
+        # A server that has stopped answering raises a TimeoutError, instead of blocking the thread forever
+        connection, response = self._open("POST", "/generate", request, self.stream_timeout)
+        try:
+            for line in response:
+                event = json.loads(line)
+                if "text" in event:
+                    outputs[event["index"]].set_text(event["text"])
+                elif "result" in event:
+                    return event["result"]
+                else:
+                    raise RuntimeError("Generation failed on the server:\n" + event["error"])
+            raise ConnectionError("The server closed the connection before the generation was finished")
+        finally:
+            connection.close()
+
+
+    def _request(self, method, path, value=None):
+        connection, response = self._open(method, path, value, self.timeout)
+        try:
+            return json.loads(response.read())
+        finally:
+            connection.close()
+
+
+    def _open(self, method, path, value, timeout):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        body = json.dumps(value).encode("utf-8") if value is not None else None
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        if response.status != 200:
+            message = response.read().decode("utf-8", errors="replace")
+            connection.close()
+            raise ConnectionError(f"The server answered {response.status} {response.reason}: {message}")
+        return connection, response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", type=Path, required=True, help="Directory of the model")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--batch-size", type=int, default=settings.getint("nlp-batch-size"),
+                        help="How many replies to generate at once")
+    args = parser.parse_args()
+
+    generator = GPT2Generator(model_path=args.model, **generator_settings())
+    server = InferenceServer((args.host, args.port), generator, args.batch_size)
+    print(f"Serving {args.model} on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""8-bit quantization of language models, for running them on the CPU
+
+With dynamic quantization, the weights of the linear layers are stored as 8-bit integers, and the activations are
+quantized on the fly. That takes about a quarter of the memory of 32-bit floats, and matrix multiplications on the CPU are
+faster. GPT-2 uses Conv1D layers, which are linear layers with transposed weights, so they're converted first.
+
+Quantizing a model takes a while and needs the 32-bit model in memory, so the result is cached next to the model's own
+files, as quantized_int8_<model class>.pt and .json.
+"""
+
+import json
+from pathlib import Path
+
+import torch
+import transformers.modeling_utils
+
+from src.getconfig import logger
+from . import gpt2
+
+try:
+    from torch.ao.quantization import quantize_dynamic
+    from torch.ao.nn.quantized.dynamic import Linear as QuantizedLinear
+except ImportError:
+    # Older versions of PyTorch
+    from torch.quantization import quantize_dynamic
+    from torch.nn.quantized.dynamic import Linear as QuantizedLinear
+
+QUANTIZATIONS = ("none", "int8")
+CONV1D_CLASSES = (transformers.modeling_utils.Conv1D, gpt2.Conv1D)
+
+
+def conv1d_to_linear(conv):
+    """Converts a Conv1D layer into the equivalent Linear layer.
+
+    Args:
+        conv (Conv1D): The layer, with a (in_features, out_features) weight
+
+    Returns:
+        torch.nn.Linear: The layer, with a (out_features, in_features) weight
+    """
+    in_features, out_features = conv.weight.shape
+    linear = torch.nn.Linear(in_features, out_features, dtype=conv.weight.dtype, device=conv.weight.device)
+    with torch.no_grad():
+        linear.weight.copy_(conv.weight.T)
+        linear.bias.copy_(conv.bias)
+    return linear
+
+
+def replace_modules(model, should_replace, replace):
+    """Replaces every submodule for which should_replace(module) is true with replace(module), in place."""
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if should_replace(child):
+                setattr(module, child_name, replace(child))
+
+
+def quantize_model(model):
+    """Quantizes a model's linear and Conv1D layers to 8-bit integers, in place.
+
+    The output embeddings get a quantized copy of their own, so they're no longer tied to the input embeddings.
+
+    Args:
+        model: e.g. GPT2LMHeadModel, with 32-bit weights on the CPU
+
+    Returns:
+        The model
+    """
+    replace_modules(model, lambda module: isinstance(module, CONV1D_CLASSES), conv1d_to_linear)
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+class QuantizedCache:
+    """A quantized model, stored for one model class.
+
+    It's considered out of date if pytorch_model.bin changes.
+
+    Args:
+        model_path (Path): The directory of the model
+        model_class: e.g. GPT2LMHeadModel
+    """
+
+
+    def __init__(self, model_path, model_class):
+        self.model_path = Path(model_path)
+        self.model_class = model_class
+        name = f"quantized_int8_{model_class.__name__}"
+        self.data_path = self.model_path / f"{name}.pt"
+        self.index_path = self.model_path / f"{name}.json"
+        self.source_path = self.model_path / "pytorch_model.bin"
+
+
+    def is_valid(self):
+        """Checks whether the cache exists and was made from the current pytorch_model.bin.
+
+        Returns:
+            bool: Whether the cache can be loaded
+        """
+        if not self.data_path.exists() or not self.index_path.exists():
+            return False
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return index.get("source") == self._source_info() and index.get("data_size") == self.data_path.stat().st_size
+
+
+    def save(self, model):
+        """Writes the cache.
+
+        Args:
+            model: The model, quantized with quantize_model()
+        """
+        temporary_path = self.data_path.with_suffix(".tmp")
+        torch.save(model.state_dict(), temporary_path)
+        temporary_path.replace(self.data_path)
+        # The index is written last, so that an interrupted save is never mistaken for a valid cache
+        with open(self.index_path, "w") as f:
+            json.dump({"source": self._source_info(), "data_size": self.data_path.stat().st_size}, f)
+
+
+    def load_model(self):
+        """Creates the quantized model, without initializing or quantizing any weights of its own.
+
+        Returns:
+            The model
+        """
+        config = self.model_class.config_class.from_pretrained(str(self.model_path))
+        try:
+            state_dict = torch.load(self.data_path, mmap=True)
+            # Without allocating or initializing the weights, as they'll be replaced anyway
+            with torch.device("meta"):
+                model = self.model_class(config)
+        except (AttributeError, TypeError):
+            # Older versions of PyTorch
+            state_dict = torch.load(self.data_path)
+            model = self.model_class(config)
+
+        # The same layers as after quantize_model(), to load the quantized weights into
+        replace_modules(model, lambda module: isinstance(module, CONV1D_CLASSES),
+                        lambda conv: QuantizedLinear(*conv.weight.shape, dtype=torch.qint8))
+        replace_modules(model, lambda module: type(module) is torch.nn.Linear,
+                        lambda linear: QuantizedLinear(linear.in_features, linear.out_features,
+                                                       bias_=linear.bias is not None, dtype=torch.qint8))
+        try:
+            model.load_state_dict(state_dict, assign=True)
+        except TypeError:
+            model.load_state_dict(state_dict)
+        return model
+
+
+    def _source_info(self):
+        stat = self.source_path.stat()
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def load_quantized(model_class, model_path, cache=True):
+    """Loads a model with its linear layers quantized to 8-bit integers, quantizing it first if needed.
+
+    Args:
+        model_class: e.g. GPT2LMHeadModel
+        model_path (Path): The directory of the model
+        cache (bool): Whether to load the quantized model from the disk, and save it there if it isn't yet
+
+    Returns:
+        The model, on the CPU
+    """
+    quantized_cache = QuantizedCache(model_path, model_class)
+    if cache and quantized_cache.is_valid():
+        return quantized_cache.load_model()
+
+    logger.info("Quantizing %s. This may take a while.", model_path)
+    model = model_class.from_pretrained(str(model_path))
+    model.to(torch.float32)
+    model.eval()
+    quantize_model(model)
+    if cache:
+        try:
+            quantized_cache.save(model)
+        except OSError as e:
+            logger.warning("Could not write the quantized model: %s", e)
+    return model
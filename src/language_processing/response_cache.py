@@ -0,0 +1,146 @@
+"""Reuse of earlier answers, for NPCs that are asked the same things with the same memories"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from src.getconfig import logger
+
+
+class ResponseCache:
+    """Remembers the answers that the language model gave, keyed by everything that the answer depends on.
+
+    Each answer is kept with the lengths of the lines that it's remembered as, so that a speaker can remember it without
+    asking the language model. The least recently used answers are evicted when there are more than max_entries. If a path is given, the answers are
+    also appended to that file, and loaded from it the next time. The file is compacted when it has grown to twice
+    max_entries lines.
+
+    Example:
+        key = ResponseCache.make_key(model_id, context, memory_lines, text, prompt, sampling_settings)
+        cached = cache.lookup(key)
+        if cached is None:
+            result = generate()
+            cache.store(key, result, line_lengths(result))
+        else:
+            result, lengths = cached
+
+    Args:
+        max_entries (int): How many answers to keep
+        path (Path, optional): A JSON lines file to keep the answers in between sessions
+    """
+
+
+    def __init__(self, max_entries, path=None):
+        self.max_entries = max_entries
+        self.path = Path(path) if path else None
+        self.entries = OrderedDict()  # key -> (result, line_lengths)
+        self.file_lines = 0
+        self.lock = threading.Lock()
+        if self.path is not None and self.path.exists():
+            self._load()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    @staticmethod
+    def make_key(*parts):
+        """Makes a key from anything that can be converted into JSON. It's the same in every session.
+
+        Returns:
+            str: The key
+        """
+        return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+    def lookup(self, key):
+        """
+        Args:
+            key (str): See make_key()
+
+        Returns:
+            Optional[Tuple[str, List[int]]]: The cached answer and the lengths of its lines, if there is one
+        """
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+            return cached
+
+
+    def store(self, key, result, line_lengths):
+        """Caches an answer. Empty answers are not cached, as they mean that the generation failed.
+
+        Args:
+            key (str): See make_key()
+            result (str): The answer
+            line_lengths (List[int]): The lengths in tokens of the lines that the answer is remembered as, see
+                NLPManager.finished_lines()
+        """
+        if not result:
+            return
+        with self.lock:
+            self._add(key, result, line_lengths)
+            if self.path is not None:
+                try:
+                    if self.file_lines >= 2 * self.max_entries:
+                        self._compact()
+                    else:
+                        with open(self.path, "a", encoding="utf-8") as f:
+                            f.write(self._file_line(key, (result, line_lengths)))
+                        self.file_lines += 1
+                except OSError as e:
+                    logger.warning("Could not write the response cache, it's only kept in memory: %s", e)
+                    self.path = None
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.path is not None:
+                try:
+                    self._compact()
+                except OSError as e:
+                    logger.warning("Could not write the response cache, it's only kept in memory: %s", e)
+                    self.path = None
+
+
+    def _add(self, key, result, line_lengths):
+        self.entries[key] = (result, list(line_lengths))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    self.file_lines += 1
+                    try:
+                        entry = json.loads(line)
+                        self._add(entry["key"], entry["result"], entry["line_lengths"])
+                    except (ValueError, KeyError, TypeError):
+                        # e.g. the last line, if the game was closed while it was written, or an answer that was cached
+                        # without its line lengths
+                        continue
+        except OSError as e:
+            logger.warning("Could not read the response cache: %s", e)
+
+
+    def _compact(self):
+        temporary_path = self.path.with_suffix(".tmp")
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            for key, cached in self.entries.items():
+                f.write(self._file_line(key, cached))
+        temporary_path.replace(self.path)
+        self.file_lines = len(self.entries)
+
+
+    @staticmethod
+    def _file_line(key, cached):
+        result, line_lengths = cached
+        return json.dumps({"key": key, "result": result, "line_lengths": line_lengths}, ensure_ascii=False) + "\n"
@@ -0,0 +1,56 @@
+"""What an NPC remembers of its conversations, for putting into the language model's prompts."""
+
+import threading
+from collections import deque
+
+
+class ShortTermMemory:
+    """The last lines of an NPC's conversations, up to a token budget.
+
+    The oldest lines are forgotten when the budget is exceeded, so a long session doesn't make the memory grow without
+    limit. The default budget is the language model's context size, as older lines could never fit in a prompt anyway.
+
+    Args:
+        max_tokens (int): How many tokens the lines may take in total
+    """
+
+
+    def __init__(self, max_tokens=1024):
+        self.max_tokens = max_tokens
+        self.entries = deque()  # (line, tokens in a prompt)
+        self.total_tokens = 0
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def append(self, line, num_tokens):
+        """Remembers a line, forgetting the oldest lines if over the budget.
+
+        Args:
+            line (str): e.g. what was said
+            num_tokens (int): How many tokens the line takes in a prompt, see GPT2Generator.line_length()
+        """
+        num_tokens = max(num_tokens, 1)
+        with self.lock:
+            self.entries.append((line, num_tokens))
+            self.total_tokens += num_tokens
+            while self.total_tokens > self.max_tokens and len(self.entries) > 1:
+                self.total_tokens -= self.entries.popleft()[1]
+
+
+    def lines(self):
+        """
+        Returns:
+            List[str]: The remembered lines, the oldest first
+        """
+        with self.lock:
+            return [line for line, _ in self.entries]
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_tokens = 0
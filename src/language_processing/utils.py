@@ -22,7 +22,7 @@ def format_input(text):
     return text.strip()
 
 
-def format_result(text):
+def format_result(text, strip=True):
     """
     Formats the result text from the AI to be more human-readable.
     """
@@ -33,7 +33,7 @@ def format_result(text):
     text = re.sub(r"(\"[.!?]) ([A-Z])", "\\1\n\n\\2", text)
     text = re.sub(r"([^\"][.!?]) \"", "\\1\n\n\"", text)
     text = re.sub(r"([\".!?]) \"", "\\1\n\"", text)
-    return text.strip()
+    return text.strip() if strip else text
 
 
 def _get_prefix(first_string, second_string):
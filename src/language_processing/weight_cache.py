@@ -0,0 +1,167 @@
+"""Fast loading of language models from a memory-mapped weight cache
+
+Loading pytorch_model.bin reads all of the weights into memory as 32-bit floats, and only then converts them to the
+precision that they are used in. The weight cache is a one-time conversion of them into a single file that is already in
+that precision. It's memory-mapped, so the weights are only read from the disk as they are needed.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from src.getconfig import logger
+
+ALIGNMENT = 64  # Bytes
+
+
+class WeightCache:
+    """The cached weights of a model, for one model class and precision.
+
+    The cache is stored next to the model's own files, as weight_cache_<model class>_<dtype>.bin and .json. It's considered
+    out of date if pytorch_model.bin changes.
+
+    Example:
+        cache = WeightCache(Path("language_models", "model_v5"), GPT2LMHeadModel, torch.float16)
+        if not cache.is_valid():
+            cache.save(model.state_dict())
+        model = cache.load_model()
+
+    Args:
+        model_path (Path): The directory of the model
+        model_class: e.g. GPT2LMHeadModel
+        dtype (torch.dtype): The precision of the weights
+    """
+
+
+    def __init__(self, model_path, model_class, dtype):
+        self.model_path = Path(model_path)
+        self.model_class = model_class
+        self.dtype = dtype
+        name = f"weight_cache_{model_class.__name__}_{str(dtype).replace('torch.', '')}"
+        self.data_path = self.model_path / f"{name}.bin"
+        self.index_path = self.model_path / f"{name}.json"
+        self.source_path = self.model_path / "pytorch_model.bin"
+
+
+    def is_valid(self):
+        """Checks whether the cache exists and was made from the current pytorch_model.bin.
+
+        Returns:
+            bool: Whether the cache can be loaded
+        """
+        if not self.data_path.exists() or not self.index_path.exists():
+            return False
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return index.get("source") == self._source_info() and index.get("data_size") == self.data_path.stat().st_size
+
+
+    def save(self, state_dict):
+        """Writes the cache.
+
+        Args:
+            state_dict (Dict[str, torch.Tensor]): The model's weights. Floating point tensors are converted to the cache's
+                precision.
+        """
+        tensors = {}
+        offsets = {}  # Tensors that share memory, like tied weights, are only written once
+        offset = 0
+        temporary_path = self.data_path.with_suffix(".tmp")
+        with open(temporary_path, "wb") as f:
+            for name, tensor in state_dict.items():
+                if tensor.is_floating_point():
+                    tensor = tensor.to(self.dtype)
+                key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+                if key not in offsets:
+                    array = tensor.detach().cpu().contiguous().numpy()
+                    padding = -offset % ALIGNMENT
+                    f.write(b"\0" * padding)
+                    offset += padding
+                    offsets[key] = offset
+                    f.write(array.tobytes())
+                    offset += array.nbytes
+                tensors[name] = {"offset": offsets[key], "shape": list(tensor.shape),
+                                 "dtype": str(tensor.dtype).replace("torch.", "")}
+
+        temporary_path.replace(self.data_path)
+        # The index is written last, so that an interrupted save is never mistaken for a valid cache
+        with open(self.index_path, "w") as f:
+            json.dump({"source": self._source_info(), "data_size": offset, "tensors": tensors}, f)
+
+
+    def load_state_dict(self):
+        """Maps the cached weights into memory.
+
+        Returns:
+            Dict[str, torch.Tensor]: The weights. They are read from the disk when they are first accessed.
+        """
+        with open(self.index_path) as f:
+            index = json.load(f)
+        state_dict = {}
+        mapped = {}
+        for name, info in index["tensors"].items():
+            key = (info["offset"], info["dtype"], tuple(info["shape"]))
+            if key not in mapped:
+                # Copy-on-write, so that PyTorch gets a writable array, but the pages are shared until written to
+                array = np.memmap(self.data_path, dtype=np.dtype(info["dtype"]), mode="c", offset=info["offset"],
+                                  shape=tuple(info["shape"]))
+                mapped[key] = torch.from_numpy(array)
+            state_dict[name] = mapped[key]
+        return state_dict
+
+
+    def load_model(self):
+        """Creates the model with the cached weights, without initializing any weights of its own.
+
+        Returns:
+            The model
+        """
+        model_class = self.model_class
+        config = model_class.config_class.from_pretrained(str(self.model_path))
+        state_dict = self.load_state_dict()
+        try:
+            # Without allocating or initializing the weights, as they'll be replaced anyway
+            with torch.device("meta"):
+                model = model_class(config)
+            model.load_state_dict(state_dict, assign=True)
+        except (AttributeError, TypeError):
+            # Older versions of PyTorch
+            model = model_class(config)
+            model.load_state_dict(state_dict)
+        model.tie_weights()
+        return model
+
+
+    def _source_info(self):
+        stat = self.source_path.stat()
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def load_pretrained(model_class, model_path, dtype):
+    """Loads a model through the weight cache, converting it into the cache first if needed.
+
+    Args:
+        model_class: e.g. GPT2LMHeadModel
+        model_path (Path): The directory of the model
+        dtype (torch.dtype): The precision to use the model in
+
+    Returns:
+        The model, in the given precision
+    """
+    cache = WeightCache(model_path, model_class, dtype)
+    if cache.is_valid():
+        return cache.load_model()
+
+    logger.info("Converting %s into a weight cache. This is only done once.", model_path)
+    model = model_class.from_pretrained(str(model_path))
+    model.to(dtype)
+    try:
+        cache.save(model.state_dict())
+    except OSError as e:
+        logger.warning("Could not write the weight cache: %s", e)
+    return model
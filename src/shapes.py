@@ -1,13 +1,67 @@
+from collections import OrderedDict
+
 from panda3d.bullet import BulletCapsuleShape, BulletBoxShape, BulletSphereShape, BulletCylinderShape, BulletConeShape
 from panda3d.bullet import BulletRigidBodyNode
 from panda3d.bullet import ZUp
-from panda3d.core import BitMask32
+from panda3d.core import BitMask32, LVecBase3f, NodePath
 from panda3d.core import Vec3, TransformState, Point3
 from shaders.basic_lighting import basic_lighting_shader
 
 
+# Shapes and visuals are shared by all bodies with the same dimensions, so that spawning many alike bodies only has to
+# link them into the scene. NOTE: Don't scale the bodies or the visuals' nodes, since that would change them all.
+# The least recently used are forgotten when there are more than max_shared_parts of either. Bodies that already use
+# them keep them, so this only bounds the memory that is kept for bodies that might be created later.
+max_shared_parts = 256
+_collision_shapes = OrderedDict()
+_visual_prototypes = OrderedDict()
+
+
+def _get_shared(cache, key, create):
+    value = cache.get(key)
+    if value is None:
+        value = cache[key] = create()
+        if len(cache) > max_shared_parts:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    return value
+
+
+def _make_key(*args):
+    # Panda's vectors are mutable, so they're keyed by their values
+    return tuple(tuple(arg) if isinstance(arg, LVecBase3f) else arg for arg in args)
+
+
+def get_collision_shape(shape_class, *args):
+    """Returns a shape_class(*args), which is created once and then shared by everyone who asks for the same one."""
+    return _get_shared(_collision_shapes, _make_key(shape_class, *args), lambda: shape_class(*args))
+
+
+def instance_visual(model_path, parent, scale, pos=Vec3(0, 0, 0), color=None):
+    """Attaches the model to parent, scaled, moved and colored, as an instance of a prototype that is loaded only once
+    for each combination of these.
+    """
+    def create_prototype():
+        prototype = NodePath(model_path)
+        loader.load_model(model_path).reparent_to(prototype)
+        prototype.set_pos_hpr_scale(pos, Vec3(0, 0, 0), scale)
+        if color is not None:
+            prototype.set_color(*color)
+        return prototype
+
+    key = _make_key(model_path, Vec3(scale), Vec3(pos), None if color is None else tuple(color))
+    return _get_shared(_visual_prototypes, key, create_prototype).instance_to(parent)
+
+
+def clear_shared_parts():
+    """Forgets all shared shapes and visuals, e.g. when the bodies that used them are gone."""
+    _collision_shapes.clear()
+    _visual_prototypes.clear()
+
+
 def create_physics_capsule(diameter, height):
-    shape = BulletCapsuleShape(diameter / 2, height - diameter, ZUp)
+    shape = get_collision_shape(BulletCapsuleShape, diameter / 2, height - diameter, ZUp)
     node_path = render.attach_new_node(BulletRigidBodyNode())
     node_path.set_collide_mask(BitMask32.bit(1))
     node_path.node().add_shape(shape)
@@ -20,15 +74,12 @@ def create_physics_capsule(diameter, height):
 def create_capsule(diameter, height, r=1, g=1, b=1, a=1):
     node_path = create_physics_capsule(diameter, height)
     node_path.set_shader(basic_lighting_shader)
-    visual = loader.load_model("3d-assets/unit_cylinder.bam")
-    visual.set_scale(Vec3(diameter, diameter, height))
-    visual.reparent_to(node_path)
-    visual.set_color(r, g, b, a)
+    instance_visual("3d-assets/unit_cylinder.bam", node_path, Vec3(diameter, diameter, height), color=(r, g, b, a))
     return node_path
 
 
 def create_physics_cone(diameter, height):
-    shape = BulletConeShape(diameter / 2, height, ZUp)
+    shape = get_collision_shape(BulletConeShape, diameter / 2, height, ZUp)
     node_path = render.attach_new_node(BulletRigidBodyNode())
     node_path.set_collide_mask(BitMask32.bit(1))
     node_path.node().add_shape(shape)
@@ -41,10 +92,7 @@ def create_physics_cone(diameter, height):
 def create_cone(diameter, height, r=1, g=1, b=1, a=1):
     node_path = create_physics_cone(diameter, height)
     node_path.set_shader(basic_lighting_shader)
-    visual = loader.load_model("3d-assets/unit_cone.bam")
-    visual.set_scale(Vec3(diameter, diameter, height))
-    visual.reparent_to(node_path)
-    visual.set_color(r, g, b, a)
+    instance_visual("3d-assets/unit_cone.bam", node_path, Vec3(diameter, diameter, height), color=(r, g, b, a))
     return node_path
 
 
@@ -53,9 +101,9 @@ def create_cone(diameter, height, r=1, g=1, b=1, a=1):
 def create_physics_rounded_box(width, depth, height):
     node_path = render.attach_new_node(BulletRigidBodyNode())
 
-    shape = BulletBoxShape(Vec3((width - depth) / 2, depth / 2, height / 2))
+    shape = get_collision_shape(BulletBoxShape, Vec3((width - depth) / 2, depth / 2, height / 2))
     node_path.node().add_shape(shape)
-    shape = BulletCylinderShape(depth / 2, height, ZUp)
+    shape = get_collision_shape(BulletCylinderShape, depth / 2, height, ZUp)
     node_path.node().add_shape(shape, TransformState.make_pos(Point3((-width + depth) / 2, 0, 0)))
     node_path.node().add_shape(shape, TransformState.make_pos(Point3((width - depth) / 2, 0, 0)))
 
@@ -69,15 +117,12 @@ def create_physics_rounded_box(width, depth, height):
 def create_rounded_box(width, depth, height, r=1, g=0, b=0, a=1):
     node_path = create_physics_rounded_box(width, depth, height)
     node_path.set_shader(basic_lighting_shader)
-    visual = loader.load_model("3d-assets/unit_cylinder.bam")
-    visual.set_scale(Vec3(width, depth, height))
-    visual.reparent_to(node_path)
-    visual.set_color(r, g, b, a)
+    instance_visual("3d-assets/unit_cylinder.bam", node_path, Vec3(width, depth, height), color=(r, g, b, a))
     return node_path
 
 
 def create_physics_box(dx, dy, dz):
-    shape = BulletBoxShape(Vec3(dx / 2, dy / 2, dz / 2))
+    shape = get_collision_shape(BulletBoxShape, Vec3(dx / 2, dy / 2, dz / 2))
     node_path = render.attach_new_node(BulletRigidBodyNode())
     node_path.set_collide_mask(BitMask32.bit(1))
     node_path.node().add_shape(shape)
@@ -90,15 +135,12 @@ def create_physics_box(dx, dy, dz):
 def create_box(dx, dy, dz, r=1, g=1, b=1, a=1):
     node_path = create_physics_box(dx, dy, dz)
     node_path.set_shader(basic_lighting_shader)
-    visual = loader.load_model("3d-assets/unit_cube.bam")
-    visual.set_scale(Vec3(dx, dy, dz))
-    visual.reparent_to(node_path)
-    visual.set_color(r, g, b, a)
+    instance_visual("3d-assets/unit_cube.bam", node_path, Vec3(dx, dy, dz), color=(r, g, b, a))
     return node_path
 
 
 def create_physics_sphere(diameter):
-    shape = BulletSphereShape(diameter / 2)
+    shape = get_collision_shape(BulletSphereShape, diameter / 2)
     node_path = render.attach_new_node(BulletRigidBodyNode())
     node_path.set_collide_mask(BitMask32.bit(1))
     node_path.node().add_shape(shape)
@@ -111,8 +153,5 @@ def create_physics_sphere(diameter):
 def create_sphere(diameter, r=1, g=1, b=1, a=1):
     node_path = create_physics_sphere(diameter)
     node_path.set_shader(basic_lighting_shader)
-    visual = loader.load_model("3d-assets/unit_sphere.bam")
-    visual.set_scale(Vec3(diameter, diameter, diameter))
-    visual.reparent_to(node_path)
-    visual.set_color(r, g, b, a)
+    instance_visual("3d-assets/unit_sphere.bam", node_path, Vec3(diameter, diameter, diameter), color=(r, g, b, a))
     return node_path
@@ -0,0 +1,225 @@
+"""Terrain elevation queries without physics raycasts.
+
+A BulletHeightfieldShape is a regular grid of triangles, so the height under any point can be calculated directly from the
+image the shape was made from. This is a lot cheaper than asking Bullet with a ray test.
+"""
+
+import numpy as np
+
+from src.utils import pnm_image_to_array
+
+
+class TerrainHeightSampler:
+    """Answers elevation queries for a terrain made with BulletHeightfieldShape.
+
+    The results match the triangles of the Bullet shape, as long as the shape's node has not been moved, rotated or scaled.
+
+    Example:
+        walk_map = create_or_load_walk_map("worldmaps/debug_heightmap.png", "worldmaps/debug_ocean.png")
+        terrain_colshape = BulletHeightfieldShape(walk_map, terrain_height, ZUp)
+        terrain_colshape.set_use_diamond_subdivision(True)
+        height_sampler = TerrainHeightSampler(walk_map, terrain_height, diamond_subdivision=True)
+        z = height_sampler.get_z(x, y)
+
+    Args:
+        image (PNMImage): The same image that was given to BulletHeightfieldShape
+        max_height (float): The same max_height that was given to BulletHeightfieldShape
+        diamond_subdivision (bool, optional): Whether set_use_diamond_subdivision(True) was called on the shape
+        outside_z (float, optional): The elevation to return for points outside the terrain
+    """
+
+
+    def __init__(self, image, max_height, diamond_subdivision=False, outside_z=0):
+        self.max_height = max_height
+        self.diamond_subdivision = diamond_subdivision
+        self.outside_z = outside_z
+
+        raw_pixels = pnm_image_to_array(image)
+        pixels = raw_pixels.astype(np.float64) / np.iinfo(raw_pixels.dtype).max
+        if pixels.shape[2] >= 3:
+            # The same weights as PNMImage.get_bright() uses
+            brightness = pixels[:, :, 0] * 0.299 + pixels[:, :, 1] * 0.587 + pixels[:, :, 2] * 0.114
+        else:
+            brightness = pixels[:, :, 0]
+
+        # Bullet's grid starts from the bottom row of the image. The shape is centered on all axes, including the vertical.
+        self.heights = np.ascontiguousarray(brightness[::-1] * max_height - max_height / 2)
+        self.y_size, self.x_size = self.heights.shape
+        self.x_offset = (self.x_size - 1) / 2
+        self.y_offset = (self.y_size - 1) / 2
+        # Indexing a flat memoryview gives plain Python floats, which is faster than going through NumPy for single points
+        self._flat_heights = memoryview(self.heights.reshape(-1)).cast('B').cast('d')
+
+
+    def get_z(self, x, y):
+        """Gets the terrain's elevation at a single point.
+
+        Args:
+            x (float): X coordinate in world space
+            y (float): Y coordinate in world space
+
+        Returns:
+            float: Z coordinate of the terrain's surface
+        """
+        grid_x = x + self.x_offset
+        grid_y = y + self.y_offset
+        if not (0 <= grid_x <= self.x_size - 1 and 0 <= grid_y <= self.y_size - 1):
+            return self.outside_z
+
+        # Both are non-negative here, so int() is the same as floor()
+        x0 = min(int(grid_x), self.x_size - 2)
+        y0 = min(int(grid_y), self.y_size - 2)
+        fx = grid_x - x0
+        fy = grid_y - y0
+        heights = self._flat_heights
+        i = y0 * self.x_size + x0
+        h00 = heights[i]
+        h10 = heights[i + 1]
+        h01 = heights[i + self.x_size]
+        h11 = heights[i + self.x_size + 1]
+
+        if self.diamond_subdivision and not (x0 + y0) & 1:
+            # The quad is split from (0, 0) to (1, 1)
+            if fy >= fx:
+                return h00 + fx * (h11 - h01) + fy * (h01 - h00)
+            return h00 + fx * (h10 - h00) + fy * (h11 - h10)
+
+        # The quad is split from (1, 0) to (0, 1)
+        if fx + fy <= 1:
+            return h00 + fx * (h10 - h00) + fy * (h01 - h00)
+        return h11 + (1 - fx) * (h01 - h11) + (1 - fy) * (h10 - h11)
+
+
+    def sample(self, xs, ys):
+        """Gets the terrain's elevation at many points at once.
+
+        Args:
+            xs (array_like): X coordinates in world space
+            ys (array_like): Y coordinates in world space, of the same shape as xs
+
+        Returns:
+            numpy.ndarray: Z coordinates of the terrain's surface, in the shape of xs
+        """
+        return self.sample_planes(xs, ys)[0]
+
+
+    def sample_planes(self, xs, ys):
+        """Gets the terrain's elevation and slope at many points at once.
+
+        The slope is that of the triangle each point is on, so z + dz_dx * dx + dz_dy * dy is exact for as long as the
+        offset stays on the same triangle. That is the case at least while the offset is shorter than the returned
+        radius, which is the point's distance to the nearest edge of its quad or of the quad's diagonal. Further away,
+        the plane may be off by up to the difference in elevation between neighboring grid points.
+
+        Args:
+            xs (array_like): X coordinates in world space
+            ys (array_like): Y coordinates in world space, of the same shape as xs
+
+        Returns:
+            Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]: Z coordinates of the terrain's surface,
+            the partial derivatives of the surface along the X and Y axes, and how far from the points the planes are
+            exact, each in the shape of xs
+        """
+        grid_x = np.asarray(xs, dtype=np.float64) + self.x_offset
+        grid_y = np.asarray(ys, dtype=np.float64) + self.y_offset
+        inside = (grid_x >= 0) & (grid_x <= self.x_size - 1) & (grid_y >= 0) & (grid_y <= self.y_size - 1)
+        grid_x = np.where(inside, grid_x, 0)
+        grid_y = np.where(inside, grid_y, 0)
+
+        x0 = np.minimum(np.floor(grid_x).astype(np.intp), self.x_size - 2)
+        y0 = np.minimum(np.floor(grid_y).astype(np.intp), self.y_size - 2)
+        fx = grid_x - x0
+        fy = grid_y - y0
+        heights = self.heights
+        h00 = heights[y0, x0]
+        h10 = heights[y0, x0 + 1]
+        h01 = heights[y0 + 1, x0]
+        h11 = heights[y0 + 1, x0 + 1]
+
+        # The quad is split from (1, 0) to (0, 1)
+        lower = fx + fy <= 1
+        dz_dx = np.where(lower, h10 - h00, h11 - h01)
+        dz_dy = np.where(lower, h01 - h00, h11 - h10)
+        if self.diamond_subdivision:
+            # Every other quad is split from (0, 0) to (1, 1) instead
+            diagonal = ((x0 + y0) & 1) == 0
+            upper_left = fy >= fx
+            dz_dx = np.where(diagonal, np.where(upper_left, h11 - h01, h10 - h00), dz_dx)
+            dz_dy = np.where(diagonal, np.where(upper_left, h01 - h00, h11 - h10), dz_dy)
+            # Both triangles of a diagonally split quad contain the (0, 0) corner
+            origin = np.where(diagonal | lower, h00, h11 - dz_dx - dz_dy)
+            diagonal_distance = np.where(diagonal, np.abs(fx - fy), np.abs(fx + fy - 1)) / np.sqrt(2)
+        else:
+            origin = np.where(lower, h00, h11 - dz_dx - dz_dy)
+            diagonal_distance = np.abs(fx + fy - 1) / np.sqrt(2)
+
+        z = np.where(inside, origin + fx * dz_dx + fy * dz_dy, self.outside_z)
+        # The sides of the triangle are on the quad's edges and its diagonal
+        radius = np.minimum(np.minimum(np.minimum(fx, 1 - fx), np.minimum(fy, 1 - fy)), diagonal_distance)
+        return z, np.where(inside, dz_dx, 0), np.where(inside, dz_dy, 0), np.where(inside, radius, 0)
+
+
+class GroundQueryBatch:
+    """Answers the elevation queries of many animals with one vectorized lookup per frame.
+
+    Every frame, after stepping the physics and before moving the animals, call resolve(). It asks each animal for the
+    points it's going to need (see Animal.get_ground_query_points()), and gives them back the terrain's surface around
+    those points. The animals then answer their own elevation queries from that, as long as the queries are on the same
+    triangles of the terrain.
+
+    Example:
+        ground_queries = GroundQueryBatch(height_sampler)
+        ground_queries.add(player)
+        ...
+        world.do_physics(dt)
+        ground_queries.resolve()
+        player.walk_in_dir(direction)
+
+    Args:
+        height_sampler (TerrainHeightSampler): What to query the elevations from
+    """
+
+
+    def __init__(self, height_sampler):
+        self.height_sampler = height_sampler
+        self.animals = []
+
+
+    def add(self, animal):
+        """Starts resolving the animal's elevation queries every frame.
+
+        Args:
+            animal (Animal): The animal
+        """
+        self.animals.append(animal)
+
+
+    def remove(self, animal):
+        """Stops resolving the animal's elevation queries.
+
+        Args:
+            animal (Animal): The animal
+        """
+        self.animals.remove(animal)
+
+
+    def resolve(self):
+        """Looks up the elevations for every animal's query points at once, and hands the results to the animals.
+        """
+        if not self.animals:
+            return
+        points = []
+        counts = []
+        for animal in self.animals:
+            animal_points = animal.get_ground_query_points()
+            points.extend(animal_points)
+            counts.append(len(animal_points))
+        if not points:
+            return
+
+        xs, ys = np.array(points, dtype=np.float64).T
+        planes = list(zip(xs.tolist(), ys.tolist(), *[values.tolist() for values in self.height_sampler.sample_planes(xs, ys)]))
+        start = 0
+        for animal, count in zip(self.animals, counts):
+            animal.set_ground_query_results(planes[start:start + count])
+            start += count
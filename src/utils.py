@@ -1,6 +1,7 @@
+import numpy as np
 from panda3d.core import PNMImage, Filename, PNMFileTypeRegistry
 from panda3d.core import Point3, BitMask32, TransformState
-from panda3d.core import SamplerState
+from panda3d.core import SamplerState, ATS_none
 from panda3d.core import ShaderTerrainMesh, Shader
 from panda3d.core import Texture
 import pyperclip
@@ -50,20 +51,103 @@ def normalize_angle(angle):
     return angle
 
 
+def pnm_image_to_array(image):
+    """Copies the pixel values of an image into a NumPy array.
+
+    Args:
+        image (PNMImage): The image to read. Should be 8-bit or 16-bit per channel.
+
+    Returns:
+        numpy.ndarray: Raw channel values shaped (y_size, x_size, num_channels), with rows from top to bottom and
+        channels in the same order as PNMImage uses (gray, gray-alpha, RGB or RGBA)
+    """
+    # Go through a Texture, because it gives us the whole image as one buffer
+    tex = Texture()
+    tex.set_auto_texture_scale(ATS_none)
+    tex.load(image)
+    dtype = np.uint16 if tex.get_component_width() == 2 else np.uint8
+    array = np.frombuffer(memoryview(tex.get_ram_image()), dtype=dtype)
+    array = array.reshape(tex.get_y_size(), tex.get_x_size(), tex.get_num_components())
+
+    # Textures are stored bottom-up and in BGR(A) order
+    array = array[::-1]
+    if array.shape[2] >= 3:
+        array = array[:, :, [2, 1, 0] + list(range(3, array.shape[2]))]
+    return np.ascontiguousarray(array)
+
+
+def array_to_pnm_image(array):
+    """The inverse of pnm_image_to_array().
+
+    Args:
+        array (numpy.ndarray): A uint8 or uint16 array shaped (y_size, x_size, num_channels)
+
+    Returns:
+        PNMImage: A new image with a maxval of 255 or 65535, depending on the array's dtype
+    """
+    num_channels = array.shape[2]
+    formats = {1: Texture.F_luminance, 2: Texture.F_luminance_alpha, 3: Texture.F_rgb, 4: Texture.F_rgba}
+    component_type = Texture.T_unsigned_short if array.dtype == np.uint16 else Texture.T_unsigned_byte
+
+    if num_channels >= 3:
+        array = array[:, :, [2, 1, 0] + list(range(3, num_channels))]
+    array = np.ascontiguousarray(array[::-1])
+
+    tex = Texture()
+    tex.set_auto_texture_scale(ATS_none)
+    tex.setup_2d_texture(array.shape[1], array.shape[0], component_type, formats[num_channels])
+    tex.set_ram_image(array.tobytes())
+    image = PNMImage()
+    tex.store(image)
+    return image
+
+
+def unfiltered_stretch_array(array, x_size, y_size):
+    """Nearest-neighbour resizing which picks the same source pixels as PNMImage.unfiltered_stretch_from()
+
+    Args:
+        array (numpy.ndarray): An array shaped (y_size, x_size, ...)
+        x_size (int): New width
+        y_size (int): New height
+
+    Returns:
+        numpy.ndarray: The resized array
+    """
+    ys = np.arange(y_size) * array.shape[0] // y_size
+    xs = np.arange(x_size) * array.shape[1] // x_size
+    return array[ys[:, None], xs[None, :]]
+
+
+def mask_walk_map(heightfield, ocean):
+    """Raises every ocean pixel in the heightfield to the maximum height, so that it can't be walked on.
+
+    Args:
+        heightfield (numpy.ndarray): The heightfield as returned by pnm_image_to_array(). Modified in place.
+        ocean (numpy.ndarray): The ocean map as returned by pnm_image_to_array(). Pixels whose green value is zero are ocean.
+
+    Returns:
+        numpy.ndarray: The heightfield
+    """
+    # For grayscale images PNMImage.get_green() returns the gray value
+    green = 1 if ocean.shape[2] >= 3 else 0
+    ocean_mask = ocean[:, :, green] == 0
+    # PNMImage.set_gray() sets every color channel but leaves alpha alone
+    color_channels = 3 if heightfield.shape[2] >= 3 else 1
+    masked_area = heightfield[:ocean_mask.shape[0], :ocean_mask.shape[1], :color_channels]
+    masked_area[ocean_mask] = np.iinfo(heightfield.dtype).max
+    return heightfield
+
+
 def create_or_load_walk_map(file_name_prefix, ocean_map_file):
     walk_map_file_name = file_name_prefix + ".walk"
     new_file = Filename(walk_map_file_name)
     if new_file.exists():
         return PNMImage(new_file)
 
-    ocean_map = PNMImage(Filename(ocean_map_file))
-    if ocean_map.get_x_size() % 2 == 0:
+    ocean = pnm_image_to_array(PNMImage(Filename(ocean_map_file)))
+    if ocean.shape[1] % 2 == 0:
         # Resize to quadratic + 1
-        ocean_resized = PNMImage(ocean_map.get_x_size() + 1, ocean_map.get_y_size() + 1, ocean_map.get_num_channels(),
-                                 ocean_map.get_maxval(), ocean_map.get_type(), ocean_map.get_color_space())
-        ocean_resized.unfiltered_stretch_from(ocean_map)
-    else:
-        ocean_resized = ocean_map
+        ocean = unfiltered_stretch_array(ocean, ocean.shape[1] + 1, ocean.shape[0] + 1)
 
     old_heightfield = PNMImage(Filename(file_name_prefix))
     if old_heightfield.get_x_size() % 2 == 0:
@@ -75,10 +159,8 @@ def create_or_load_walk_map(file_name_prefix, ocean_map_file):
     else:
         resized_heightfield = old_heightfield
 
-    for x in range(ocean_resized.get_x_size()):
-        for y in range(ocean_resized.get_y_size()):
-            if ocean_resized.get_green(x, y) == 0:
-                resized_heightfield.set_gray(x, y, 1)
+    heightfield = mask_walk_map(pnm_image_to_array(resized_heightfield), ocean)
+    resized_heightfield = array_to_pnm_image(heightfield)
     png_type = PNMFileTypeRegistry.get_global_ptr().get_type_from_extension('.png')
     resized_heightfield.write(new_file, png_type)
     return resized_heightfield